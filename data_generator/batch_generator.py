@@ -3,137 +3,42 @@ import random
 import os
 import sys
 import pathlib
-import scipy.misc
+import json
 import cv2
-from glob import glob
+import multiprocessing
+import itertools
+import copy
 from math import ceil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import trange
 
-from helpers.ground_truth_conversion_utils import convert_IDs_to_IDs, convert_IDs_to_one_hot
+from helpers.image_codecs import imread, imwrite
+from helpers.ground_truth_conversion_utils import convert_IDs_to_IDs, convert_IDs_to_IDs_partial, convert_IDs_to_one_hot, convert_between_IDs_and_colors
+from data_generator.dataset_manifest import DatasetManifest
+from data_generator.sample_table import SampleTable
+from data_generator.dataset_store import DatasetStore, INDEX_FILE_NAME, IMAGES_SHARD_NAME, GROUND_TRUTH_SHARD_NAME
 
-class BatchGenerator():
+class _BatchGeneratorBase():
 
-    def __init__(self,
-                 image_dirs,
-                 image_file_extension='png',
-                 ground_truth_dirs=None,
-                 image_name_split_separator=None,
-                 ground_truth_suffix=None,
-                 check_existence=True,
-                 num_classes=None,
-                 root_dir=None,
-                 export_dir=None):
+    def __init__(self, num_classes=None):
         '''
+        The batch generation pipeline that `BatchGenerator` and `RecordBatchGenerator` share. Subclasses
+        set `dataset_size` and `ground_truth` and implement `_generate_batch_paths()`, which determines
+        where the samples come from. Everything from there on, i.e. processing, augmentation, worker
+        processes, and batch assembly, happens in `generate()`.
+
         Arguments:
-            image_dirs (list): A list of directory paths, each of which contain
-                images either directly or within a hierarchy of subdirectories.
-                The directory paths given serve as root directories and the generator
-                will load images from all subdirectories within. This lets you
-                combine multiple datasets randomly. All images must have 3 channels.
-            image_file_extension (string, optional): The file extension of the
-                images in the datasets. Must be identical for all images in all
-                datasets in `datasets`. Defaults to `png`.
-            ground_truth_dirs (list, optional): `None` or a list of directory paths,
-                each of which contain the ground truth images that correspond to
-                the respective directory paths in `datasets`. The ground truth
-                images must have 1 channel that encodes the segmentation classes
-                numbered consecutively from 0 to `n`, where `n` is an integer.
-            image_name_split_separator (string, optional): Only relevant if
-                `ground_truth_dirs` contains at least one item. A string by which
-                the image names will be split into a left and right part, the left
-                part of which (i.e. the beginning of the image file name) will be
-                used to get the matching ground truth image file name. More precisely,
-                all characters left of the separator string will constitute the
-                beginning of the file name of the corresponding ground truth image.
-            ground_truth_suffix (string, optional): The suffix added to the left part of
-                an image name string (see `image_name_split_separator`) in order
-                to compose the name of the corresponding ground truth image file.
-                The suffix must exclude the file extension.
-            check_existence (bool, optional): Only relevant if ground truth images
-                are given. If `True`, the constructor checks for each ground truth image
-                path whether the respective file actually exists and throws a
-                `DataError` if it doesn't. Defaults to `True`.
-            num_classes (int, optional): The number of segmentation classes in the
-                ground truth data. Only relevant if you want the generator to convert
-                numeric labels to one-hot format, otherwise you can leave this `None`.
-            root_dir (string, optional): The dataset root directory. This is only
-                relevant if you want to use the generator to save processed data
-                to disk in addition to yielding it, i.e. if you want to do offline processing.
-                In this case, the generator will reproduce the directory hierarchy
-                of the source data within the target directory in which to save
-                the processed data. It needs to know the root directory of the
-                dataset in order to do so
-            export_dir (string, optional): This is only relevant if you want use
-                the generator to save processed data to disk in addition to yielding it,
-                i.e. if you want to do offline processing. This is the directory
-                into which the processed data will be written. The generator will
-                reproduce the directory hierarchy of the source data within this
-                directory.
+            num_classes (int, optional): The number of segmentation classes, see `BatchGenerator`.
         '''
-
-        self.image_dirs = image_dirs
-        self.ground_truth_dirs = ground_truth_dirs
-        self.root_dir = root_dir # The dataset root directory.
-        self.export_dir = export_dir
-        self.image_paths = [] # The list of images from which the generator will draw.
-        self.ground_truth_paths = {} # The dictionary of ground truth images that correspond to the images.
         self.num_classes = num_classes
         self.dataset_size = 0
         self.ground_truth = False # Whether or not ground truth images were given.
 
-        if (not self.ground_truth_dirs is None) and (len(self.image_dirs) != len(self.ground_truth_dirs)):
-            raise ValueError("`image_dirs` and `ground_truth_dirs` must contain the same number of elements.")
-
-        image_file_extension = image_file_extension.lower()
-
-        for i, image_dir in enumerate(image_dirs): # Iterate over all given datasets.
-
-            for image_dir_path, subdir_list, file_list in os.walk(image_dir, topdown=True): # Iterate over all subdirectories of this dataset directory.
-
-                image_paths = glob(os.path.join(image_dir_path, '*.' + image_file_extension)) # Get all images in this directory
-
-                if len(image_paths) > 0: # If there are any images, add them to the list of images.
-
-                    self.image_paths += image_paths
-
-                    if not ground_truth_dirs is None: # If there is ground truth data, add it to the ground truth list.
-                        # Get the path of the ground truth directory that corresponds to this image directory.
-                        ground_truth_dir = ground_truth_dirs[i] # Get the head.
-                        ground_truth_subdir = os.path.basename(os.path.normpath(image_dir_path)) # Get the subdirectory we're currently in.
-                        ground_truth_dir_path = os.path.join(ground_truth_dir, ground_truth_subdir)
-
-                        # Loop over all image paths to collect the corresponding ground truth image paths.
-                        for image_path in image_paths:
-                            # Construct the name of the ground truth image from the name of the image.
-                            image_name = os.path.basename(image_path)
-                            left_part = image_name.split(image_name_split_separator, 1)[0] # Get the left part of the split.
-                            # Compose the name of the ground truth image that corresponds to this image.
-                            ground_truth_image_name = left_part + ground_truth_suffix + '.' + image_file_extension
-                            # Create the full path to this ground truth image.
-                            ground_truth_path = os.path.join(ground_truth_dir_path, ground_truth_image_name)
-
-                            if check_existence and not os.path.isfile(ground_truth_path):
-                                raise DataError("The dataset contains an image file '{}' for which the corresponding ground truth image file does not exist at '{}'.".format(image_path, ground_truth_path))
-
-                            # Add the pair `image_name : ground_truth_path` to the dictionary
-                            self.ground_truth_paths[image_name] = ground_truth_path
-
-        self.dataset_size = len(self.image_paths)
-
-        if self.dataset_size == 0:
-            raise DataError("No images with the given file extension '{}' were found in the given image directories.".format(image_file_extension))
-
-        if (not ground_truth_dirs is None) and (len(self.ground_truth_paths) != self.dataset_size):
-            raise DataError('Ground truth directories were given, but the number of ground truth images found does not match the number of images. Number of images: {}. Number of ground truth images: {}'.format(self.dataset_size, len(self.ground_truth_paths)))
-
-        if len(self.ground_truth_paths) > 0:
-            self.ground_truth = True
-
     def get_num_files(self):
         '''
-        Returns the total number of image files (or image/ground truth image file
-        pairs if ground truth data was given) contained in all dataset directories
-        passed to the BatchGenerator constructor.
+        Returns the total number of images (or image/ground truth image pairs if
+        ground truth data was given) that the generator draws from.
         '''
         return self.dataset_size
 
@@ -152,12 +57,29 @@ class BatchGenerator():
                  scale=False,
                  gray=False,
                  to_disk=False,
-                 shuffle=True):
+                 shuffle=True,
+                 num_workers=0,
+                 prefetch=2,
+                 seed=None,
+                 store_dir=None,
+                 batch_augmentation=False,
+                 fused_geometry=False,
+                 reuse_buffers=False,
+                 sampler=None,
+                 bucket_by=None,
+                 scales=None,
+                 size_multiple=32,
+                 read_ahead=0,
+                 read_ahead_bytes=256*1024*1024,
+                 read_ahead_threads=8):
         '''
 
         With any of the image transformations below, the respective ground truth images, if given,
         will be transformed accordingly.
 
+        `to_disk`, `store_dir`, `sampler`, and `bucket_by` require random access to the sample files
+        and are only supported by `BatchGenerator`.
+
         Arguments:
             batch_size (int): The number of images (or image/ground truth pairs) to generate per
                 batch.
@@ -167,7 +89,8 @@ class BatchGenerator():
                 value. If the input ground truth images are 3-channel color images and a conversion
                 dictionary is passed, the ground truth images will be converted to single-channel
                 images with the according class IDs instead of color values. It is recommended to
-                perform color-to-ID conversion offline.
+                perform color-to-ID conversion offline, although the conversion only takes a single
+                vectorized pass over each image. Colors that are not in the dictionary are converted to ID 0.
             convert_ids_to_ids (array or dict, optional): `False` or either a 1D Numpy array or a Python
                 dictionary that represents a map according to which the generator will convert the
                 grund truth data's current class IDs to the desired class IDs. In the case of an array,
@@ -176,9 +99,11 @@ class BatchGenerator():
                 current class IDs. In the case of a dictionary, both keys and values must be integers.
                 The keys are the current IDs and the values are the desired IDs to which to convert.
                 The dictionary does not need to contain a mapping for all possible unique current class IDs.
-                For conversion of all IDs, an array will enable much faster conversion than a dictionary.
+                For `uint8` and `uint16` ground truth, a dictionary is converted just as fast as an array.
             convert_to_one_hot (bool, optional): If `True`, the ground truth data will be converted to
-                one-hot format.
+                one-hot format. Set this to `False` to feed an `FCN8s` model that was built with
+                `sparse_labels=True`, which performs the one-hot conversion inside the graph. The ground
+                truth data is then yielded as integer label maps, which are much smaller.
             void_class_id (int, optional): The class ID of a 'void' or 'background' class. Only relevant
                 if any of the `random_crop`, `translate`, or `scale` transformations are being used
                 on ground truth data. Determines the pixel value of blank image space that might occur
@@ -211,6 +136,86 @@ class BatchGenerator():
             to_disk (bool, optional): If `True`, the generated batches are being saved to `export_dir` (see constuctor)
                 in addition to being yielded. This can be used for offline dataset processing.
             shuffle (bool, optional): If `True`, the dataset will be shuffled before each new pass.
+            num_workers (int, optional): The number of worker processes among which the loading and processing
+                of the individual samples is distributed. If `0`, all samples are loaded and processed serially
+                in the calling process. The shuffling and the composition of the batches are still determined
+                by the calling process, so the generated batches and their order are the same as in the serial
+                case. Defaults to 0.
+            prefetch (int, optional): Only relevant if `num_workers > 0`. The maximal number of batches that are
+                being processed in the background ahead of the batch that is currently being consumed. Bounds
+                the memory used for batches that are ready, but haven't been consumed yet. Defaults to 2.
+            seed (int, optional): `None` or a non-negative integer. If an integer is given, the generator doesn't
+                use the global random number generators. Instead, the shuffle of each pass is drawn from a random
+                number generator seeded with `(seed, epoch)`, and each sample is augmented with its own random
+                number generator seeded with `(seed, epoch, sample_index)`, where `sample_index` is the position
+                of the sample within the pass. The generated batches therefore only depend on `seed`,
+                independently of `num_workers`. Defaults to `None`.
+            store_dir (string, optional): `None` or the directory of a store that was created with `pack()`.
+                If a store is given, the decoded images and ground truth images are read from the memory-mapped
+                store instead of being decoded from the image files. The store must contain all images
+                of this generator. Defaults to `None`.
+            batch_augmentation (bool, optional): If `True`, the `brightness`, `flip`, and `translate` transformations
+                (as well as `gray` and `convert_to_one_hot`) are not applied to each sample individually, but to
+                the assembled batch as a whole in a few vectorized operations, which removes most of the per-sample
+                overhead. The distribution of the outputs is the same. Requires that all samples of a batch have the
+                same size and can't be combined with `to_disk`. If `seed` is given, the random number generator of
+                a batch is seeded with `(seed, epoch, sample_index, 1)`, where `sample_index` is the index of the
+                first sample of the batch. Defaults to `False`.
+            fused_geometry (bool, optional): If `True`, the `random_crop`, `crop`, `resize`, `flip`, `translate`,
+                and `scale` transformations of a sample are combined into a single affine transformation that is
+                applied with one warp per image and ground truth image (nearest-neighbor interpolation and
+                `void_class_id` border for the ground truth), instead of copying or resampling the sample once for
+                every transformation. The random parameters are the same as without fusion, so the results only
+                differ in interpolation. Defaults to `False`.
+            reuse_buffers (bool, optional): Only relevant if `random_crop` or `resize` is set, i.e. if all samples
+                have the same output shape. In this case the samples are written directly into preallocated batch
+                arrays instead of being stacked into new arrays, and the one-hot conversion writes directly into its
+                batch array, too. If `True`, the generator cycles through a ring of two sets of batch arrays, so that
+                no memory is allocated per batch, but a yielded batch is overwritten once the generator has been
+                advanced twice after yielding it. Copy the batch if you need to keep it for longer. If `False`,
+                new batch arrays are allocated for every batch. Defaults to `False`.
+            sampler (Sampler, optional): `None` or a sampler from `data_generator.samplers` that selects the samples
+                of each batch instead of the uniform shuffle, e.g. to balance the classes or to focus on hard examples.
+                If the sampler chooses a class for a sample, the sample's random crop is centered on a random pixel of
+                that class. The sample indices of the batch that was yielded last are available as the sampler's
+                `last_batch_indices`. `shuffle` has no effect if a sampler is given. If `seed` is given, the samples
+                are selected with a random number generator seeded with `seed`, and each sample is augmented with its
+                own random number generator seeded with `(seed, batch_index, position)`. Defaults to `None`.
+            bucket_by (string, optional): `None`, 'size', or 'aspect_ratio'. Makes it possible to train on datasets
+                with varying image sizes without `random_crop` or `resize`. The samples are grouped into buckets,
+                and each batch is drawn from a single bucket, so that all samples of a batch have the same shape.
+                With 'size', a bucket contains all images of the same size, which keeps all images at their native
+                resolution. With 'aspect_ratio', a bucket contains all images whose aspect ratios lie within about
+                9% of each other, and all images of a bucket are resized to the size that is most common in it.
+                This avoids small batches for datasets with many slightly different sizes. Each pass shuffles the
+                samples within each bucket (if `shuffle` is `True`), splits each bucket into batches, and shuffles
+                the order of the batches, so the last batch of each bucket may be smaller than `batch_size`.
+                The image sizes are read from the image file headers the first time they are needed, which is only
+                supported for PNG images, and are stored in the manifest if there is one. Can't be combined with `random_crop`, `resize`, or `sampler`. If `seed` is
+                given, each sample is augmented with its own random number generator seeded with
+                `(seed, epoch, batch_index, position)`. Defaults to `None`.
+            scales (list, optional): `None` or a list of positive floats for multi-scale training. Requires `random_crop`
+                or `resize`. For each batch, a scale is drawn uniformly from the list, and the whole batch is generated at
+                the output size `(height, width)` of `random_crop` (or, if `random_crop` isn't used, of `resize`) multiplied
+                by that scale and rounded to the nearest multiple of `size_multiple`. With `random_crop`, this crops larger
+                or smaller patches at the native resolution, with `resize`, it resizes the images to a larger or smaller size.
+                All samples of a batch have the same size, but the size varies between batches. If `seed` is given, the
+                scales are drawn from a random number generator seeded with `seed`. Defaults to `None`.
+            size_multiple (int, optional): Only relevant if `scales` is given. The output sizes are multiples of this number.
+                The FCN-8s decoder upsamples its stride-32 output by 2, 2, and 8, so the default of 32 makes sure that the
+                shapes of the skip connections always match. Defaults to 32.
+            read_ahead (int, optional): The number of upcoming samples whose image files (and ground truth image files)
+                are being read into memory in the background by a pool of threads, so that the file system latency overlaps
+                with the decoding and processing of the current samples. The decoding itself still happens in the calling
+                process (or in the worker processes if `num_workers > 0`). Helps most on network file systems and with a
+                cold page cache. Whole batches are being read ahead, at least one. If `0`, every sample is read when it is
+                being processed. Can't be combined with `to_disk` or `store_dir`. Defaults to 0.
+            read_ahead_bytes (int, optional): Only relevant if `read_ahead > 0`. Bounds the memory used by the files that
+                were read ahead, but not yet consumed: No further batch is being read ahead while the files of the pending
+                batches (estimated from the average file size for reads that haven't finished yet) exceed this number of
+                bytes. Defaults to 256 MiB.
+            read_ahead_threads (int, optional): Only relevant if `read_ahead > 0`. The number of threads that read files.
+                Defaults to 8.
 
         Yields:
             Either one 4D Numpy array of shape `(batch_size, img_height, img_with, num_channels)` with the
@@ -224,197 +229,616 @@ class BatchGenerator():
         if convert_to_one_hot and self.num_classes is None:
             raise ValueError("One-hot conversion requires that you pass an integer value for `num_classes` in the constructor, but `num_classes` is `None`.")
 
+        if num_workers > 0 and prefetch < 1:
+            raise ValueError("`prefetch` must be at least 1 if `num_workers > 0`, but is {}.".format(prefetch))
+
+        if (not seed is None) and seed < 0:
+            raise ValueError("`seed` must be `None` or a non-negative integer, but is {}.".format(seed))
+
+        if (not bucket_by is None) and (random_crop or resize or (not sampler is None)):
+            raise ValueError("`bucket_by` can't be combined with `random_crop`, `resize`, or `sampler`.")
+
+        if read_ahead > 0 and (to_disk or (not store_dir is None)):
+            raise ValueError("`read_ahead` can't be combined with `to_disk` or `store_dir`.")
+
+        if not scales is None:
+            if not (random_crop or resize):
+                raise ValueError("`scales` requires `random_crop` or `resize`.")
+            if len(scales) == 0 or min(scales) <= 0:
+                raise ValueError("`scales` must be a non-empty list of positive numbers.")
+
+        # The sample indices of the batches that were selected by `sampler`, but not yet yielded.
+        selected_batches = deque()
+        # Each batch comes with a dictionary of processing arguments that override `processing_kwargs` for this batch, or `None`.
+        batches, source_kwargs = self._generate_batch_source(batch_size=batch_size,
+                                                             shuffle=shuffle,
+                                                             seed=seed,
+                                                             selected_batches=selected_batches,
+                                                             to_disk=to_disk,
+                                                             store_dir=store_dir,
+                                                             sampler=sampler,
+                                                             bucket_by=bucket_by)
+
+        # All arguments that determine how an individual sample is being processed.
+        processing_kwargs = {'convert_colors_to_ids': convert_colors_to_ids,
+                             'convert_ids_to_ids': convert_ids_to_ids,
+                             'convert_to_one_hot': convert_to_one_hot,
+                             'num_classes': self.num_classes,
+                             'void_class_id': void_class_id,
+                             'random_crop': random_crop,
+                             'crop': crop,
+                             'resize': resize,
+                             'brightness': brightness,
+                             'flip': flip,
+                             'translate': translate,
+                             'scale': scale,
+                             'gray': gray,
+                             'to_disk': to_disk,
+                             'fused_geometry': fused_geometry}
+        processing_kwargs.update(source_kwargs)
+
+        if batch_augmentation:
+            if to_disk:
+                raise ValueError("`batch_augmentation` can't be combined with `to_disk`.")
+            # These transformations are applied to the assembled batches instead of the individual samples.
+            batch_augmentation_kwargs = {'convert_to_one_hot': convert_to_one_hot,
+                                         'num_classes': self.num_classes,
+                                         'void_class_id': void_class_id,
+                                         'brightness': brightness,
+                                         'flip': flip,
+                                         'translate': translate,
+                                         'gray': gray}
+            for key in ['convert_to_one_hot', 'brightness', 'flip', 'translate', 'gray']:
+                processing_kwargs[key] = False
+        else:
+            batch_augmentation_kwargs = None
+
+        assembly_kwargs = {'batch_augmentation_kwargs': batch_augmentation_kwargs,
+                           'buffers': None,
+                           'one_hot_classes': None}
+
+        if random_crop or resize or bucket_by: # All samples of a batch have the same shape, so they can be written into preallocated batch arrays.
+            assembly_kwargs['buffers'] = _BatchBuffers(batch_size=batch_size, reuse=reuse_buffers)
+            if convert_to_one_hot and not to_disk:
+                # Write the one-hot ground truth directly into the batch array instead of converting each sample.
+                assembly_kwargs['one_hot_classes'] = self.num_classes
+                processing_kwargs['convert_to_one_hot'] = False
+                if not batch_augmentation_kwargs is None:
+                    batch_augmentation_kwargs['convert_to_one_hot'] = False
+
+        if not scales is None:
+            batches = _generate_scaled_batches(batches=batches,
+                                               scales=scales,
+                                               size=random_crop if random_crop else resize,
+                                               size_key='random_crop' if random_crop else 'resize',
+                                               size_multiple=size_multiple,
+                                               seed=seed)
+
+        if read_ahead > 0:
+            batches = _read_ahead(batches=batches,
+                                  num_samples=read_ahead,
+                                  max_bytes=read_ahead_bytes,
+                                  num_threads=read_ahead_threads)
+
+        if num_workers > 0:
+
+            pool = multiprocessing.Pool(processes=num_workers, initializer=_seed_worker)
+            pending_batches = deque() # The batches that are currently being processed by the workers.
+
+            try:
+                while True:
+                    # Keep `prefetch` batches in flight so that the workers never idle while a batch is being consumed.
+                    while len(pending_batches) < prefetch:
+                        batch_paths, batch_kwargs = next(batches)
+                        kwargs = processing_kwargs if batch_kwargs is None else dict(processing_kwargs, **batch_kwargs)
+                        pending_batches.append((batch_paths, [pool.apply_async(_process_sample, args=sample_paths, kwds=kwargs)
+                                                              for sample_paths in batch_paths]))
+                    # Wait for the oldest batch to be complete and yield it.
+                    batch_paths, results = pending_batches.popleft()
+                    samples = [result.get() for result in results]
+                    if not sampler is None: sampler.last_batch_indices = selected_batches.popleft()
+                    yield self._assemble_batch(samples, batch_paths, **assembly_kwargs)
+            finally:
+                pool.terminate()
+
+        else:
+
+            for batch_paths, batch_kwargs in batches:
+                kwargs = processing_kwargs if batch_kwargs is None else dict(processing_kwargs, **batch_kwargs)
+                samples = [_process_sample(*sample_paths, **kwargs) for sample_paths in batch_paths]
+                if not sampler is None: sampler.last_batch_indices = selected_batches.popleft()
+                yield self._assemble_batch(samples, batch_paths, **assembly_kwargs)
+
+    def _generate_batch_source(self, batch_size, shuffle, seed, selected_batches, to_disk=False, store_dir=None, sampler=None, bucket_by=None):
+        '''
+        Returns the batches that `generate()` processes as a generator of tuples `(batch_paths, batch_kwargs)`,
+        and a dictionary of additional processing arguments for `_process_sample()`.
+
+        This implementation streams the samples of `_generate_batch_paths()` and supports none of the
+        arguments that require random access to the sample files.
+        '''
+        for argument, value in [('to_disk', to_disk), ('store_dir', store_dir), ('sampler', sampler), ('bucket_by', bucket_by)]:
+            if value:
+                raise ValueError("`{}` is not supported by `{}`.".format(argument, type(self).__name__))
+
+        return ((batch_paths, None) for batch_paths in self._generate_batch_paths(batch_size=batch_size, shuffle=shuffle, seed=seed)), {}
+
+    def _generate_batch_paths(self, batch_size, shuffle, seed=None):
+        '''
+        Generates the samples that make up each batch indefinitely, as a list of tuples whose elements
+        are the positional arguments of `_process_sample()`.
+        '''
+        raise NotImplementedError
+
+
+    def _assemble_batch(self, samples, batch_paths, batch_augmentation_kwargs=None, buffers=None, one_hot_classes=None):
+        '''
+        Stacks a list of processed `(image, gt_image)` samples into the arrays that `generate()` yields
+        and maybe applies the batch-level augmentations and the one-hot conversion to them.
+
+        Arguments:
+            buffers (_BatchBuffers, optional): If given, the samples are written into batch arrays
+                from `buffers`, otherwise they are stacked into new arrays.
+            one_hot_classes (int, optional): If given, the ground truth is converted to one-hot format
+                with this many classes after the batch has been assembled.
+        '''
+        if buffers is None:
+            images = np.array([sample[0] for sample in samples])
+            gt_images = np.array([sample[1] for sample in samples]) if self.ground_truth else None
+        else:
+            images = buffers.stack([sample[0] for sample in samples])
+            gt_images = buffers.stack([sample[1] for sample in samples]) if self.ground_truth else None
+
+        if not batch_augmentation_kwargs is None:
+            random_seed = batch_paths[0][2]
+            rng = np.random if random_seed is None else np.random.RandomState(random_seed + [1])
+            images, gt_images = _augment_batch(images, gt_images, rng=rng, **batch_augmentation_kwargs)
+
+        if not one_hot_classes is None:
+            one_hot = buffers.get(gt_images.shape[1:] + (one_hot_classes,), np.bool_)[:len(gt_images)]
+            np.equal(gt_images[..., np.newaxis], np.arange(one_hot_classes), out=one_hot)
+            gt_images = one_hot
+
+        if self.ground_truth:
+            return images, gt_images
+        else:
+            return images
+
+class BatchGenerator(_BatchGeneratorBase):
+
+    def __init__(self,
+                 image_dirs,
+                 image_file_extension='png',
+                 ground_truth_dirs=None,
+                 image_name_split_separator=None,
+                 ground_truth_suffix=None,
+                 check_existence=True,
+                 num_classes=None,
+                 root_dir=None,
+                 export_dir=None,
+                 manifest_path=None,
+                 revalidate_manifest=False):
+        '''
+        Arguments:
+            image_dirs (list): A list of directory paths, each of which contain
+                images either directly or within a hierarchy of subdirectories.
+                The directory paths given serve as root directories and the generator
+                will load images from all subdirectories within. This lets you
+                combine multiple datasets randomly. All images must have 3 channels.
+            image_file_extension (string, optional): The file extension of the
+                images in the datasets. Must be identical for all images in all
+                datasets in `datasets`. Defaults to `png`.
+            ground_truth_dirs (list, optional): `None` or a list of directory paths,
+                each of which contain the ground truth images that correspond to
+                the respective directory paths in `datasets`. The ground truth
+                images must have 1 channel that encodes the segmentation classes
+                numbered consecutively from 0 to `n`, where `n` is an integer.
+            image_name_split_separator (string, optional): Only relevant if
+                `ground_truth_dirs` contains at least one item. A string by which
+                the image names will be split into a left and right part, the left
+                part of which (i.e. the beginning of the image file name) will be
+                used to get the matching ground truth image file name. More precisely,
+                all characters left of the separator string will constitute the
+                beginning of the file name of the corresponding ground truth image.
+            ground_truth_suffix (string, optional): The suffix added to the left part of
+                an image name string (see `image_name_split_separator`) in order
+                to compose the name of the corresponding ground truth image file.
+                The suffix must exclude the file extension.
+            check_existence (bool, optional): Only relevant if ground truth images
+                are given. If `True`, the constructor checks for each ground truth image
+                path whether the respective file actually exists and throws a
+                `DataError` if it doesn't. Defaults to `True`.
+            num_classes (int, optional): The number of segmentation classes in the
+                ground truth data. Only relevant if you want the generator to convert
+                numeric labels to one-hot format, otherwise you can leave this `None`.
+            root_dir (string, optional): The dataset root directory. This is only
+                relevant if you want to use the generator to save processed data
+                to disk in addition to yielding it, i.e. if you want to do offline processing.
+                In this case, the generator will reproduce the directory hierarchy
+                of the source data within the target directory in which to save
+                the processed data. It needs to know the root directory of the
+                dataset in order to do so
+            export_dir (string, optional): This is only relevant if you want use
+                the generator to save processed data to disk in addition to yielding it,
+                i.e. if you want to do offline processing. This is the directory
+                into which the processed data will be written. The generator will
+                reproduce the directory hierarchy of the source data within this
+                directory.
+            manifest_path (string, optional): `None` or the path of a manifest file that lists the
+                dataset's image files (and ground truth image files). If the file exists and was written
+                for the same arguments, the dataset is read from it instead of scanning the directories,
+                which makes the constructor fast for large datasets and slow file systems. Otherwise the
+                directories are scanned and the manifest is written to this path. If you add or remove
+                files, either delete the manifest or set `revalidate_manifest`.
+            revalidate_manifest (bool, optional): Only relevant if `manifest_path` points to an existing
+                manifest. If `True`, the directories whose modification time changed since the manifest
+                was written are scanned again and the manifest is updated. This detects added, removed,
+                and renamed files at the cost of one `stat` call per directory. Defaults to `False`.
+        '''
+        super().__init__(num_classes=num_classes)
+
+        self.image_dirs = image_dirs
+        self.ground_truth_dirs = ground_truth_dirs
+        self.root_dir = root_dir # The dataset root directory.
+        self.export_dir = export_dir
+
+        if (not self.ground_truth_dirs is None) and (len(self.image_dirs) != len(self.ground_truth_dirs)):
+            raise ValueError("`image_dirs` and `ground_truth_dirs` must contain the same number of elements.")
+
+        image_file_extension = image_file_extension.lower()
+
+        # Keep the arguments rather than the manifest itself, which holds Python objects for every sample.
+        self.manifest_kwargs = {'image_dirs': image_dirs,
+                                'image_file_extension': image_file_extension,
+                                'ground_truth_dirs': ground_truth_dirs,
+                                'image_name_split_separator': image_name_split_separator,
+                                'ground_truth_suffix': ground_truth_suffix,
+                                'check_existence': check_existence}
+        self.manifest_path = manifest_path
+
+        manifest = DatasetManifest(**self.manifest_kwargs)
+
+        # Reuse the manifest if there is one for this dataset configuration, otherwise scan the dataset directories.
+        if (not manifest_path is None) and manifest.load(manifest_path):
+            if revalidate_manifest:
+                manifest.scan(incremental=True)
+                manifest_changed = True
+            else:
+                manifest_changed = False
+        else:
+            manifest.scan()
+            manifest_changed = True
+
+        if check_existence and len(manifest.missing_ground_truth) > 0:
+            image_path, ground_truth_path = manifest.missing_ground_truth[0]
+            raise DataError("The dataset contains an image file '{}' for which the corresponding ground truth image file does not exist at '{}'.".format(image_path, ground_truth_path))
+
+        if (not manifest_path is None) and manifest_changed:
+            manifest.save(manifest_path)
+
+        self.samples = SampleTable(manifest.samples()) # The images (and ground truth images) from which the generator will draw.
+        self.dataset_size = len(self.samples)
+
+        if self.dataset_size == 0:
+            raise DataError("No images with the given file extension '{}' were found in the given image directories.".format(image_file_extension))
+
+        self.ground_truth = self.samples.ground_truth
+
+    @property
+    def image_paths(self):
+        '''
+        The list of the paths of all images in the order of `samples`.
+        '''
+        return [self.samples.image_path(i) for i in range(self.dataset_size)]
+
+    @property
+    def ground_truth_paths(self):
+        '''
+        The list of the paths of all ground truth images in the order of `samples`, i.e. the
+        `i`-th ground truth image belongs to the `i`-th image in `image_paths`. Empty if no
+        ground truth data was given.
+        '''
+        if not self.ground_truth:
+            return []
+        return [self.samples.ground_truth_path(i) for i in range(self.dataset_size)]
+
+    def shard(self, num_shards, shard_index):
+        '''
+        Returns a copy of this `BatchGenerator` that only draws from every `num_shards`-th sample,
+        starting at the sample `shard_index`, in the order of the sorted image paths. The shards of
+        all `shard_index` values in `[0, num_shards)` are disjoint and together contain every sample,
+        and they don't depend on the order in which the file system lists the files, so independent
+        processes, e.g. the workers of a distributed training, can each take their own shard.
+
+        Arguments:
+            num_shards (int): The number of shards.
+            shard_index (int): The index of the shard to return, in `[0, num_shards)`.
+
+        Returns:
+            A new `BatchGenerator` that shares everything except the samples with this one.
+        '''
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("`shard_index` must be in [0, num_shards), but is {}.".format(shard_index))
+        if num_shards > self.dataset_size:
+            raise ValueError("Can't split {} samples into {} shards.".format(self.dataset_size, num_shards))
+
+        sharded = copy.copy(self)
+        sharded.samples = self.samples.subset(self.samples.sorted_indices()[shard_index::num_shards])
+        sharded.dataset_size = len(sharded.samples)
+
+        return sharded
+
+    def _generate_batch_source(self, batch_size, shuffle, seed, selected_batches, to_disk=False, store_dir=None, sampler=None, bucket_by=None):
+        '''
+        Returns the batches that `generate()` processes, drawn from `samples` in the order that
+        `sampler` or `bucket_by` dictate, and the processing arguments for exporting to disk and
+        reading from the store `store_dir`.
+        '''
+        if not bucket_by is None:
+            if not bucket_by in ['size', 'aspect_ratio']:
+                raise ValueError("`bucket_by` must be `None`, 'size', or 'aspect_ratio', but is '{}'.".format(bucket_by))
+            self._read_image_sizes()
+            if np.any(self.samples.image_sizes < 0):
+                raise DataError("`bucket_by` requires the sizes of all images, but they are only known for PNG images.")
+
+        if not store_dir is None:
+            store = _get_store(store_dir)
+            if self.ground_truth and not store.ground_truth:
+                raise DataError("The store at '{}' doesn't contain any ground truth images.".format(store_dir))
+            for i in range(self.dataset_size):
+                image_path = self.samples.image_path(i)
+                if not image_path in store:
+                    raise DataError("The store at '{}' doesn't contain the image '{}'.".format(store_dir, image_path))
+
+        if not bucket_by is None:
+            batches = self._generate_bucketed_batch_paths(batch_size=batch_size, bucket_by=bucket_by, shuffle=shuffle, seed=seed)
+        elif sampler is None:
+            batches = ((batch_paths, None) for batch_paths in self._generate_batch_paths(batch_size=batch_size, shuffle=shuffle, seed=seed))
+        else:
+            batches = ((batch_paths, None) for batch_paths in self._generate_sampled_batch_paths(sampler=sampler, batch_size=batch_size, seed=seed, selected_batches=selected_batches))
+
+        source_kwargs = {'root_dir': self.root_dir,
+                         'export_dir': self.export_dir,
+                         'store_dir': store_dir}
+
+        return batches, source_kwargs
+
+    def _read_image_sizes(self):
+        '''
+        Reads the sizes of the images whose sizes are unknown and, if there is a manifest,
+        records them in it, so that they are only read once.
+        '''
+        image_sizes = self.samples.read_image_sizes()
+
+        if (len(image_sizes) > 0) and (not self.manifest_path is None):
+            manifest = DatasetManifest(**self.manifest_kwargs)
+            if manifest.load(self.manifest_path):
+                manifest.set_image_sizes(image_sizes)
+                manifest.save(self.manifest_path)
+
+    def _generate_batch_paths(self, batch_size, shuffle, seed=None):
+        '''
+        Generates the paths of the samples that make up each batch indefinitely.
+
+        Yields:
+            A list of tuples `(image_path, gt_image_path, random_seed)`, one for each sample in the batch.
+            `gt_image_path` is `None` if no ground truth data was given. `random_seed` is `None` if `seed`
+            is `None`, otherwise it is the seed for the random number generator of the sample.
+        '''
+        # Shuffling only permutes the sample indices, the sample table itself is never reordered.
+        if seed is None:
+            sample_indices = np.arange(self.dataset_size)
+        else:
+            # Don't depend on the order in which the file system listed the images.
+            sample_indices = self.samples.sorted_indices()
+
+        epoch = 0
+
         if shuffle:
-            random.shuffle(self.image_paths)
+            if seed is None: np.random.shuffle(sample_indices)
+            else: np.random.RandomState([seed, epoch]).shuffle(sample_indices)
 
         current = 0
 
         while True:
 
-            # Store the new batch here
-            images = []
-            gt_images = []
-
             # Shuffle data after each complete pass
-            if current >= len(self.image_paths):
-                if shuffle: random.shuffle(self.image_paths)
+            if current >= self.dataset_size:
+                epoch += 1
+                if shuffle:
+                    if seed is None: np.random.shuffle(sample_indices)
+                    else: np.random.RandomState([seed, epoch]).shuffle(sample_indices)
                 current = 0
 
-            # Load the images and ground truth images for this batch
-            for image_path in self.image_paths[current:current+batch_size]: # Careful: This works in Python, but might cause an 'index out of bounds' error in other languages if `current+batch_size > len(image_paths)`
-
-                # Load the image
-                image = scipy.misc.imread(image_path)
-                img_height, img_width, img_ch = image.shape
-
-                # If at least one ground truth directory was given, load the ground truth images.
-                if self.ground_truth:
-
-                    gt_image_path = self.ground_truth_paths[os.path.basename(image_path)]
-                    gt_image = scipy.misc.imread(gt_image_path)
-                    gt_dtype = gt_image.dtype
-
-                    if not convert_colors_to_ids is False:
-                        gt_image = convert_between_IDs_and_colors(gt_image, convert_colors_to_ids, gt_dtype=gt_dtype)
-
-                    if not convert_ids_to_ids is False:
-                        if isinstance(convert_ids_to_ids, np.ndarray):
-                            gt_image = convert_IDs_to_IDs(gt_image, convert_ids_to_ids)
-                        if isinstance(convert_ids_to_ids, dict):
-                            gt_image = convert_IDs_to_IDs_partial(gt_image, convert_ids_to_ids)
-
-                # Maybe process the images and ground truth images.
-
-                if random_crop:
-                    # Compute how much room we have in both dimensions to make a random crop.
-                    # A negative number here means that we want to crop out a patch that is larger than the original image in the respective dimension,
-                    # in which case we will create a black background canvas onto which we will randomly place the image.
-                    y_range = img_height - random_crop[0]
-                    x_range = img_width - random_crop[1]
-
-                    # Select a random crop position from the possible crop positions
-                    if y_range >= 0: crop_ymin = np.random.randint(0, y_range + 1) # There are y_range + 1 possible positions for the crop in the vertical dimension
-                    else: crop_ymin = np.random.randint(0, -y_range + 1) # The possible positions for the image on the background canvas in the vertical dimension
-                    if x_range >= 0: crop_xmin = np.random.randint(0, x_range + 1) # There are x_range + 1 possible positions for the crop in the horizontal dimension
-                    else: crop_xmin = np.random.randint(0, -x_range + 1) # The possible positions for the image on the background canvas in the horizontal dimension
-                    # Perform the crop
-                    if y_range >= 0 and x_range >= 0: # If the patch to be cropped out is smaller than the original image in both dimenstions, we just perform a regular crop
-                        # Crop the image
-                        image = np.copy(image[crop_ymin:crop_ymin+random_crop[0], crop_xmin:crop_xmin+random_crop[1]])
-                        # Do the same for the ground truth image.
-                        if self.ground_truth: gt_image = np.copy(gt_image[crop_ymin:crop_ymin+random_crop[0], crop_xmin:crop_xmin+random_crop[1]])
-                    elif y_range >= 0 and x_range < 0: # If the crop is larger than the original image in the horizontal dimension only,...
-                        # Crop the image
-                        patch_image = np.copy(image[crop_ymin:crop_ymin+random_crop[0]]) # ...crop the vertical dimension just as before,...
-                        canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
-                        canvas[:, crop_xmin:crop_xmin+img_width] = patch_image # ...and place the patch onto the canvas at the random `crop_xmin` position computed above.
-                        image = canvas
-                        # Do the same for the ground truth image.
-                        if self.ground_truth:
-                            patch_gt_image = np.copy(gt_image[crop_ymin:crop_ymin+random_crop[0]]) # ...crop the vertical dimension just as before,...
-                            canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
-                            canvas[:, crop_xmin:crop_xmin+img_width] = patch_gt_image # ...and place the patch onto the canvas at the random `crop_xmin` position computed above.
-                            gt_image = canvas
-                    elif y_range < 0 and x_range >= 0: # If the crop is larger than the original image in the vertical dimension only,...
-                        # Crop the image
-                        patch_image = np.copy(image[:,crop_xmin:crop_xmin+random_crop[1]]) # ...crop the horizontal dimension just as in the first case,...
-                        canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
-                        canvas[crop_ymin:crop_ymin+img_height, :] = patch_image # ...and place the patch onto the canvas at the random `crop_ymin` position computed above.
-                        image = canvas
-                        # Do the same for the ground truth image.
-                        if self.ground_truth:
-                            patch_gt_image = np.copy(gt_image[:,crop_xmin:crop_xmin+random_crop[1]]) # ...crop the horizontal dimension just as in the first case,...
-                            canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
-                            canvas[crop_ymin:crop_ymin+img_height, :] = patch_gt_image # ...and place the patch onto the canvas at the random `crop_ymin` position computed above.
-                            gt_image = canvas
-                    else:  # If the crop is larger than the original image in both dimensions,...
-                        patch_image = np.copy(image)
-                        canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
-                        canvas[crop_ymin:crop_ymin+img_height, crop_xmin:crop_xmin+img_width] = patch_image # ...and place the patch onto the canvas at the random `(crop_ymin, crop_xmin)` position computed above.
-                        image = canvas
-                        # Do the same for the ground truth image.
-                        if self.ground_truth:
-                            patch_gt_image = np.copy(gt_image)
-                            canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
-                            canvas[crop_ymin:crop_ymin+img_height, crop_xmin:crop_xmin+img_width] = patch_gt_image # ...and place the patch onto the canvas at the random `(crop_ymin, crop_xmin)` position computed above.
-                            gt_image = canvas
-                    # Update the height and width values.
-                    img_height, img_width = random_crop
-
-                if crop:
-                    image = np.copy(image[crop[0]:img_height-crop[1], crop[2]:img_width-crop[3]])
-                    gt_image = np.copy(gt_image[crop[0]:img_height-crop[1], crop[2]:img_width-crop[3]])
-
-                if resize:
-                    image = cv2.resize(image, dsize=(resize[1], resize[0]), interpolation=cv2.INTER_LINEAR)
-                    if self.ground_truth: gt_image = cv2.resize(gt_image, dsize=(resize[1], resize[0]), interpolation=cv2.INTER_NEAREST)
-                    img_height, img_width = resize # Updating these at this point is unnecessary, but it's one fewer source of error if this method gets expanded in the future
-
-                if brightness:
-                    p = np.random.uniform(0,1)
-                    if p >= (1-brightness[2]):
-                        image = _brightness(image, min=brightness[0], max=brightness[1])
-
-                if flip:
-                    p = np.random.uniform(0,1)
-                    if p >= (1-flip):
-                        image = cv2.flip(image, 1) # Horizontal flip
-                        if self.ground_truth: gt_image = cv2.flip(gt_image, 1) # Horizontal flip
-
-                if translate:
-                    p = np.random.uniform(0,1)
-                    if p >= (1-translate[2]):
-                        # Randomly select horizontal and vertical shift values.
-                        x = np.random.randint(translate[0][0], translate[0][1]+1)
-                        y = np.random.randint(translate[1][0], translate[1][1]+1)
-                        x_shift = random.choice([-x, x])
-                        y_shift = random.choice([-y, y])
-                        # Compute the warping matrix for the selected values.
-                        translation_matrix = np.float32([[1,0,x_shift],[0,1,y_shift]])
-                        # Warp the image and maybe the ground truth image.
-                        image = cv2.warpAffine(src=image, M=translation_matrix, dsize=(img_width, img_height))
-                        if self.ground_truth: gt_image = cv2.warpAffine(src=gt_image, M=translation_matrix, dsize=(img_width, img_height), borderValue=void_class_id)
-
-                if scale:
-                    p = np.random.uniform(0,1)
-                    if p >= (1-scale[2]):
-                        scaling_factor = np.random.uniform(scale[0], scale[1])
-                        scaled_height = int(img_height * scaling_factor)
-                        scaled_width = int(img_width * scaling_factor)
-                        y_offset = abs(int((img_height - scaled_height) / 2))
-                        x_offset = abs(int((img_width - scaled_width) / 2))
-
-                        # Scale the image.
-                        patch_image = cv2.resize(image, dsize=(scaled_width, scaled_height), interpolation=cv2.INTER_LINEAR)
-                        if scaling_factor <= 1:
-                            canvas = np.zeros(shape=(img_height, img_width, img_ch), dtype=np.uint8)
-                            canvas[y_offset:y_offset+scaled_height, x_offset:x_offset+scaled_width] = patch_image
-                            image = canvas
-                        if scaling_factor > 1:
-                            image = np.copy(patch_image[y_offset:img_height+y_offset, x_offset:img_width+x_offset])
-
-                        # Scale the ground truth image.
-                        if self.ground_truth:
-                            patch_gt_image = cv2.resize(gt_image, dsize=(scaled_width, scaled_height), interpolation=cv2.INTER_NEAREST)
-                            if scaling_factor <= 1:
-                                canvas = np.full(shape=(img_height, img_width), fill_value=void_class_id, dtype=gt_dtype)
-                                canvas[y_offset:y_offset+scaled_height, x_offset:x_offset+scaled_width] = patch_gt_image
-                                gt_image = canvas
-                            if scaling_factor > 1:
-                                gt_image = np.copy(patch_gt_image[y_offset:img_height+y_offset, x_offset:img_width+x_offset])
-
-                if gray:
-                    image = np.expand_dims(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), axis=2)
-
-                # Maybe convert ground truth IDs to one-hot.
-                if convert_to_one_hot:
-                    gt_image = convert_IDs_to_one_hot(gt_image, self.num_classes)
-
-                if to_disk: # If the processed data is to be written to disk instead of yieled.
-                    # Create the directory (including parents) if it doesn't already exist.
-                    image_save_file_path = os.path.join(self.export_dir, os.path.relpath(image_path, start=self.root_dir))
-                    image_save_directory_path = os.path.dirname(image_save_file_path)
-                    pathlib.Path(image_save_directory_path).mkdir(parents=True, exist_ok=True)
-                    # Save the image.
-                    scipy.misc.imsave(image_save_file_path, image)
-                    if self.ground_truth:
-                        # Create the directory (including parents) if it doesn't already exist.
-                        gt_image_save_file_path = os.path.join(self.export_dir, os.path.relpath(gt_image_path, start=self.root_dir))
-                        gt_image_save_directory_path = os.path.dirname(gt_image_save_file_path)
-                        pathlib.Path(gt_image_save_directory_path).mkdir(parents=True, exist_ok=True)
-                        # Save the ground truth image.
-                        scipy.misc.imsave(gt_image_save_file_path, gt_image)
+            batch_paths = []
 
-                # Append the processed image (and maybe ground truth image) to this batch.
-                images.append(image)
-                if self.ground_truth: gt_images.append(gt_image)
+            for i, sample_index in enumerate(sample_indices[current:current+batch_size], current): # Careful: This works in Python, but might cause an 'index out of bounds' error in other languages if `current+batch_size > self.dataset_size`
+                random_seed = None if seed is None else [seed, epoch, i]
+                batch_paths.append((self.samples.image_path(sample_index), self.samples.ground_truth_path(sample_index), random_seed))
 
             current += batch_size
 
-            if self.ground_truth:
-                yield np.array(images), np.array(gt_images)
+            yield batch_paths
+
+    def _generate_bucketed_batch_paths(self, batch_size, bucket_by, shuffle, seed=None):
+        '''
+        Like `_generate_batch_paths()`, but each batch consists of samples of the same bucket, see `generate()`.
+
+        Yields:
+            A tuple `(batch_paths, batch_kwargs)`, where `batch_paths` is a list of tuples `(image_path, gt_image_path, random_seed)`
+            and `batch_kwargs` is `None` or a dictionary of processing arguments that apply to this batch only.
+        '''
+        image_sizes = self.samples.image_sizes
+
+        if bucket_by == 'size':
+            keys = image_sizes
+        else:
+            # Bins of width 1/8 on a log2 scale, i.e. aspect ratios within about 9% of each other share a bin.
+            keys = np.round(np.log2(image_sizes[:,1] / image_sizes[:,0]) * 8).astype(np.int32)
+
+        if seed is None:
+            sample_indices = np.arange(self.dataset_size)
+        else:
+            # Don't depend on the order in which the file system listed the images.
+            sample_indices = self.samples.sorted_indices()
+
+        # Group the sample indices by bucket.
+        _, bucket_ids = np.unique(keys[sample_indices], axis=0, return_inverse=True)
+        bucket_ids = bucket_ids.reshape(-1)
+        buckets = [sample_indices[bucket_ids == bucket_id] for bucket_id in range(bucket_ids.max() + 1)]
+
+        bucket_kwargs = []
+        for bucket in buckets:
+            if bucket_by == 'size':
+                bucket_kwargs.append(None)
             else:
-                yield np.array(images)
+                # Resize all images of the bucket to its most common size.
+                sizes, counts = np.unique(image_sizes[bucket], axis=0, return_counts=True)
+                if len(sizes) == 1:
+                    bucket_kwargs.append(None)
+                else:
+                    bucket_kwargs.append({'resize': tuple(int(x) for x in sizes[np.argmax(counts)])})
+
+        for epoch in itertools.count():
+
+            if seed is None: rng = np.random
+            else: rng = np.random.RandomState([seed, epoch])
+
+            # Split each (shuffled) bucket into batches.
+            epoch_batches = []
+            for bucket_id, bucket in enumerate(buckets):
+                if shuffle:
+                    bucket = rng.permutation(bucket)
+                for start in range(0, len(bucket), batch_size):
+                    epoch_batches.append((bucket_id, bucket[start:start+batch_size]))
+
+            if shuffle:
+                epoch_batches = [epoch_batches[i] for i in rng.permutation(len(epoch_batches))]
+
+            for batch_index, (bucket_id, batch_indices) in enumerate(epoch_batches):
+
+                batch_paths = []
+
+                for i, sample_index in enumerate(batch_indices):
+                    random_seed = None if seed is None else [seed, epoch, batch_index, i]
+                    batch_paths.append((self.samples.image_path(sample_index), self.samples.ground_truth_path(sample_index), random_seed))
+
+                yield batch_paths, bucket_kwargs[bucket_id]
+
+    def _generate_sampled_batch_paths(self, sampler, batch_size, seed=None, selected_batches=None):
+        '''
+        Like `_generate_batch_paths()`, but the samples of each batch are selected by `sampler`.
+        The sample indices of each batch are appended to `selected_batches` if it isn't `None`.
+
+        Yields:
+            A list of tuples `(image_path, gt_image_path, random_seed, crop_class)`, one for each sample in the batch.
+            `crop_class` is `None` or the class on which to center the random crop of the sample.
+        '''
+        rng = np.random.RandomState(seed)
+
+        for batch_index in itertools.count():
+
+            sample_indices, crop_classes = sampler.sample(batch_size, rng)
+            if not selected_batches is None: selected_batches.append(sample_indices)
+
+            batch_paths = []
+
+            for i, sample_index in enumerate(sample_indices):
+                random_seed = None if seed is None else [seed, batch_index, i]
+                crop_class = None if crop_classes is None else int(crop_classes[i])
+                batch_paths.append((self.samples.image_path(sample_index), self.samples.ground_truth_path(sample_index), random_seed, crop_class))
+
+            yield batch_paths
+
+    def pack(self,
+             store_dir,
+             shard_size=256,
+             resize=False,
+             num_workers=0):
+        '''
+        Decodes the entire dataset once and writes the decoded images (and ground truth images)
+        into a store of memory-mapped shards that `generate()` can read from via its `store_dir`
+        argument. This moves the PNG decoding cost out of the training loop: Reading a sample from
+        the store costs only memory bandwidth.
+
+        All images (and all ground truth images) must have the same shape, since each shard is one
+        fixed-shape array. The ground truth images are stored as they are, i.e. any ID conversions
+        are still performed by `generate()`.
+
+        Arguments:
+            store_dir (string): The directory into which to write the store. Will be created if it
+                doesn't exist.
+            shard_size (int, optional): The number of samples per shard. Defaults to 256.
+            resize (tuple, optional): `False` or a tuple of 2 integers `(height, width)` to which all images
+                (and ground truth images) will be resized before being stored. Can be used to make
+                datasets with varying image sizes packable. Defaults to `False`.
+            num_workers (int, optional): The number of worker processes among which the decoding is
+                distributed. If `0`, the dataset is decoded in the calling process. Defaults to 0.
+        '''
+        pathlib.Path(store_dir).mkdir(parents=True, exist_ok=True)
+
+        # Process the samples in the order of `self.samples`, which is the order of the store.
+        samples_paths = [(self.samples.image_path(i), self.samples.ground_truth_path(i)) for i in range(self.dataset_size)]
+
+        processing_kwargs = {'convert_to_one_hot': False, 'resize': resize}
+
+        if num_workers > 0:
+            pool = multiprocessing.Pool(processes=num_workers)
+            samples = pool.imap(_process_sample_star, [(sample_paths, processing_kwargs) for sample_paths in samples_paths])
+        else:
+            pool = None
+            samples = (_process_sample(*sample_paths, **processing_kwargs) for sample_paths in samples_paths)
+
+        image_shape = None
+        gt_shape = None
+        image_shard = None
+        gt_shard = None
+
+        tr = trange(self.dataset_size, file=sys.stdout)
+        tr.set_description('Packing images')
+
+        try:
+            for i in tr:
+
+                image, gt_image = next(samples)
+
+                if i == 0:
+                    image_shape = image.shape
+                    if self.ground_truth: gt_shape = gt_image.shape
+                elif image.shape != image_shape or (self.ground_truth and gt_image.shape != gt_shape):
+                    raise DataError("All images must have the same shape to be packed, but '{}' has a different shape than the first image. Use `resize` to make them equal.".format(samples_paths[i][0]))
+
+                shard, row = divmod(i, shard_size)
+
+                # Start a new shard.
+                if row == 0:
+                    num_shard_samples = min(shard_size, self.dataset_size - i)
+                    image_shard = np.lib.format.open_memmap(os.path.join(store_dir, IMAGES_SHARD_NAME.format(shard)),
+                                                            mode='w+', dtype=image.dtype, shape=(num_shard_samples,) + image_shape)
+                    if self.ground_truth:
+                        gt_shard = np.lib.format.open_memmap(os.path.join(store_dir, GROUND_TRUTH_SHARD_NAME.format(shard)),
+                                                             mode='w+', dtype=gt_image.dtype, shape=(num_shard_samples,) + gt_shape)
+
+                image_shard[row] = image
+                if self.ground_truth: gt_shard[row] = gt_image
+
+                # Finish the current shard.
+                if row == num_shard_samples - 1:
+                    image_shard.flush()
+                    if self.ground_truth: gt_shard.flush()
+        finally:
+            if not pool is None:
+                pool.terminate()
+
+        # Write the index last so that an interrupted run doesn't leave a valid-looking store behind.
+        index = {'shard_size': shard_size,
+                 'num_samples': self.dataset_size,
+                 'image_shape': list(image_shape),
+                 'gt_shape': None if gt_shape is None else list(gt_shape),
+                 'image_paths': [os.path.abspath(sample_paths[0]) for sample_paths in samples_paths]}
+
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), 'w') as f:
+            json.dump(index, f)
 
     def process_all(self,
                     convert_colors_to_ids=False,
@@ -431,52 +855,764 @@ class BatchGenerator():
                     gray=False,
                     to_disk=True,
                     shuffle=False,
-                    batch_size=1):
+                    batch_size=1,
+                    num_workers=0,
+                    skip_up_to_date=False,
+                    png_compression=None,
+                    seed=None):
         '''
-        Processes the entire dataset in batches of `batch_size` and saves the
-        results to `export_dir` (see constructor).
+        Processes the entire dataset and saves the results to `export_dir` (see constructor).
 
-        This is basically just a wrapper around the `generate()` method that
-        iterates over the entire dataset (or datasets, in case multiple were
-        passed in the constructor).
+        The samples are processed independently of each other, so the work can be distributed
+        among `num_workers` worker processes. Each sample is written to disk by the worker that
+        processed it, only the progress is reported back to the calling process.
 
-        For documentation of the arguments, see `generate()`. Returns void.
-        '''
+        For documentation of the processing arguments, see `generate()`.
 
-        preprocessor = self.generate(batch_size=batch_size,
-                                convert_colors_to_ids=convert_colors_to_ids,
-                                convert_ids_to_ids=convert_ids_to_ids,
-                                convert_to_one_hot=convert_to_one_hot,
-                                void_class_id=void_class_id,
-                                random_crop=random_crop,
-                                crop=crop,
-                                resize=resize,
-                                brightness=brightness,
-                                flip=flip,
-                                translate=translate,
-                                scale=scale,
-                                gray=gray,
-                                to_disk=to_disk,
-                                shuffle=shuffle)
+        Arguments:
+            shuffle (bool, optional): If `True`, the samples are processed in random order.
+                Has no effect on the results if `seed` is set.
+            batch_size (int, optional): The number of samples that are handed to a worker
+                process at a time. Has no effect on the results.
+            num_workers (int, optional): The number of worker processes among which the processing
+                is distributed. If `0`, all samples are processed in the calling process. Defaults to 0.
+            skip_up_to_date (bool, optional): If `True`, samples whose output files already exist and
+                are newer than their source files are skipped, so that an interrupted run can be resumed.
+                Note that this only compares modification times, i.e. outputs that were produced with
+                different processing arguments are not detected. Defaults to `False`.
+            png_compression (int, optional): `None` or an integer in [0, 9], the zlib compression level
+                with which the outputs are written. Lower levels write faster but produce larger files.
+                If `None`, the codec's default level is used. Defaults to `None`.
+            seed (int, optional): `None` or an integer seed for the random augmentations. If given, each
+                sample gets its own random number generator that is seeded with the seed and the sample's
+                position in the dataset, so the results are the same no matter how many worker processes
+                are used. The samples get the same random numbers as in the first pass of
+                `generate(seed=seed, shuffle=False)`. Defaults to `None`.
+
+        Returns:
+            None.
+        '''
+        if not png_compression is None and not png_compression in range(10):
+            raise ValueError("`png_compression` must be `None` or an integer in [0, 9].")
+
+        processing_kwargs = {'convert_colors_to_ids': convert_colors_to_ids,
+                             'convert_ids_to_ids': convert_ids_to_ids,
+                             'convert_to_one_hot': convert_to_one_hot,
+                             'num_classes': self.num_classes,
+                             'void_class_id': void_class_id,
+                             'random_crop': random_crop,
+                             'crop': crop,
+                             'resize': resize,
+                             'brightness': brightness,
+                             'flip': flip,
+                             'translate': translate,
+                             'scale': scale,
+                             'gray': gray,
+                             'to_disk': to_disk,
+                             'root_dir': self.root_dir,
+                             'export_dir': self.export_dir,
+                             'png_compression': png_compression}
+
+        # One pass over the whole dataset in its canonical order, which also assigns each sample its seed.
+        samples_paths = next(self._generate_batch_paths(batch_size=self.dataset_size, shuffle=False, seed=seed))
+
+        if skip_up_to_date:
+            samples_paths = [sample_paths for sample_paths in samples_paths
+                             if not all(_is_up_to_date(path, _export_path(path, self.root_dir, self.export_dir))
+                                        for path in sample_paths[:2] if not path is None)]
 
-        num_batches = ceil(self.dataset_size/batch_size)
+        if shuffle:
+            random.shuffle(samples_paths)
 
-        tr = trange(num_batches, file=sys.stdout)
+        tr = trange(len(samples_paths), file=sys.stdout)
         tr.set_description('Processing images')
 
-        for batch in tr:
-                next(preprocessor)
+        if num_workers > 0:
+            pool = multiprocessing.Pool(processes=num_workers, initializer=_init_export_worker)
+            try:
+                # The order in which the samples finish doesn't matter, they are only written to disk.
+                results = pool.imap_unordered(_export_sample_star,
+                                              [(sample_paths, processing_kwargs) for sample_paths in samples_paths],
+                                              chunksize=batch_size)
+                for _ in results:
+                    tr.update()
+            finally:
+                pool.terminate()
+        else:
+            for sample_paths in samples_paths:
+                _process_sample(*sample_paths, **processing_kwargs)
+                tr.update()
+
+        tr.close()
+
+
+def _generate_scaled_batches(batches, scales, size, size_key, size_multiple=32, seed=None):
+    '''
+    Draws a scale for each batch of `batches` and overrides the processing argument `size_key`
+    of the batch with `size` multiplied by that scale and rounded to a multiple of `size_multiple`.
+
+    Yields:
+        The tuples `(batch_paths, batch_kwargs)` of `batches` with the updated `batch_kwargs`.
+    '''
+    if seed is None: rng = np.random
+    else: rng = np.random.RandomState(seed)
+
+    # The possible output sizes, computed once.
+    scaled_sizes = [tuple(max(size_multiple, int(round(x * scale / size_multiple)) * size_multiple) for x in size) for scale in scales]
 
+    for batch_paths, batch_kwargs in batches:
+        overrides = {size_key: scaled_sizes[rng.randint(0, len(scaled_sizes))]}
+        if not batch_kwargs is None:
+            overrides = dict(batch_kwargs, **overrides)
+        yield batch_paths, overrides
 
-def _brightness(image, min=0.5, max=2.0):
+def _read_ahead(batches, num_samples, max_bytes, num_threads=8):
+    '''
+    Reads the files of the upcoming batches of `batches` in a pool of threads.
+
+    Keeps reading whole batches ahead as long as fewer than `num_samples` samples and fewer than
+    `max_bytes` bytes are pending. The sizes of the files that are still being read are estimated
+    from the average size of the files read so far.
+
+    Yields:
+        The tuples `(batch_paths, batch_kwargs)` of `batches`, but with the image and ground truth
+        image paths in `batch_paths` replaced by the contents of the files as `bytes`.
+    '''
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+    pending_batches = deque() # Tuples `(batch_paths, batch_kwargs, futures)` of the batches being read.
+    num_pending_samples = 0
+    num_files_read = 0
+    num_bytes_read = 0
+
+    def pending_bytes():
+        average_size = num_bytes_read / num_files_read if num_files_read > 0 else 0
+        total = 0
+        for _, _, futures in pending_batches:
+            for future in futures:
+                if future.done():
+                    total += sum(len(data) for data in future.result() if not data is None)
+                else:
+                    total += 2 * average_size
+        return total
+
+    try:
+        while True:
+            # Read ahead until either limit is reached, but always at least one batch.
+            while len(pending_batches) == 0 or (num_pending_samples < num_samples and pending_bytes() < max_bytes):
+                try:
+                    batch_paths, batch_kwargs = next(batches)
+                except StopIteration:
+                    break
+                futures = [executor.submit(_read_files, sample_paths[:2]) for sample_paths in batch_paths]
+                pending_batches.append((batch_paths, batch_kwargs, futures))
+                num_pending_samples += len(batch_paths)
+
+            if len(pending_batches) == 0:
+                return
+
+            batch_paths, batch_kwargs, futures = pending_batches.popleft()
+            num_pending_samples -= len(batch_paths)
+
+            batch_data = []
+            for sample_paths, future in zip(batch_paths, futures):
+                sample_data = future.result()
+                num_files_read += sum(1 for data in sample_data if not data is None)
+                num_bytes_read += sum(len(data) for data in sample_data if not data is None)
+                batch_data.append(sample_data + tuple(sample_paths[2:]))
+
+            yield batch_data, batch_kwargs
+    finally:
+        for _, _, futures in pending_batches:
+            for future in futures:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+def _read_files(paths):
+    '''
+    Returns a tuple with the contents of the files `paths` as `bytes`. Elements of `paths` that are
+    `None` or that are already `bytes` are returned as they are.
+    '''
+    contents = []
+    for path in paths:
+        if path is None or isinstance(path, (bytes, bytearray, memoryview)):
+            contents.append(path)
+        else:
+            with open(path, 'rb') as f:
+                contents.append(f.read())
+    return tuple(contents)
+
+def _process_sample(image_path,
+                    gt_image_path,
+                    random_seed=None,
+                    crop_class=None,
+                    convert_colors_to_ids=False,
+                    convert_ids_to_ids=False,
+                    convert_to_one_hot=True,
+                    num_classes=None,
+                    void_class_id=None,
+                    random_crop=False,
+                    crop=False,
+                    resize=False,
+                    brightness=False,
+                    flip=False,
+                    translate=False,
+                    scale=False,
+                    gray=False,
+                    to_disk=False,
+                    root_dir=None,
+                    export_dir=None,
+                    store_dir=None,
+                    fused_geometry=False,
+                    png_compression=None):
+    '''
+    Loads and processes a single image (and maybe ground truth image).
+
+    This is a module-level function so that it can be sent to the worker processes
+    of `BatchGenerator.generate()`. For documentation of the arguments, see `generate()`.
+    If `random_seed` is `None`, the global random number generator is used for the
+    augmentations, otherwise a random number generator seeded with `random_seed`.
+    If `crop_class` is given, the random crop is centered on a random pixel of that class.
+    Instead of paths, `image_path` and `gt_image_path` may also be the encoded image files as `bytes`.
+
+    Returns:
+        A tuple `(image, gt_image)`, where `gt_image` is `None` if `gt_image_path` is `None`.
+    '''
+    ground_truth = not gt_image_path is None
+    gt_image = None
+
+    if random_seed is None:
+        rng = np.random
+    else:
+        rng = np.random.RandomState(random_seed)
+
+    # Load the image and, if a ground truth image path was given, the ground truth image.
+    if store_dir is None:
+        image = imread(image_path)
+        if ground_truth: gt_image = imread(gt_image_path)
+    else:
+        image, gt_image = _get_store(store_dir).load(image_path)
+        if not ground_truth: gt_image = None
+
+    img_height, img_width, img_ch = image.shape
+
+    if ground_truth:
+
+        gt_dtype = gt_image.dtype
+
+        if not convert_colors_to_ids is False:
+            gt_image = convert_between_IDs_and_colors(gt_image, convert_colors_to_ids, gt_dtype=gt_dtype)
+
+        if not convert_ids_to_ids is False:
+            if isinstance(convert_ids_to_ids, np.ndarray):
+                gt_image = convert_IDs_to_IDs(gt_image, convert_ids_to_ids)
+            if isinstance(convert_ids_to_ids, dict):
+                gt_image = convert_IDs_to_IDs_partial(gt_image, convert_ids_to_ids)
+
+    # Maybe process the images and ground truth images.
+
+    if fused_geometry:
+        image, gt_image = _fused_geometry(image,
+                                          gt_image,
+                                          rng=rng,
+                                          crop_class=crop_class,
+                                          void_class_id=void_class_id,
+                                          random_crop=random_crop,
+                                          crop=crop,
+                                          resize=resize,
+                                          brightness=brightness,
+                                          flip=flip,
+                                          translate=translate,
+                                          scale=scale)
+        img_height, img_width = image.shape[:2]
+        # All of these have been applied already.
+        random_crop = crop = resize = brightness = flip = translate = scale = False
+
+    if random_crop:
+        # Compute how much room we have in both dimensions to make a random crop.
+        # A negative number here means that we want to crop out a patch that is larger than the original image in the respective dimension,
+        # in which case we will create a black background canvas onto which we will randomly place the image.
+        y_range = img_height - random_crop[0]
+        x_range = img_width - random_crop[1]
+
+        # Select a random crop position from the possible crop positions
+        crop_ymin, crop_xmin = _random_crop_position(img_height, img_width, random_crop, rng, gt_image, crop_class)
+        # Perform the crop
+        if y_range >= 0 and x_range >= 0: # If the patch to be cropped out is smaller than the original image in both dimenstions, we just perform a regular crop
+            # Crop the image
+            image = np.copy(image[crop_ymin:crop_ymin+random_crop[0], crop_xmin:crop_xmin+random_crop[1]])
+            # Do the same for the ground truth image.
+            if ground_truth: gt_image = np.copy(gt_image[crop_ymin:crop_ymin+random_crop[0], crop_xmin:crop_xmin+random_crop[1]])
+        elif y_range >= 0 and x_range < 0: # If the crop is larger than the original image in the horizontal dimension only,...
+            # Crop the image
+            patch_image = np.copy(image[crop_ymin:crop_ymin+random_crop[0]]) # ...crop the vertical dimension just as before,...
+            canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
+            canvas[:, crop_xmin:crop_xmin+img_width] = patch_image # ...and place the patch onto the canvas at the random `crop_xmin` position computed above.
+            image = canvas
+            # Do the same for the ground truth image.
+            if ground_truth:
+                patch_gt_image = np.copy(gt_image[crop_ymin:crop_ymin+random_crop[0]]) # ...crop the vertical dimension just as before,...
+                canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
+                canvas[:, crop_xmin:crop_xmin+img_width] = patch_gt_image # ...and place the patch onto the canvas at the random `crop_xmin` position computed above.
+                gt_image = canvas
+        elif y_range < 0 and x_range >= 0: # If the crop is larger than the original image in the vertical dimension only,...
+            # Crop the image
+            patch_image = np.copy(image[:,crop_xmin:crop_xmin+random_crop[1]]) # ...crop the horizontal dimension just as in the first case,...
+            canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
+            canvas[crop_ymin:crop_ymin+img_height, :] = patch_image # ...and place the patch onto the canvas at the random `crop_ymin` position computed above.
+            image = canvas
+            # Do the same for the ground truth image.
+            if ground_truth:
+                patch_gt_image = np.copy(gt_image[:,crop_xmin:crop_xmin+random_crop[1]]) # ...crop the horizontal dimension just as in the first case,...
+                canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
+                canvas[crop_ymin:crop_ymin+img_height, :] = patch_gt_image # ...and place the patch onto the canvas at the random `crop_ymin` position computed above.
+                gt_image = canvas
+        else:  # If the crop is larger than the original image in both dimensions,...
+            patch_image = np.copy(image)
+            canvas = np.zeros(shape=(random_crop[0], random_crop[1], patch_image.shape[2]), dtype=np.uint8) # ...generate a blank background image to place the patch onto,...
+            canvas[crop_ymin:crop_ymin+img_height, crop_xmin:crop_xmin+img_width] = patch_image # ...and place the patch onto the canvas at the random `(crop_ymin, crop_xmin)` position computed above.
+            image = canvas
+            # Do the same for the ground truth image.
+            if ground_truth:
+                patch_gt_image = np.copy(gt_image)
+                canvas = np.full(shape=random_crop, fill_value=void_class_id, dtype=gt_dtype) # ...generate a blank background image to place the patch onto,...
+                canvas[crop_ymin:crop_ymin+img_height, crop_xmin:crop_xmin+img_width] = patch_gt_image # ...and place the patch onto the canvas at the random `(crop_ymin, crop_xmin)` position computed above.
+                gt_image = canvas
+        # Update the height and width values.
+        img_height, img_width = random_crop
+
+    if crop:
+        image = np.copy(image[crop[0]:img_height-crop[1], crop[2]:img_width-crop[3]])
+        if ground_truth: gt_image = np.copy(gt_image[crop[0]:img_height-crop[1], crop[2]:img_width-crop[3]])
+        img_height, img_width = image.shape[:2]
+
+    if resize:
+        image = cv2.resize(image, dsize=(resize[1], resize[0]), interpolation=cv2.INTER_LINEAR)
+        if ground_truth: gt_image = cv2.resize(gt_image, dsize=(resize[1], resize[0]), interpolation=cv2.INTER_NEAREST)
+        img_height, img_width = resize # Updating these at this point is unnecessary, but it's one fewer source of error if this method gets expanded in the future
+
+    if brightness:
+        p = rng.uniform(0,1)
+        if p >= (1-brightness[2]):
+            image = _brightness(image, min=brightness[0], max=brightness[1], rng=rng)
+
+    if flip:
+        p = rng.uniform(0,1)
+        if p >= (1-flip):
+            image = cv2.flip(image, 1) # Horizontal flip
+            if ground_truth: gt_image = cv2.flip(gt_image, 1) # Horizontal flip
+
+    if translate:
+        p = rng.uniform(0,1)
+        if p >= (1-translate[2]):
+            # Randomly select horizontal and vertical shift values.
+            x = rng.randint(translate[0][0], translate[0][1]+1)
+            y = rng.randint(translate[1][0], translate[1][1]+1)
+            x_shift = rng.choice([-x, x])
+            y_shift = rng.choice([-y, y])
+            # Compute the warping matrix for the selected values.
+            translation_matrix = np.float32([[1,0,x_shift],[0,1,y_shift]])
+            # Warp the image and maybe the ground truth image.
+            image = cv2.warpAffine(src=image, M=translation_matrix, dsize=(img_width, img_height))
+            if ground_truth: gt_image = cv2.warpAffine(src=gt_image, M=translation_matrix, dsize=(img_width, img_height), borderValue=void_class_id)
+
+    if scale:
+        p = rng.uniform(0,1)
+        if p >= (1-scale[2]):
+            scaling_factor = rng.uniform(scale[0], scale[1])
+            scaled_height = int(img_height * scaling_factor)
+            scaled_width = int(img_width * scaling_factor)
+            y_offset = abs(int((img_height - scaled_height) / 2))
+            x_offset = abs(int((img_width - scaled_width) / 2))
+
+            # Scale the image.
+            patch_image = cv2.resize(image, dsize=(scaled_width, scaled_height), interpolation=cv2.INTER_LINEAR)
+            if scaling_factor <= 1:
+                canvas = np.zeros(shape=(img_height, img_width, img_ch), dtype=np.uint8)
+                canvas[y_offset:y_offset+scaled_height, x_offset:x_offset+scaled_width] = patch_image
+                image = canvas
+            if scaling_factor > 1:
+                image = np.copy(patch_image[y_offset:img_height+y_offset, x_offset:img_width+x_offset])
+
+            # Scale the ground truth image.
+            if ground_truth:
+                patch_gt_image = cv2.resize(gt_image, dsize=(scaled_width, scaled_height), interpolation=cv2.INTER_NEAREST)
+                if scaling_factor <= 1:
+                    canvas = np.full(shape=(img_height, img_width), fill_value=void_class_id, dtype=gt_dtype)
+                    canvas[y_offset:y_offset+scaled_height, x_offset:x_offset+scaled_width] = patch_gt_image
+                    gt_image = canvas
+                if scaling_factor > 1:
+                    gt_image = np.copy(patch_gt_image[y_offset:img_height+y_offset, x_offset:img_width+x_offset])
+
+    if gray:
+        image = np.expand_dims(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), axis=2)
+
+    # Maybe convert ground truth IDs to one-hot.
+    if convert_to_one_hot:
+        gt_image = convert_IDs_to_one_hot(gt_image, num_classes)
+
+    if to_disk: # If the processed data is to be written to disk in addition to being yielded.
+        _save_image(_export_path(image_path, root_dir, export_dir), image, png_compression)
+        if ground_truth:
+            _save_image(_export_path(gt_image_path, root_dir, export_dir), gt_image, png_compression)
+
+    return image, gt_image
+
+class _BatchBuffers():
+
+    def __init__(self, batch_size, reuse=False):
+        '''
+        Provides the batch arrays for `BatchGenerator.generate()`.
+
+        Arguments:
+            batch_size (int): The number of samples per batch.
+            reuse (bool, optional): If `True`, cycles through a ring of two preallocated arrays
+                for each distinct array shape and dtype. Otherwise allocates new arrays every time.
+        '''
+        self.batch_size = batch_size
+        self.reuse = reuse
+        self.rings = {} # The rings of preallocated arrays, keyed by their shape and dtype.
+
+    def get(self, sample_shape, dtype):
+        '''
+        Returns an uninitialized batch array for samples of shape `sample_shape` and dtype `dtype`.
+        '''
+        shape = (self.batch_size,) + tuple(sample_shape)
+
+        if not self.reuse:
+            return np.empty(shape, dtype=dtype)
+
+        key = (shape, np.dtype(dtype))
+        if not key in self.rings:
+            self.rings[key] = deque([np.empty(shape, dtype=dtype) for _ in range(2)])
+        ring = self.rings[key]
+        ring.rotate(1)
+        return ring[0]
+
+    def stack(self, arrays):
+        '''
+        Writes a list of equally shaped arrays into a batch array and returns it. The returned
+        array is a view of the first `len(arrays)` samples of the batch array.
+        '''
+        batch = self.get(arrays[0].shape, arrays[0].dtype)[:len(arrays)]
+        for i, array in enumerate(arrays):
+            batch[i] = array
+        return batch
+
+def _augment_batch(images,
+                   gt_images,
+                   rng=np.random,
+                   convert_to_one_hot=False,
+                   num_classes=None,
+                   void_class_id=None,
+                   brightness=False,
+                   flip=False,
+                   translate=False,
+                   gray=False):
+    '''
+    Applies the `brightness`, `flip`, and `translate` transformations (and maybe the grayscale
+    and one-hot conversions) to a whole batch at once. The batch arrays are modified in place
+    wherever possible. For documentation of the arguments, see `BatchGenerator.generate()`.
+
+    Returns:
+        A tuple `(images, gt_images)` with the transformed batch. `gt_images` may be `None`.
+    '''
+    batch_size, img_height, img_width, img_ch = images.shape
+
+    if brightness:
+        selected = np.nonzero(rng.uniform(0, 1, size=batch_size) >= (1-brightness[2]))[0]
+        if len(selected) > 0:
+            factors = rng.uniform(brightness[0], brightness[1], size=len(selected))
+            # Color conversions operate pixel by pixel, so the whole selection can be converted in one call.
+            hsv = cv2.cvtColor(images[selected].reshape(-1, img_width, img_ch), cv2.COLOR_RGB2HSV).reshape(len(selected), img_height, img_width, img_ch)
+            # Protect against overflow just like `_brightness()`.
+            hsv[...,2] = np.minimum(hsv[...,2] * factors[:, np.newaxis, np.newaxis], 255)
+            images[selected] = cv2.cvtColor(hsv.reshape(-1, img_width, img_ch), cv2.COLOR_HSV2RGB).reshape(len(selected), img_height, img_width, img_ch)
+
+    if flip:
+        selected = np.nonzero(rng.uniform(0, 1, size=batch_size) >= (1-flip))[0]
+        images[selected] = images[selected, :, ::-1]
+        if not gt_images is None: gt_images[selected] = gt_images[selected, :, ::-1]
+
+    if translate:
+        selected = np.nonzero(rng.uniform(0, 1, size=batch_size) >= (1-translate[2]))[0]
+        x_shifts = rng.randint(translate[0][0], translate[0][1]+1, size=len(selected)) * rng.choice([-1, 1], size=len(selected))
+        y_shifts = rng.randint(translate[1][0], translate[1][1]+1, size=len(selected)) * rng.choice([-1, 1], size=len(selected))
+        # Integer translations are just shifted copies, so no resampling is needed. One scratch canvas is reused for all samples.
+        canvas = np.empty(shape=images.shape[1:], dtype=images.dtype)
+        if not gt_images is None: gt_canvas = np.empty(shape=gt_images.shape[1:], dtype=gt_images.dtype)
+        for i, x_shift, y_shift in zip(selected, x_shifts, y_shifts):
+            src_y, dst_y = _shifted_slices(y_shift, img_height)
+            src_x, dst_x = _shifted_slices(x_shift, img_width)
+            canvas.fill(0)
+            canvas[dst_y, dst_x] = images[i, src_y, src_x]
+            images[i] = canvas
+            if not gt_images is None:
+                gt_canvas.fill(0 if void_class_id is None else void_class_id)
+                gt_canvas[dst_y, dst_x] = gt_images[i, src_y, src_x]
+                gt_images[i] = gt_canvas
+
+    if gray:
+        images = cv2.cvtColor(images.reshape(-1, img_width, img_ch), cv2.COLOR_RGB2GRAY).reshape(batch_size, img_height, img_width, 1)
+
+    if convert_to_one_hot:
+        gt_images = convert_IDs_to_one_hot(gt_images, num_classes)
+
+    return images, gt_images
+
+def _shifted_slices(shift, length):
+    '''
+    Returns the source and destination slices along one axis of length `length`
+    for a translation by `shift` pixels.
+    '''
+    if shift >= 0:
+        return slice(0, max(length - shift, 0)), slice(min(shift, length), length)
+    else:
+        return slice(min(-shift, length), length), slice(0, max(length + shift, 0))
+
+def _process_sample_star(args):
+    '''
+    Unpacks `(sample_paths, processing_kwargs)` for `_process_sample()`, for use with `Pool.imap()`.
+    '''
+    sample_paths, processing_kwargs = args
+    return _process_sample(*sample_paths, **processing_kwargs)
+
+def _export_sample_star(args):
+    '''
+    Like `_process_sample_star()`, but doesn't send the processed sample back to the calling
+    process, for use with `BatchGenerator.process_all()`, which only writes the samples to disk.
+    '''
+    _process_sample_star(args)
+
+def _init_export_worker():
+    '''
+    Initializes a worker process of `BatchGenerator.process_all()`.
+    '''
+    _seed_worker()
+    # The parallelism comes from the worker processes, OpenCV's own threads would only compete with them.
+    cv2.setNumThreads(1)
+
+def _export_path(path, root_dir, export_dir):
+    '''
+    Returns the path under `export_dir` to which the processed version of the file `path` is written.
+    '''
+    return os.path.join(export_dir, os.path.relpath(path, start=root_dir))
+
+def _is_up_to_date(source_path, output_path):
+    '''
+    Returns `True` if `output_path` exists and was modified after `source_path`.
+    '''
+    return os.path.isfile(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(source_path)
+
+def _save_image(path, image, png_compression=None):
+    '''
+    Saves `image` to `path`, creating the directory (including parents) if it doesn't already exist.
+
+    The image is first written to a temporary file that then replaces `path`, so that an interrupted
+    run never leaves a truncated file behind that would look up to date to `BatchGenerator.process_all()`.
+
+    Arguments:
+        path (string): The path of the file to write. The file extension determines the format.
+        image (array): The RGB image or single-channel image to save.
+        png_compression (int, optional): `None` or the zlib compression level in [0, 9] for PNG files.
+            If `None`, the codec's default level is used.
+    '''
+    pathlib.Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+    root, extension = os.path.splitext(path)
+    temp_path = '{}.{}.tmp{}'.format(root, os.getpid(), extension)
+    imwrite(temp_path, image, png_compression=png_compression)
+    os.replace(temp_path, path)
+
+_open_stores = {} # The `DatasetStore`s that have been opened in this process, keyed by their directory.
+
+def _get_store(store_dir):
+    '''
+    Returns the `DatasetStore` for `store_dir`, opening it only once per process.
+    '''
+    if not store_dir in _open_stores:
+        _open_stores[store_dir] = DatasetStore(store_dir)
+    return _open_stores[store_dir]
+
+def _seed_worker():
+    '''
+    Re-seeds the global random number generators in a freshly started worker process.
+
+    Forked worker processes inherit the random state of the parent process, so without
+    re-seeding all workers would produce identical random augmentations.
+    '''
+    np.random.seed()
+    random.seed()
+
+def _random_crop_position(img_height, img_width, random_crop, rng=np.random, gt_image=None, crop_class=None):
+    '''
+    Draws the position of a random crop of size `random_crop` from an image of size `(img_height, img_width)`.
+
+    In each dimension in which the crop is smaller than the image, the position is the offset of the crop
+    within the image, otherwise it is the offset of the image within the crop. If `crop_class` is given and
+    occurs in `gt_image`, the crop is centered on a random pixel of that class as far as the image borders allow.
+
+    Returns:
+        A tuple `(crop_ymin, crop_xmin)`.
+    '''
+    y_range = img_height - random_crop[0]
+    x_range = img_width - random_crop[1]
+
+    if not crop_class is None and not gt_image is None and gt_image.ndim == 2:
+        ys, xs = np.nonzero(gt_image == crop_class)
+        if len(ys) > 0:
+            i = rng.randint(0, len(ys))
+            # Dimensions in which the image fits into the crop entirely keep a random offset.
+            crop_ymin = min(max(ys[i] - random_crop[0] // 2, 0), y_range) if y_range >= 0 else rng.randint(0, -y_range + 1)
+            crop_xmin = min(max(xs[i] - random_crop[1] // 2, 0), x_range) if x_range >= 0 else rng.randint(0, -x_range + 1)
+            return int(crop_ymin), int(crop_xmin)
+
+    crop_ymin = rng.randint(0, abs(y_range) + 1) # There are `abs(y_range) + 1` possible positions in the vertical dimension.
+    crop_xmin = rng.randint(0, abs(x_range) + 1) # There are `abs(x_range) + 1` possible positions in the horizontal dimension.
+
+    return crop_ymin, crop_xmin
+
+def _fused_geometry(image,
+                    gt_image,
+                    rng=np.random,
+                    crop_class=None,
+                    void_class_id=None,
+                    random_crop=False,
+                    crop=False,
+                    resize=False,
+                    brightness=False,
+                    flip=False,
+                    translate=False,
+                    scale=False):
+    '''
+    Applies the geometric transformations of `_process_sample()` (and `brightness`) to a sample
+    with a single affine warp. The random parameters are drawn in the same order as in
+    `_process_sample()`, so both produce the same transformations for the same random state.
+
+    Each transformation is expressed as a 3x3 matrix that maps the pixel coordinates
+    before the transformation to those after it, and the matrices are multiplied into one.
+    Since a single warp would otherwise show image content that an intermediate crop
+    discarded, the output is clipped to the region that lies within the frames of all
+    intermediate results.
+
+    Returns:
+        A tuple `(image, gt_image)`, where `gt_image` is `None` if `gt_image` is `None`.
+    '''
+    img_height, img_width = image.shape[:2]
+    transform = np.eye(3)
+    frames = [] # The transform and the size of each intermediate result.
+    random_br = None
+
+    def translation(x, y):
+        return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+    def scaling(x_factor, y_factor):
+        # Maps pixel centers the way `cv2.resize()` does.
+        return np.array([[x_factor, 0, 0.5 * x_factor - 0.5], [0, y_factor, 0.5 * y_factor - 0.5], [0, 0, 1]], dtype=np.float64)
+
+    if random_crop:
+        y_range = img_height - random_crop[0]
+        x_range = img_width - random_crop[1]
+        crop_ymin, crop_xmin = _random_crop_position(img_height, img_width, random_crop, rng, gt_image, crop_class)
+        # Either crop out a patch or place the image on a larger canvas.
+        transform = translation(-crop_xmin if x_range >= 0 else crop_xmin,
+                                -crop_ymin if y_range >= 0 else crop_ymin).dot(transform)
+        img_height, img_width = random_crop
+        frames.append((transform, img_width, img_height))
+
+    if crop:
+        transform = translation(-crop[2], -crop[0]).dot(transform)
+        img_height, img_width = img_height - crop[0] - crop[1], img_width - crop[2] - crop[3]
+        frames.append((transform, img_width, img_height))
+
+    if resize:
+        transform = scaling(resize[1] / img_width, resize[0] / img_height).dot(transform)
+        img_height, img_width = resize
+
+    if brightness:
+        p = rng.uniform(0,1)
+        if p >= (1-brightness[2]):
+            # Brightness is a per-pixel operation, so it's applied to the (usually smaller) warped image.
+            random_br = rng.uniform(brightness[0], brightness[1])
+
+    if flip:
+        p = rng.uniform(0,1)
+        if p >= (1-flip):
+            transform = np.array([[-1, 0, img_width - 1], [0, 1, 0], [0, 0, 1]], dtype=np.float64).dot(transform)
+
+    if translate:
+        p = rng.uniform(0,1)
+        if p >= (1-translate[2]):
+            x = rng.randint(translate[0][0], translate[0][1]+1)
+            y = rng.randint(translate[1][0], translate[1][1]+1)
+            x_shift = rng.choice([-x, x])
+            y_shift = rng.choice([-y, y])
+            transform = translation(x_shift, y_shift).dot(transform)
+            frames.append((transform, img_width, img_height))
+
+    if scale:
+        p = rng.uniform(0,1)
+        if p >= (1-scale[2]):
+            scaling_factor = rng.uniform(scale[0], scale[1])
+            scaled_height = int(img_height * scaling_factor)
+            scaled_width = int(img_width * scaling_factor)
+            y_offset = abs(int((img_height - scaled_height) / 2))
+            x_offset = abs(int((img_width - scaled_width) / 2))
+            transform = scaling(scaled_width / img_width, scaled_height / img_height).dot(transform)
+            # Either center the scaled-down image or crop out the center of the scaled-up image.
+            if scaling_factor <= 1:
+                transform = translation(x_offset, y_offset).dot(transform)
+            else:
+                transform = translation(-x_offset, -y_offset).dot(transform)
+            frames.append((transform, img_width, img_height))
+
+    if not np.array_equal(transform, np.eye(3)) or image.shape[:2] != (img_height, img_width):
+
+        gt_border_value = 0 if void_class_id is None else void_class_id
+
+        image = cv2.warpAffine(src=image, M=transform[:2], dsize=(img_width, img_height), flags=cv2.INTER_LINEAR)
+        if not gt_image is None:
+            gt_image = cv2.warpAffine(src=gt_image,
+                                      M=transform[:2],
+                                      dsize=(img_width, img_height),
+                                      flags=cv2.INTER_NEAREST,
+                                      borderValue=gt_border_value)
+
+        # Compute the output region whose pixel centers lie within all intermediate frames.
+        x_min, y_min, x_max, y_max = 0, 0, img_width, img_height
+        for frame_transform, frame_width, frame_height in frames:
+            edges = transform.dot(np.linalg.inv(frame_transform)).dot([[-0.5, frame_width - 0.5],
+                                                                       [-0.5, frame_height - 0.5],
+                                                                       [1, 1]])
+            x_min = max(x_min, int(np.ceil(edges[0].min() - 1e-6)))
+            x_max = min(x_max, int(np.ceil(edges[0].max() - 1e-6)))
+            y_min = max(y_min, int(np.ceil(edges[1].min() - 1e-6)))
+            y_max = min(y_max, int(np.ceil(edges[1].max() - 1e-6)))
+        x_max, y_max = max(x_min, x_max), max(y_min, y_max)
+
+        # Clear everything outside of that region.
+        for region in [np.s_[:y_min], np.s_[y_max:], np.s_[:, :x_min], np.s_[:, x_max:]]:
+            image[region] = 0
+            if not gt_image is None: gt_image[region] = gt_border_value
+
+    if not random_br is None:
+        image = _scale_brightness(image, random_br)
+
+    return image, gt_image
+
+def _brightness(image, min=0.5, max=2.0, rng=np.random):
     '''
     Randomly changes the brightness of the input image.
 
     Protected against overflow.
     '''
-    hsv = cv2.cvtColor(image,cv2.COLOR_RGB2HSV)
+    return _scale_brightness(image, rng.uniform(min,max))
 
-    random_br = np.random.uniform(min,max)
+def _scale_brightness(image, random_br):
+    '''
+    Scales the brightness of the input image by the factor `random_br`.
+
+    Protected against overflow.
+    '''
+    hsv = cv2.cvtColor(image,cv2.COLOR_RGB2HSV)
 
     #To protect against overflow: Calculate a mask for all pixels
     #where adjustment of the brightness would exceed the maximum
@@ -2,15 +2,19 @@ import numpy as np
 import re
 import random
 import os
-import scipy.misc
+import multiprocessing
 from glob import glob
 
+from helpers.image_codecs import imread, imresize
+
 def batch_generator(batch_size,
                     dataset_rootdir,
                     images_subdir,
                     labels_subdir,
                     image_size,
-                    flip=False):
+                    flip=False,
+                    cache=False,
+                    num_workers=0):
         """
         Generates batches of iamges and corresponding labels indefinitely.
         Designed for the KITTI Vision Road dataset.
@@ -33,6 +37,16 @@ def batch_generator(batch_size,
                 trailing slashes do not matter.
             image_size (tuple): A tuple that represents the size to which all
                 images will be resized in the format `(height, width)`.
+            flip (float, optional): `False` or a float in [0,1], the probability
+                to flip a sample horizontally.
+            cache (bool, optional): If `True`, all images and labels are decoded and
+                resized once and kept in memory as arrays, from which all batches are
+                then served by indexing. The KITTI road dataset is small enough for this,
+                at the default image size it takes a few hundred megabytes. If `False`,
+                the images and labels are loaded from disk for every batch.
+            num_workers (int, optional): Only relevant if `cache` is `True`. The number
+                of worker processes among which the initial decoding is distributed.
+                If `0`, the images are decoded in the calling process. Defaults to 0.
 
         """
 
@@ -44,6 +58,16 @@ def batch_generator(batch_size,
         # The background color for the labels in the KITTI road dataset.
         background_color = np.array([255, 0, 0])
 
+        if cache:
+            yield from _generate_cached_batches(batch_size=batch_size,
+                                                image_paths=image_paths,
+                                                label_paths=None if labels_subdir is None else [label_paths[os.path.basename(image_path)] for image_path in image_paths],
+                                                image_size=image_size,
+                                                background_color=background_color,
+                                                flip=flip,
+                                                num_workers=num_workers)
+            return
+
         random.shuffle(image_paths)
 
         current = 0
@@ -68,14 +92,14 @@ def batch_generator(batch_size,
                 #       dirty solution until batch generation and image manipulation
                 #       will be separated properly (and random crops are a lot better
                 #       in many cases than resizing).
-                image = scipy.misc.imresize(scipy.misc.imread(image_path), image_size)
+                image = imresize(imread(image_path), image_size)
                 images.append(image)
 
                 # If a label path was given, load the labels
                 if not labels_subdir is None:
 
                     label_path = label_paths[os.path.basename(image_path)]
-                    label = scipy.misc.imresize(scipy.misc.imread(label_path), image_size)
+                    label = imresize(imread(label_path), image_size)
 
                     # Process the labels:
                     # Convert the RGB label images to boolean arrays where background = false and road = true.
@@ -105,3 +129,82 @@ def batch_generator(batch_size,
                 yield np.array(images), np.array(labels)
             else:
                 yield np.array(images)
+
+
+def _generate_cached_batches(batch_size,
+                             image_paths,
+                             label_paths,
+                             image_size,
+                             background_color,
+                             flip=False,
+                             num_workers=0):
+    """
+    The cached version of `batch_generator()`: Decodes all images and labels once
+    and then serves the batches from memory.
+    """
+
+    # Decode and resize all images (and labels) once.
+    tasks = [(image_path, None if label_paths is None else label_paths[i], image_size, background_color) for i, image_path in enumerate(image_paths)]
+    if num_workers > 0:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            samples = pool.map(_load_sample_star, tasks)
+    else:
+        samples = [_load_sample(*task) for task in tasks]
+
+    images = np.stack([sample[0] for sample in samples]) # Array of shape (num_images, height, width, 3).
+    if not label_paths is None:
+        # Only the background mask is cached, the two-channel labels are built per batch.
+        backgrounds = np.stack([sample[1] for sample in samples]) # Array of shape (num_images, height, width).
+    del samples
+
+    num_images = len(images)
+    sample_indices = np.random.permutation(num_images)
+
+    current = 0
+
+    while True:
+
+        # Shuffle data after each complete pass
+        if current >= num_images:
+            sample_indices = np.random.permutation(num_images)
+            current = 0
+
+        batch_indices = sample_indices[current:current+batch_size]
+        current += batch_size
+
+        # Fancy indexing copies the batch, so the cache is never modified.
+        batch_images = images[batch_indices]
+        if not label_paths is None:
+            batch_backgrounds = backgrounds[batch_indices]
+
+        if flip:
+            flipped = np.random.uniform(0, 1, size=len(batch_indices)) >= (1-flip)
+            batch_images[flipped] = batch_images[flipped, :, ::-1]
+            if not label_paths is None:
+                batch_backgrounds[flipped] = batch_backgrounds[flipped, :, ::-1]
+
+        if not label_paths is None:
+            # The first channel is for the background pixels and the second for the road pixels.
+            yield batch_images, np.stack((batch_backgrounds, np.invert(batch_backgrounds)), axis=3)
+        else:
+            yield batch_images
+
+def _load_sample(image_path, label_path, image_size, background_color):
+    """
+    Loads and resizes an image and, if `label_path` isn't `None`, its label.
+
+    Returns:
+        A tuple `(image, background)`, where `background` is a boolean array of shape
+        `(height, width)` in which every background pixel is `True`, or `None`.
+    """
+    image = imresize(imread(image_path), image_size)
+    if label_path is None:
+        return image, None
+    label = imresize(imread(label_path), image_size)
+    return image, np.all(label == background_color, axis=2)
+
+def _load_sample_star(args):
+    """
+    Unpacks the arguments of `_load_sample()`, for use with `Pool.map()`.
+    """
+    return _load_sample(*args)
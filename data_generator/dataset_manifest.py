@@ -0,0 +1,254 @@
+import json
+import os
+import struct
+
+MANIFEST_VERSION = 2
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# The valid PNG color types. The number of decoded channels isn't recorded, since it depends on the
+# `helpers.image_codecs` backend, e.g. for gray images with an alpha channel.
+PNG_COLOR_TYPES = {0, 2, 3, 4, 6}
+
+class DatasetManifest():
+
+    def __init__(self,
+                 image_dirs,
+                 image_file_extension='png',
+                 ground_truth_dirs=None,
+                 image_name_split_separator=None,
+                 ground_truth_suffix=None,
+                 check_existence=True):
+        '''
+        An index of the image files (and matching ground truth image files) of a dataset,
+        together with each image's file size, modification time and, once it has been read,
+        size `(height, width)`.
+
+        Scanning a dataset only lists every directory, it doesn't open any image files. The
+        sizes of the images are only read on demand, see `set_image_sizes()`, and are kept
+        across rescans as long as an image's size and modification time don't change.
+        The result can be written to a manifest file in JSON lines format and be read back
+        later, which replaces the scan by a single file read. A loaded manifest can also be
+        revalidated incrementally: Only the directories whose modification time (or whose
+        ground truth directory's modification time) changed since the manifest was written
+        are listed again, all others are taken over from the manifest. This detects added,
+        removed and renamed files, but not files that were modified in place.
+
+        The manifest file consists of a header line with the arguments below, followed by
+        one line per directory.
+
+        For documentation of the arguments, see `BatchGenerator`.
+        '''
+        self.params = {'image_dirs': [os.path.abspath(image_dir) for image_dir in image_dirs],
+                       'image_file_extension': image_file_extension.lower(),
+                       'ground_truth_dirs': None if ground_truth_dirs is None else [os.path.abspath(ground_truth_dir) for ground_truth_dir in ground_truth_dirs],
+                       'image_name_split_separator': image_name_split_separator,
+                       'ground_truth_suffix': ground_truth_suffix,
+                       'check_existence': check_existence}
+        self.directories = [] # One record per directory, in the order in which `os.walk()` would visit them.
+        self.missing_ground_truth = [] # `(image_path, ground_truth_path)` pairs found by the last scan whose ground truth image doesn't exist.
+
+    def scan(self, incremental=False):
+        '''
+        Scans the dataset directories.
+
+        Arguments:
+            incremental (bool, optional): If `True`, directories that didn't change since they
+                were last scanned (or loaded) are not listed again. Defaults to `False`.
+        '''
+        if incremental:
+            previous = {(record['dataset'], record['dir']): record for record in self.directories}
+        else:
+            previous = {}
+
+        self.directories = []
+        self.missing_ground_truth = []
+
+        for i, image_dir in enumerate(self.params['image_dirs']):
+            self._scan_directory(i, image_dir, previous)
+
+    def load(self, manifest_path):
+        '''
+        Reads the manifest file at `manifest_path`.
+
+        Returns:
+            `True` if the manifest was read, `False` if it doesn't exist or was written for a
+            different dataset configuration, in which case the dataset has to be scanned.
+        '''
+        if not os.path.isfile(manifest_path):
+            return False
+
+        with open(manifest_path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != MANIFEST_VERSION or header.get('params') != self.params:
+                return False
+            self.directories = [json.loads(line) for line in f]
+
+        self.missing_ground_truth = []
+
+        return True
+
+    def save(self, manifest_path):
+        '''
+        Writes the manifest file to `manifest_path`. The file is replaced atomically, so
+        that an interrupted write doesn't leave a truncated manifest behind.
+        '''
+        temp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'params': self.params}) + '\n')
+            for record in self.directories:
+                f.write(json.dumps(record) + '\n')
+
+        os.replace(temp_path, manifest_path)
+
+    def samples(self):
+        '''
+        Generates the samples of the dataset.
+
+        Yields:
+            A tuple `(image_path, ground_truth_path, size)` for each image. `ground_truth_path` is
+            `None` if no ground truth directories were given, `size` is the `(height, width)` of the
+            image or `None` if it isn't known.
+        '''
+        for record in self.directories:
+            for image_name, file_size, mtime, size in record['samples']:
+                image_path = os.path.join(record['dir'], image_name)
+                if record['gt_dir'] is None:
+                    ground_truth_path = None
+                else:
+                    ground_truth_path = os.path.join(record['gt_dir'], self._get_ground_truth_name(image_name))
+                yield image_path, ground_truth_path, None if size is None else tuple(size)
+
+    def set_image_sizes(self, image_sizes):
+        '''
+        Records the sizes of images, e.g. after they were read with `read_image_size()`.
+
+        Arguments:
+            image_sizes (dict): A dictionary that maps image paths as generated by `samples()` to
+                sizes `(height, width)`.
+        '''
+        for record in self.directories:
+            for sample in record['samples']:
+                size = image_sizes.get(os.path.join(record['dir'], sample[0]))
+                if not size is None:
+                    sample[3] = list(size)
+
+    def _get_ground_truth_name(self, image_name):
+        '''
+        Composes the name of the ground truth image that corresponds to the image `image_name`.
+        '''
+        left_part = image_name.split(self.params['image_name_split_separator'], 1)[0]
+        return left_part + self.params['ground_truth_suffix'] + '.' + self.params['image_file_extension']
+
+    def _scan_directory(self, i, dir_path, previous):
+        '''
+        Scans the directory `dir_path` of the `i`-th dataset and, recursively, its subdirectories.
+        '''
+        ground_truth_dirs = self.params['ground_truth_dirs']
+        if ground_truth_dirs is None:
+            gt_dir_path = None
+        else:
+            # The ground truth of an image directory lives in the subdirectory of the same name within the ground truth directory.
+            gt_dir_path = os.path.join(ground_truth_dirs[i], os.path.basename(os.path.normpath(dir_path)))
+
+        mtime = os.stat(dir_path).st_mtime_ns
+        gt_mtime = _get_mtime(gt_dir_path)
+
+        record = previous.get((i, dir_path))
+
+        if record is None or record['mtime'] != mtime or record['gt_mtime'] != gt_mtime:
+            record = self._list_directory(i, dir_path, gt_dir_path, mtime, gt_mtime, record)
+
+        self.directories.append(record)
+
+        for subdir_name in record['subdirs']:
+            self._scan_directory(i, os.path.join(dir_path, subdir_name), previous)
+
+    def _list_directory(self, i, dir_path, gt_dir_path, mtime, gt_mtime, previous_record=None):
+        '''
+        Lists the directory `dir_path` and returns its record. The shapes of images whose size and
+        modification time are the same as in `previous_record` are taken over instead of being read again.
+        '''
+        extension = '.' + self.params['image_file_extension']
+
+        if previous_record is None:
+            previous_samples = {}
+        else:
+            previous_samples = {sample[0]: sample for sample in previous_record['samples']}
+
+        samples = []
+        subdir_names = []
+
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'): # `glob()` ignores hidden files, too.
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdir_names.append(entry.name)
+                elif entry.name.endswith(extension) and entry.is_file():
+                    stat = entry.stat()
+                    previous_sample = previous_samples.get(entry.name)
+                    if not previous_sample is None and previous_sample[1] == stat.st_size and previous_sample[2] == stat.st_mtime_ns:
+                        size = previous_sample[3]
+                    else:
+                        size = None
+                    samples.append([entry.name, stat.st_size, stat.st_mtime_ns, size])
+
+        if len(samples) == 0:
+            # Directories without images don't have ground truth data.
+            gt_dir_path = None
+            gt_mtime = None
+        elif not gt_dir_path is None and self.params['check_existence']:
+            # List the ground truth directory once instead of checking each ground truth file separately.
+            if os.path.isdir(gt_dir_path):
+                gt_names = set(os.listdir(gt_dir_path))
+            else:
+                gt_names = set()
+            for image_name, _, _, _ in samples:
+                gt_name = self._get_ground_truth_name(image_name)
+                if not gt_name in gt_names:
+                    self.missing_ground_truth.append((os.path.join(dir_path, image_name), os.path.join(gt_dir_path, gt_name)))
+
+        return {'dataset': i,
+                'dir': dir_path,
+                'mtime': mtime,
+                'gt_dir': gt_dir_path,
+                'gt_mtime': gt_mtime,
+                'subdirs': subdir_names,
+                'samples': samples}
+
+def _get_mtime(path):
+    '''
+    Returns the modification time of `path` in nanoseconds or `None` if `path` is `None` or doesn't exist.
+    '''
+    if path is None:
+        return None
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def read_image_size(image_path):
+    '''
+    Returns the size `[height, width]` of the image, read from the header of the file
+    without decoding the image, or `None` if the file is not a PNG file.
+    '''
+    with open(image_path, 'rb') as f:
+        return parse_png_size(f.read(26))
+
+def parse_png_size(data):
+    '''
+    Returns the size `[height, width]` of the image, parsed from the first 26 bytes of the
+    encoded image `data`, or `None` if `data` is not a PNG image.
+    '''
+    header = data[:26]
+
+    # The IHDR chunk always comes first and contains the width, the height, the bit depth and the color type.
+    if len(header) < 26 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+
+    if not header[25] in PNG_COLOR_TYPES:
+        return None
+
+    width, height = struct.unpack('>II', header[16:24])
+
+    return [height, width]
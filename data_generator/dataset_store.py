@@ -0,0 +1,67 @@
+import numpy as np
+import json
+import os
+
+INDEX_FILE_NAME = 'index.json'
+IMAGES_SHARD_NAME = 'images_{:05d}.npy'
+GROUND_TRUTH_SHARD_NAME = 'ground_truth_{:05d}.npy'
+
+class DatasetStore():
+
+    def __init__(self, store_dir):
+        '''
+        Read access to a dataset that was packed with `BatchGenerator.pack()`.
+
+        A store consists of an index file and a number of shards, each of which is a
+        `.npy` file that holds up to `shard_size` decoded images (or ground truth images)
+        of identical shape. The shards are memory-mapped, so loading a sample does not
+        decode or copy anything, it only returns a read-only view into the shard.
+
+        Arguments:
+            store_dir (string): The directory that contains the packed dataset.
+        '''
+        self.store_dir = store_dir
+
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), 'r') as f:
+            index = json.load(f)
+
+        self.shard_size = index['shard_size']
+        self.num_samples = index['num_samples']
+        self.image_shape = tuple(index['image_shape'])
+        self.gt_shape = None if index['gt_shape'] is None else tuple(index['gt_shape'])
+        self.ground_truth = not self.gt_shape is None
+        # Map each original image path to its position in the store.
+        self.sample_indices = {os.path.abspath(image_path): i for i, image_path in enumerate(index['image_paths'])}
+
+        self._image_shards = {} # The shards that have been memory-mapped so far.
+        self._gt_shards = {}
+
+    def __contains__(self, image_path):
+        return os.path.abspath(image_path) in self.sample_indices
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        # Memory maps can't be sent to other processes, they get re-opened lazily instead.
+        state = self.__dict__.copy()
+        state['_image_shards'] = {}
+        state['_gt_shards'] = {}
+        return state
+
+    def load(self, image_path):
+        '''
+        Returns the stored image that was packed from `image_path` and its ground truth
+        image (or `None` if the store doesn't contain ground truth data) as read-only views.
+        '''
+        shard, row = divmod(self.sample_indices[os.path.abspath(image_path)], self.shard_size)
+
+        if not shard in self._image_shards:
+            self._image_shards[shard] = np.load(os.path.join(self.store_dir, IMAGES_SHARD_NAME.format(shard)), mmap_mode='r')
+            if self.ground_truth:
+                self._gt_shards[shard] = np.load(os.path.join(self.store_dir, GROUND_TRUTH_SHARD_NAME.format(shard)), mmap_mode='r')
+
+        if self.ground_truth:
+            return self._image_shards[shard][row], self._gt_shards[shard][row]
+        else:
+            return self._image_shards[shard][row], None
@@ -0,0 +1,245 @@
+import numpy as np
+import os
+import sys
+import json
+import struct
+import zlib
+import itertools
+import copy
+from tqdm import trange
+
+from data_generator.batch_generator import _BatchGeneratorBase
+from data_generator.dataset_manifest import parse_png_size
+
+RECORD_INDEX_FILE_NAME = 'records.json'
+RECORD_SHARD_NAME = 'records_{:05d}.bin'
+RECORD_MAGIC = b'FCNR'
+# Each record starts with the magic bytes and the lengths of the metadata, the image and the ground truth image...
+RECORD_HEADER = struct.Struct('<4sIII')
+# ...and ends with the CRC32 checksum of the metadata, the image and the ground truth image.
+RECORD_FOOTER = struct.Struct('<I')
+
+def write_record_shards(batch_generator,
+                        record_dir,
+                        shard_bytes=256*1024*1024,
+                        shuffle=True,
+                        seed=None):
+    '''
+    Writes the image files (and ground truth image files) of a `BatchGenerator` into a small number
+    of large shard files that `RecordBatchGenerator` streams sequentially. This replaces opening
+    millions of small files in random order by a few large sequential reads, which is much faster
+    on network and distributed file systems.
+
+    The images are stored as they are, i.e. still encoded as PNG (or JPEG), together with their
+    original path and size `[height, width]`. Each record consists of a header with the lengths of its parts, the
+    metadata as JSON, the encoded image, the encoded ground truth image, and a CRC32 checksum.
+
+    Arguments:
+        batch_generator (BatchGenerator): The `BatchGenerator` whose files to write.
+        record_dir (string): The directory into which to write the shards. Will be created if it
+            doesn't exist.
+        shard_bytes (int, optional): A new shard is started once a shard exceeds this size in bytes.
+            Defaults to 256 MiB.
+        shuffle (bool, optional): If `True`, the samples are written in random order. Since the reader
+            only shuffles within a limited buffer, this makes sure that each shard contains a random
+            mix of the dataset. Defaults to `True`.
+        seed (int, optional): `None` or an integer seed for the order of the samples.
+    '''
+    os.makedirs(record_dir, exist_ok=True)
+
+    sample_indices = batch_generator.samples.sorted_indices()
+    if shuffle:
+        np.random.RandomState(seed).shuffle(sample_indices)
+
+    shards = []
+    shard_file = None
+
+    tr = trange(len(sample_indices), file=sys.stdout)
+    tr.set_description('Writing records')
+
+    try:
+        for i in tr:
+
+            sample_index = sample_indices[i]
+            image_path = batch_generator.samples.image_path(sample_index)
+            gt_image_path = batch_generator.samples.ground_truth_path(sample_index)
+
+            with open(image_path, 'rb') as f:
+                image_data = f.read()
+            if gt_image_path is None:
+                gt_data = b''
+            else:
+                with open(gt_image_path, 'rb') as f:
+                    gt_data = f.read()
+
+            metadata = {'image_path': image_path,
+                        'gt_image_path': gt_image_path,
+                        'image_size': parse_png_size(image_data),
+                        'gt_size': None if gt_image_path is None else parse_png_size(gt_data)}
+
+            # Start a new shard.
+            if shard_file is None or shard_file.tell() >= shard_bytes:
+                if not shard_file is None:
+                    shard_file.close()
+                shards.append({'file': RECORD_SHARD_NAME.format(len(shards)), 'num_samples': 0})
+                shard_file = open(os.path.join(record_dir, shards[-1]['file']), 'wb')
+
+            _write_record(shard_file, json.dumps(metadata).encode('utf-8'), image_data, gt_data)
+            shards[-1]['num_samples'] += 1
+    finally:
+        if not shard_file is None:
+            shard_file.close()
+
+    # Write the index last so that an interrupted run doesn't leave valid-looking shards behind.
+    index = {'num_samples': len(sample_indices),
+             'ground_truth': batch_generator.ground_truth,
+             'shards': shards}
+
+    with open(os.path.join(record_dir, RECORD_INDEX_FILE_NAME), 'w') as f:
+        json.dump(index, f)
+
+def read_record_shard(shard_path, buffer_size=8*1024*1024):
+    '''
+    Reads the records of a shard sequentially.
+
+    Arguments:
+        shard_path (string): The path of the shard file.
+        buffer_size (int, optional): The size of the read buffer in bytes. Defaults to 8 MiB.
+
+    Yields:
+        A tuple `(metadata, image_data, gt_data)` for each record, where `metadata` is a dictionary,
+        `image_data` the encoded image, and `gt_data` the encoded ground truth image or `None`.
+    '''
+    with open(shard_path, 'rb', buffering=buffer_size) as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) == 0:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise IOError("The shard '{}' is truncated.".format(shard_path))
+            magic, metadata_length, image_length, gt_length = RECORD_HEADER.unpack(header)
+            if magic != RECORD_MAGIC:
+                raise IOError("The shard '{}' is corrupted.".format(shard_path))
+            payload = f.read(metadata_length + image_length + gt_length)
+            footer = f.read(RECORD_FOOTER.size)
+            if len(payload) < metadata_length + image_length + gt_length or len(footer) < RECORD_FOOTER.size:
+                raise IOError("The shard '{}' is truncated.".format(shard_path))
+            if zlib.crc32(payload) != RECORD_FOOTER.unpack(footer)[0]:
+                raise IOError("A record in the shard '{}' is corrupted.".format(shard_path))
+            metadata = json.loads(payload[:metadata_length].decode('utf-8'))
+            image_data = payload[metadata_length:metadata_length+image_length]
+            gt_data = payload[metadata_length+image_length:] if gt_length > 0 else None
+            yield metadata, image_data, gt_data
+
+class RecordBatchGenerator(_BatchGeneratorBase):
+
+    def __init__(self,
+                 record_dir,
+                 num_classes=None,
+                 shuffle_buffer_size=1024):
+        '''
+        A `BatchGenerator` that streams its samples from the shards that `write_record_shards()` wrote,
+        instead of reading the individual image files. The dataset directories aren't needed.
+
+        The shards are read sequentially, one after another. Shuffling happens at two levels: The order of
+        the shards is shuffled before each pass, and the samples pass through a shuffle buffer from which
+        they are drawn at random. The larger the buffer, the closer the result is to a full shuffle, but
+        the buffer holds the encoded samples in memory.
+
+        `generate()` works like `BatchGenerator.generate()` and yields the same batches, except that it doesn't
+        support `to_disk`, `store_dir`, `sampler` and `bucket_by`, which require random access to the samples.
+
+        Arguments:
+            record_dir (string): The directory that contains the shards.
+            num_classes (int, optional): The number of segmentation classes, see `BatchGenerator`.
+            shuffle_buffer_size (int, optional): The number of samples in the shuffle buffer. Defaults to 1024.
+        '''
+        super().__init__(num_classes=num_classes)
+
+        self.record_dir = record_dir
+
+        with open(os.path.join(record_dir, RECORD_INDEX_FILE_NAME), 'r') as f:
+            index = json.load(f)
+
+        self.dataset_size = index['num_samples']
+        self.ground_truth = index['ground_truth']
+        self.shards = index['shards']
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+    def shard(self, num_shards, shard_index):
+        '''
+        Like `BatchGenerator.shard()`, but distributes the record shards instead of the individual
+        samples, so that each record shard is still read sequentially by a single process.
+        `num_shards` can be at most the number of record shards.
+        '''
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("`shard_index` must be in [0, num_shards), but is {}.".format(shard_index))
+        if num_shards > len(self.shards):
+            raise ValueError("Can't split {} record shards into {} shards. Write the records with a smaller `shard_bytes`.".format(len(self.shards), num_shards))
+
+        sharded = copy.copy(self)
+        sharded.shards = self.shards[shard_index::num_shards]
+        sharded.dataset_size = sum(shard['num_samples'] for shard in sharded.shards)
+
+        return sharded
+
+    def _generate_batch_paths(self, batch_size, shuffle, seed=None):
+        '''
+        Streams the samples from the shards indefinitely and groups them into batches.
+
+        Yields:
+            A list of tuples `(image_data, gt_data, random_seed)`, one for each sample in the batch, where
+            `image_data` and `gt_data` are the encoded images, which `_process_sample()` accepts in place of paths.
+        '''
+        for epoch in itertools.count():
+
+            if seed is None: rng = np.random
+            else: rng = np.random.RandomState([seed, epoch])
+
+            batch_paths = []
+
+            for i, (image_data, gt_data) in enumerate(self._generate_epoch_samples(shuffle, rng)):
+                random_seed = None if seed is None else [seed, epoch, i]
+                batch_paths.append((image_data, gt_data, random_seed))
+                if len(batch_paths) == batch_size:
+                    yield batch_paths
+                    batch_paths = []
+
+            # Like `BatchGenerator`, the last batch of a pass may be smaller.
+            if len(batch_paths) > 0:
+                yield batch_paths
+
+    def _generate_epoch_samples(self, shuffle, rng):
+        '''
+        Generates the encoded samples `(image_data, gt_data)` of one pass over all shards.
+        '''
+        shard_order = rng.permutation(len(self.shards)) if shuffle else range(len(self.shards))
+
+        buffer = []
+
+        for shard_index in shard_order:
+            for _, image_data, gt_data in read_record_shard(os.path.join(self.record_dir, self.shards[shard_index]['file'])):
+                if not shuffle:
+                    yield image_data, gt_data
+                elif len(buffer) < self.shuffle_buffer_size:
+                    buffer.append((image_data, gt_data))
+                else:
+                    # Replace a random sample of the buffer by the new one and yield the replaced sample.
+                    j = rng.randint(0, len(buffer))
+                    yield buffer[j]
+                    buffer[j] = (image_data, gt_data)
+
+        # Drain the buffer at the end of the pass.
+        for j in (rng.permutation(len(buffer)) if shuffle else range(len(buffer))):
+            yield buffer[j]
+
+def _write_record(f, metadata, image_data, gt_data):
+    '''
+    Writes one record to the file `f`.
+    '''
+    f.write(RECORD_HEADER.pack(RECORD_MAGIC, len(metadata), len(image_data), len(gt_data)))
+    f.write(metadata)
+    f.write(image_data)
+    f.write(gt_data)
+    checksum = zlib.crc32(gt_data, zlib.crc32(image_data, zlib.crc32(metadata)))
+    f.write(RECORD_FOOTER.pack(checksum))
@@ -0,0 +1,120 @@
+import numpy as np
+import os
+
+from data_generator.dataset_manifest import read_image_size
+
+class SampleTable():
+
+    def __init__(self, samples):
+        '''
+        A compact, array-backed table of the samples of a dataset.
+
+        Every path is stored as an index into a table of directory paths, each of which
+        is stored only once, plus the file name. The file names are stored UTF-8 encoded in
+        a fixed-width byte string array, so the table takes only a few dozen bytes per sample
+        and no Python object per sample. Samples are identified by their position in the
+        table, so shuffling or sampling the dataset only permutes integer indices.
+
+        Arguments:
+            samples (iterable): An iterable of tuples `(image_path, ground_truth_path, size)` as
+                generated by `DatasetManifest.samples()`. Either all or none of the ground truth
+                paths must be `None`. `size` is the `(height, width)` of the image or `None` if it isn't known.
+        '''
+        self.directories = [] # The table of directory paths that the samples reference.
+        directory_indices = {}
+
+        def intern(path):
+            directory, name = os.path.split(path)
+            if not directory in directory_indices:
+                directory_indices[directory] = len(self.directories)
+                self.directories.append(directory)
+            return directory_indices[directory], name.encode('utf-8')
+
+        image_directories = []
+        image_names = []
+        gt_directories = []
+        gt_names = []
+        image_sizes = []
+
+        for image_path, ground_truth_path, size in samples:
+            directory, name = intern(image_path)
+            image_directories.append(directory)
+            image_names.append(name)
+            if not ground_truth_path is None:
+                directory, name = intern(ground_truth_path)
+                gt_directories.append(directory)
+                gt_names.append(name)
+            image_sizes.append((-1, -1) if size is None else size)
+
+        if len(gt_names) > 0 and len(gt_names) != len(image_names):
+            raise ValueError("Either all or none of the samples must have a ground truth path.")
+
+        self.image_directories = np.array(image_directories, dtype=np.int32)
+        self.image_names = np.array(image_names, dtype=np.bytes_)
+        self.ground_truth = len(gt_names) > 0
+        if self.ground_truth:
+            self.gt_directories = np.array(gt_directories, dtype=np.int32)
+            self.gt_names = np.array(gt_names, dtype=np.bytes_)
+        else:
+            self.gt_directories = None
+            self.gt_names = None
+        # The `(height, width)` of each image as read from the file headers, `(-1, -1)` where unknown, see `read_image_sizes()`.
+        self.image_sizes = np.array(image_sizes, dtype=np.int32).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.image_names)
+
+    def image_path(self, i):
+        '''
+        Returns the path of the image of the `i`-th sample.
+        '''
+        return os.path.join(self.directories[self.image_directories[i]], self.image_names[i].decode('utf-8'))
+
+    def ground_truth_path(self, i):
+        '''
+        Returns the path of the ground truth image of the `i`-th sample or `None` if there is no ground truth data.
+        '''
+        if not self.ground_truth:
+            return None
+        return os.path.join(self.directories[self.gt_directories[i]], self.gt_names[i].decode('utf-8'))
+
+    def read_image_sizes(self):
+        '''
+        Reads the sizes of the images whose sizes are unknown from the headers of their files.
+
+        Returns:
+            A dictionary that maps the path of each image whose size was read to its size `[height, width]`.
+            Images whose size can't be read from the header, i.e. non-PNG images, are left out.
+        '''
+        image_sizes = {}
+        for i in np.flatnonzero(self.image_sizes[:, 0] < 0):
+            image_path = self.image_path(i)
+            size = read_image_size(image_path)
+            if not size is None:
+                self.image_sizes[i] = size
+                image_sizes[image_path] = size
+        return image_sizes
+
+    def subset(self, indices):
+        '''
+        Returns a new `SampleTable` that contains the samples `indices` in the given order.
+        The directory table is shared with this table.
+        '''
+        subset = SampleTable([])
+        subset.directories = self.directories
+        subset.image_directories = self.image_directories[indices]
+        subset.image_names = self.image_names[indices]
+        subset.ground_truth = self.ground_truth
+        if self.ground_truth:
+            subset.gt_directories = self.gt_directories[indices]
+            subset.gt_names = self.gt_names[indices]
+        subset.image_sizes = self.image_sizes[indices]
+        return subset
+
+    def sorted_indices(self):
+        '''
+        Returns the sample indices sorted by directory path and file name, i.e. in an order
+        that doesn't depend on the order in which the file system listed the files.
+        '''
+        directory_ranks = np.argsort(np.argsort(np.array(self.directories, dtype=object))).astype(np.int32)
+        return np.lexsort((self.image_names, directory_ranks[self.image_directories]))
@@ -0,0 +1,256 @@
+import numpy as np
+import os
+import sys
+import json
+import hashlib
+import multiprocessing
+from tqdm import trange
+
+from helpers.image_codecs import imread
+from helpers.ground_truth_conversion_utils import convert_IDs_to_IDs, convert_IDs_to_IDs_partial
+
+def compute_class_statistics(batch_generator,
+                             num_classes=None,
+                             convert_ids_to_ids=False,
+                             cache_path=None,
+                             num_workers=0):
+    '''
+    Counts the pixels of each class in each ground truth image of a dataset.
+
+    The counts are needed by `ClassBalancedSampler`. Since computing them requires decoding
+    the entire ground truth dataset, they can be cached in a file that is reused as long
+    as it was computed for the same samples, number of classes and ID conversion.
+
+    Arguments:
+        batch_generator (BatchGenerator): The `BatchGenerator` whose ground truth images to count.
+        num_classes (int, optional): The number of classes. Class IDs outside of `[0, num_classes)`,
+            e.g. a void class ID of 255, are not counted. If `None`, `batch_generator.num_classes` is used.
+        convert_ids_to_ids (array or dict, optional): The same ID conversion that is passed to
+            `BatchGenerator.generate()`, so that the counts refer to the converted class IDs.
+        cache_path (string, optional): `None` or the path of an `.npz` file in which to cache the counts.
+            If the file exists and matches the arguments, the counts are read from it, otherwise they are
+            computed and written to it.
+        num_workers (int, optional): The number of worker processes among which the counting is
+            distributed. If `0`, the counting happens in the calling process. Defaults to 0.
+
+    Returns:
+        A 2D Numpy array of shape `(num_samples, num_classes)` whose element `[i, c]` is the number of pixels
+        of class `c` in the `i`-th ground truth image, in the order of `batch_generator.samples`.
+    '''
+    if not batch_generator.ground_truth:
+        raise ValueError("The `BatchGenerator` doesn't have any ground truth data.")
+
+    if num_classes is None:
+        num_classes = batch_generator.num_classes
+    if num_classes is None:
+        raise ValueError("`num_classes` must be given if the `BatchGenerator` doesn't know the number of classes.")
+
+    gt_image_paths = batch_generator.ground_truth_paths
+    # Identifies what the counts were computed for. The paths are hashed, so that checking
+    # the cache doesn't require storing and comparing the paths of the entire dataset.
+    paths_hash = hashlib.sha1()
+    for path in gt_image_paths:
+        paths_hash.update(os.path.abspath(path).encode('utf-8') + b'\0')
+    fingerprint = json.dumps({'num_classes': num_classes,
+                              'convert_ids_to_ids': _describe_id_conversion(convert_ids_to_ids),
+                              'num_samples': len(gt_image_paths),
+                              'gt_image_paths_sha1': paths_hash.hexdigest()})
+
+    if (not cache_path is None) and os.path.isfile(cache_path):
+        with np.load(cache_path) as cache:
+            if str(cache['fingerprint']) == fingerprint:
+                return cache['pixel_counts']
+
+    tasks = [(gt_image_path, num_classes, convert_ids_to_ids) for gt_image_path in gt_image_paths]
+
+    if num_workers > 0:
+        pool = multiprocessing.Pool(processes=num_workers)
+        counts = pool.imap(_count_class_pixels_star, tasks, chunksize=16)
+    else:
+        pool = None
+        counts = (_count_class_pixels(*task) for task in tasks)
+
+    pixel_counts = np.zeros((len(tasks), num_classes), dtype=np.int64)
+
+    tr = trange(len(tasks), file=sys.stdout)
+    tr.set_description('Counting class pixels')
+
+    try:
+        for i in tr:
+            pixel_counts[i] = next(counts)
+    finally:
+        if not pool is None:
+            pool.terminate()
+
+    if not cache_path is None:
+        np.savez(cache_path, pixel_counts=pixel_counts, fingerprint=np.array(fingerprint))
+
+    return pixel_counts
+
+class Sampler():
+    '''
+    The base class of the samplers that `BatchGenerator.generate()` accepts via its `sampler` argument.
+
+    A sampler selects the samples of each batch (and optionally a class for each sample on
+    which the random crop is centered) instead of the uniform shuffle of `generate()`.
+    Samplers may update their state based on the losses of the batches they selected,
+    see `report_losses()`.
+    '''
+
+    def __init__(self):
+        self.last_batch_indices = None # The sample indices of the batch that was yielded last, set by `BatchGenerator.generate()`.
+
+    def sample(self, batch_size, rng):
+        '''
+        Selects the samples of the next batch.
+
+        Arguments:
+            batch_size (int): The number of samples to select.
+            rng (RandomState): The random number generator to use.
+
+        Returns:
+            A tuple `(sample_indices, crop_classes)` of two 1D Numpy arrays of length `batch_size`.
+            `crop_classes` is `None` if the random crops aren't supposed to be centered on a class,
+            otherwise it contains for each sample the class on which to center the crop.
+        '''
+        raise NotImplementedError
+
+    def update(self, sample_indices, losses):
+        '''
+        Lets the sampler know the losses of the samples `sample_indices`. Does nothing by default.
+        '''
+        pass
+
+    def report_losses(self, losses):
+        '''
+        Reports the losses of the batch that was yielded last, one loss per sample. This can be passed
+        to `FCN8s.train()` as its `loss_feedback` argument.
+        '''
+        if self.last_batch_indices is None:
+            raise ValueError("No batch has been yielded yet.")
+        if len(losses) != len(self.last_batch_indices):
+            raise ValueError("Got {} losses for a batch of {} samples. Make sure that the losses belong to the batch that was yielded last.".format(len(losses), len(self.last_batch_indices)))
+        self.update(self.last_batch_indices, np.asarray(losses))
+
+class ClassBalancedSampler(Sampler):
+
+    def __init__(self,
+                 pixel_counts,
+                 ignore_classes=(),
+                 min_pixels=1,
+                 class_aware_crops=True):
+        '''
+        Samples the classes uniformly instead of the images: For each sample in a batch, a class is drawn
+        uniformly from all classes that occur in the dataset, and then an image is drawn uniformly from all
+        images that contain that class. Rare classes thus appear as often as frequent ones.
+
+        Optionally, the random crop of each sample is centered on a random pixel of the class for
+        which it was drawn, so that small objects of rare classes aren't cropped away.
+
+        Arguments:
+            pixel_counts (array): The class pixel counts as computed by `compute_class_statistics()`.
+            ignore_classes (iterable, optional): Class IDs that are never drawn, e.g. the void class.
+            min_pixels (int, optional): The minimum number of pixels of a class that an image must contain
+                to count as containing that class. Defaults to 1.
+            class_aware_crops (bool, optional): If `True`, random crops are centered on a random pixel of
+                the drawn class. Only relevant if `random_crop` is used in `generate()`. Defaults to `True`.
+        '''
+        super().__init__()
+
+        contains_class = pixel_counts >= min_pixels
+        self.classes = np.array([c for c in range(pixel_counts.shape[1]) if not c in ignore_classes and np.any(contains_class[:, c])])
+
+        if len(self.classes) == 0:
+            raise ValueError("No image contains any of the classes that aren't being ignored.")
+
+        # For each class, the indices of the images that contain it.
+        self.class_sample_indices = [np.flatnonzero(contains_class[:, c]) for c in self.classes]
+        self.class_aware_crops = class_aware_crops
+
+    def sample(self, batch_size, rng):
+        classes = rng.randint(0, len(self.classes), size=batch_size)
+        sample_indices = np.array([self.class_sample_indices[c][rng.randint(0, len(self.class_sample_indices[c]))] for c in classes])
+        if self.class_aware_crops:
+            return sample_indices, self.classes[classes]
+        else:
+            return sample_indices, None
+
+class LossWeightedSampler(Sampler):
+
+    def __init__(self,
+                 num_samples,
+                 uniform_fraction=0.5,
+                 momentum=0.9,
+                 power=1.0):
+        '''
+        Samples images with a probability that grows with their recent training loss, so that
+        hard examples are seen more often. The losses are reported back from `FCN8s.train()`
+        via its `loss_feedback` argument, for example:
+
+            sampler = LossWeightedSampler(batch_generator.dataset_size)
+            train_generator = batch_generator.generate(..., sampler=sampler)
+            model.train(train_generator, ..., loss_feedback=sampler.report_losses)
+
+        Arguments:
+            num_samples (int): The number of samples in the dataset.
+            uniform_fraction (float, optional): The fraction of the sampling probability that is distributed
+                uniformly among all samples, so that easy examples are still being revisited. Defaults to 0.5.
+            momentum (float, optional): The momentum of the exponential moving average of each sample's loss.
+                Defaults to 0.9.
+            power (float, optional): The sampling weights are the averaged losses to the power of `power`.
+                Larger values focus the sampling more on the hardest examples. Defaults to 1.
+        '''
+        super().__init__()
+
+        if not 0 <= uniform_fraction <= 1:
+            raise ValueError("`uniform_fraction` must be in [0, 1].")
+
+        self.num_samples = num_samples
+        self.uniform_fraction = uniform_fraction
+        self.momentum = momentum
+        self.power = power
+        self.losses = np.full(num_samples, np.nan) # The moving averages of the losses, `NaN` for samples whose loss hasn't been reported yet.
+
+    def sample(self, batch_size, rng):
+        seen = ~np.isnan(self.losses)
+        if np.any(seen):
+            # Samples that haven't been seen yet count as being as hard as the hardest sample.
+            weights = np.where(seen, self.losses, np.nanmax(self.losses)) ** self.power
+        if (not np.any(seen)) or (np.sum(weights) == 0):
+            # Sample uniformly until some loss is known, or if all losses are zero.
+            probabilities = None
+        else:
+            probabilities = self.uniform_fraction / self.num_samples + (1 - self.uniform_fraction) * weights / np.sum(weights)
+        return rng.choice(self.num_samples, size=batch_size, p=probabilities), None
+
+    def update(self, sample_indices, losses):
+        previous = self.losses[sample_indices]
+        self.losses[sample_indices] = np.where(np.isnan(previous), losses, self.momentum * previous + (1 - self.momentum) * losses)
+
+def _count_class_pixels(gt_image_path, num_classes, convert_ids_to_ids=False):
+    '''
+    Returns the number of pixels of each class in the ground truth image at `gt_image_path`.
+    '''
+    gt_image = imread(gt_image_path)
+    if isinstance(convert_ids_to_ids, np.ndarray):
+        gt_image = convert_IDs_to_IDs(gt_image, convert_ids_to_ids)
+    elif isinstance(convert_ids_to_ids, dict):
+        gt_image = convert_IDs_to_IDs_partial(gt_image, convert_ids_to_ids)
+    return np.bincount(gt_image.ravel(), minlength=num_classes)[:num_classes]
+
+def _count_class_pixels_star(args):
+    '''
+    Unpacks the arguments of `_count_class_pixels()`, for use with `Pool.imap()`.
+    '''
+    return _count_class_pixels(*args)
+
+def _describe_id_conversion(convert_ids_to_ids):
+    '''
+    Returns a JSON-serializable description of an ID conversion as accepted by `BatchGenerator.generate()`.
+    '''
+    if isinstance(convert_ids_to_ids, np.ndarray):
+        return convert_ids_to_ids.tolist()
+    elif isinstance(convert_ids_to_ids, dict):
+        return sorted([int(key), int(value)] for key, value in convert_ids_to_ids.items())
+    else:
+        return convert_ids_to_ids
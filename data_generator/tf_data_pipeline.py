@@ -0,0 +1,118 @@
+import tensorflow as tf
+import numpy as np
+
+def build_dataset(batch_generator,
+                  batch_size,
+                  convert_ids_to_ids=False,
+                  random_crop=False,
+                  resize=False,
+                  brightness=False,
+                  flip=False,
+                  shuffle=True,
+                  seed=None,
+                  repeat=True,
+                  num_parallel_calls=4,
+                  prefetch=2):
+    '''
+    Builds a `tf.data.Dataset` from the image (and ground truth image) files of a
+    `BatchGenerator`. The decoding and augmentation of the samples happen in TensorFlow ops
+    that run in parallel, and the next batches are being prefetched while the current batch is
+    being processed by the model, so that the input pipeline overlaps with the computation.
+    The resulting dataset can be passed to `FCN8s.train()`, `FCN8s.evaluate()`, and
+    `FCN8s.predict()` in place of a Python generator.
+
+    Supports a subset of the transformations of `BatchGenerator.generate()`, see there for
+    details. Color-to-ID conversion is not supported, convert the ground truth data offline instead.
+    The ground truth images are always yielded as label maps of class IDs, if the model expects
+    one-hot labels, the conversion happens inside the model.
+
+    Arguments:
+        batch_generator (BatchGenerator): The `BatchGenerator` whose files to use.
+        batch_size (int): The number of images (or image/ground truth pairs) per batch.
+        convert_ids_to_ids (array, optional): `False` or a 1D Numpy array that maps the current class
+            IDs of the ground truth data to the desired class IDs. Dictionaries are not supported.
+        random_crop (tuple, optional): `False` or a tuple of two integers, `(height, width)`, the size of
+            the patch that is to be cropped out at a random position. The patch may not be larger than the images.
+        resize (tuple, optional): `False` or a tuple of 2 integers for the desired output size of the images
+            in the format `(height, width)`. Resizing happens after random cropping.
+        brightness (tuple, optional): `False` or a tuple containing three floats, `(min, max, prob)`.
+        flip (float, optional): `False` or a float in [0,1], the probability to flip a sample horizontally.
+        shuffle (bool, optional): If `True`, the dataset will be shuffled before each new pass.
+        seed (int, optional): `None` or an integer seed for the shuffling. Note that the random
+            augmentations are not deterministic if `num_parallel_calls > 1`.
+        repeat (bool, optional): If `True`, the dataset repeats indefinitely like the generator returned by
+            `BatchGenerator.generate()`. This is required for `FCN8s.train()` and `FCN8s.evaluate()`.
+            Set this to `False` for `FCN8s.predict()`, which runs until the dataset is exhausted.
+        num_parallel_calls (int, optional): The number of samples that are being loaded and processed in parallel.
+        prefetch (int, optional): The number of batches to prepare in advance.
+
+    Returns:
+        A `tf.data.Dataset` whose elements are either a `uint8` tensor of shape `(batch_size, height, width, 3)`
+        with the images, or, if the `BatchGenerator` has ground truth data, a tuple of the former and a `uint8`
+        tensor of shape `(batch_size, height, width)` with the ground truth class IDs.
+    '''
+    if isinstance(convert_ids_to_ids, dict):
+        raise ValueError("`convert_ids_to_ids` must be `False` or a Numpy array, dictionaries are not supported.")
+
+    ground_truth = batch_generator.ground_truth
+
+    image_paths = batch_generator.image_paths
+    if ground_truth:
+        gt_image_paths = batch_generator.ground_truth_paths
+        dataset = tf.data.Dataset.from_tensor_slices((image_paths, gt_image_paths))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(image_paths)
+
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=len(image_paths), seed=seed)
+    if repeat:
+        dataset = dataset.repeat()
+
+    if not convert_ids_to_ids is False:
+        id_map = tf.constant(convert_ids_to_ids.astype(np.uint8))
+
+    def load_sample(image_path, gt_image_path=None):
+
+        image = tf.image.decode_png(tf.read_file(image_path), channels=3)
+
+        if ground_truth:
+            gt_image = tf.image.decode_png(tf.read_file(gt_image_path), channels=1)
+            if not convert_ids_to_ids is False:
+                gt_image = tf.gather(id_map, tf.cast(gt_image, tf.int32))
+
+        if random_crop:
+            if ground_truth:
+                # Stack the image and the ground truth image so that both get cropped at the same position.
+                stacked = tf.random_crop(tf.concat([image, gt_image], axis=-1), size=[random_crop[0], random_crop[1], 4])
+                image, gt_image = stacked[:,:,:3], stacked[:,:,3:]
+            else:
+                image = tf.random_crop(image, size=[random_crop[0], random_crop[1], 3])
+
+        if resize:
+            image = tf.cast(tf.round(tf.image.resize_images(image, size=resize, method=tf.image.ResizeMethod.BILINEAR)), tf.uint8)
+            if ground_truth: gt_image = tf.image.resize_images(gt_image, size=resize, method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+
+        if brightness:
+            # Scale the value channel in HSV space just like `BatchGenerator.generate()`.
+            hsv = tf.image.rgb_to_hsv(tf.image.convert_image_dtype(image, tf.float32))
+            factor = tf.where(tf.random_uniform([]) >= (1 - brightness[2]),
+                              tf.random_uniform([], minval=brightness[0], maxval=brightness[1]),
+                              1.0)
+            hsv = tf.concat([hsv[:,:,:2], tf.minimum(hsv[:,:,2:] * factor, 1.0)], axis=-1)
+            image = tf.image.convert_image_dtype(tf.image.hsv_to_rgb(hsv), tf.uint8, saturate=True)
+
+        if flip:
+            do_flip = tf.random_uniform([]) >= (1 - flip)
+            image = tf.cond(do_flip, lambda: tf.reverse(image, axis=[1]), lambda: image)
+            if ground_truth: gt_image = tf.cond(do_flip, lambda: tf.reverse(gt_image, axis=[1]), lambda: gt_image)
+
+        if ground_truth:
+            return image, tf.squeeze(gt_image, axis=-1)
+        else:
+            return image
+
+    dataset = dataset.map(load_sample, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(prefetch)
+
+    return dataset
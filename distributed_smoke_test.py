@@ -0,0 +1,157 @@
+'''
+Trains an FCN-8s for a few synchronous steps in a distributed training on this machine, with one
+parameter server and several workers in separate processes, and checks that:
+
+1. The global step advances once per synchronous step, not once per worker and step.
+2. Only the chief writes checkpoints and summaries.
+
+Each worker trains on its own shard of the dataset, see `BatchGenerator.shard()`.
+
+Usage:
+    python distributed_smoke_test.py --vgg16_dir path/to/vgg16 --num_classes 34 \
+        --image_dirs path/to/images --ground_truth_dirs path/to/ground_truth
+'''
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from fcn8s_tensorflow import FCN8s, local_cluster_spec, run_parameter_server
+from data_generator.batch_generator import BatchGenerator
+
+def _run_worker(cluster_spec, task_index, args, output_dir, results):
+    '''
+    Trains one worker for `args.num_steps` steps and puts `(task_index, initial_step, final_step)`
+    into the queue `results`. Runs in its own process.
+    '''
+    num_workers = len(cluster_spec['worker'])
+
+    batch_generator = BatchGenerator(image_dirs=args.image_dirs,
+                                     ground_truth_dirs=args.ground_truth_dirs,
+                                     image_name_split_separator=args.image_name_split_separator,
+                                     ground_truth_suffix=args.ground_truth_suffix,
+                                     num_classes=args.num_classes).shard(num_workers, task_index)
+
+    train_generator = batch_generator.generate(batch_size=args.batch_size,
+                                               convert_to_one_hot=False,
+                                               resize=tuple(args.image_size),
+                                               seed=task_index)
+
+    model = FCN8s(vgg16_dir=args.vgg16_dir,
+                  num_classes=args.num_classes,
+                  sparse_labels=True,
+                  cluster_spec=cluster_spec,
+                  task_index=task_index)
+
+    initial_step = model.sess.run(model.global_step)
+
+    worker_dir = os.path.join(output_dir, 'worker_{}'.format(task_index))
+
+    # Every worker asks for checkpoints and summaries, `train()` must only write them on the chief.
+    model.train(train_generator=train_generator,
+                epochs=1,
+                steps_per_epoch=args.num_steps,
+                learning_rate_schedule=lambda step: 1e-5,
+                metrics={},
+                save_during_training=True,
+                save_dir=os.path.join(worker_dir, 'checkpoints'),
+                save_best_only=False,
+                save_frequency=1,
+                saver='train_saver',
+                record_summaries=True,
+                summaries_frequency=1,
+                summaries_dir=os.path.join(worker_dir, 'summaries'),
+                summaries_name='training')
+
+    final_step = model.sess.run(model.global_step)
+
+    results.put((task_index, int(initial_step), int(final_step)))
+
+    model.close()
+
+def _list_files(directory):
+    '''
+    Returns the paths of all files below `directory`, or an empty list if it doesn't exist.
+    '''
+    return [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(directory) for file_name in file_names]
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the synchronous distributed training of FCN-8s on a local cluster.')
+    parser.add_argument('--vgg16_dir', required=True, help='The directory of the pretrained VGG-16 SavedModel.')
+    parser.add_argument('--num_classes', type=int, required=True, help='The number of segmentation classes.')
+    parser.add_argument('--image_dirs', nargs='+', required=True, help='The image directories.')
+    parser.add_argument('--ground_truth_dirs', nargs='+', required=True, help='The ground truth directories.')
+    parser.add_argument('--image_name_split_separator', default='leftImg8bit', help='See `BatchGenerator`.')
+    parser.add_argument('--ground_truth_suffix', default='gtFine_labelIds', help='See `BatchGenerator`.')
+    parser.add_argument('--num_workers', type=int, default=2, help='The number of worker processes. Defaults to 2.')
+    parser.add_argument('--num_steps', type=int, default=3, help='The number of synchronous training steps. Defaults to 3.')
+    parser.add_argument('--batch_size', type=int, default=2, help='The batch size of each worker. Defaults to 2.')
+    parser.add_argument('--image_size', type=int, nargs=2, default=[96, 160], help='The size `height width` to which the images are resized.')
+    parser.add_argument('--start_port', type=int, default=2222, help='The first of the consecutive ports of the processes.')
+    parser.add_argument('--timeout', type=float, default=600.0, help='The number of seconds to wait for the workers.')
+    parser.add_argument('--output_dir', default=None, help='Where to write the checkpoints and summaries. Defaults to a temporary directory that is deleted afterwards.')
+    args = parser.parse_args()
+
+    if args.num_workers < 2:
+        raise ValueError('`num_workers` must be at least 2, but is {}.'.format(args.num_workers))
+
+    output_dir = tempfile.mkdtemp() if args.output_dir is None else args.output_dir
+
+    cluster_spec = local_cluster_spec(num_workers=args.num_workers, num_ps=1, start_port=args.start_port)
+
+    # Each process needs its own TensorFlow runtime, which a forked process wouldn't get.
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+
+    parameter_server = context.Process(target=run_parameter_server, args=(cluster_spec, 0), daemon=True)
+    workers = [context.Process(target=_run_worker, args=(cluster_spec, task_index, args, output_dir, results))
+               for task_index in range(args.num_workers)]
+
+    parameter_server.start()
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join(timeout=args.timeout)
+
+        for task_index, worker in enumerate(workers):
+            assert worker.exitcode == 0, 'Worker {} failed with exit code {}.'.format(task_index, worker.exitcode)
+
+        steps = {}
+        for _ in workers:
+            task_index, initial_step, final_step = results.get(timeout=10)
+            steps[task_index] = (initial_step, final_step)
+
+        # 1: The global step advances once per synchronous step.
+        for task_index, (initial_step, final_step) in sorted(steps.items()):
+            assert final_step - initial_step == args.num_steps, \
+                'Worker {}: The global step advanced by {} in {} synchronous steps of {} workers.'.format(task_index, final_step - initial_step, args.num_steps, args.num_workers)
+
+        # 2: Only the chief writes checkpoints and summaries.
+        for task_index in range(args.num_workers):
+            worker_dir = os.path.join(output_dir, 'worker_{}'.format(task_index))
+            checkpoint_files = _list_files(os.path.join(worker_dir, 'checkpoints'))
+            summary_files = _list_files(os.path.join(worker_dir, 'summaries'))
+            if task_index == 0:
+                assert any(os.path.basename(path) == 'checkpoint' for path in checkpoint_files), 'The chief didn\'t write a checkpoint.'
+                assert any('tfevents' in os.path.basename(path) for path in summary_files), 'The chief didn\'t write any summaries.'
+            else:
+                assert len(checkpoint_files) == 0, 'Worker {} wrote checkpoints: {}'.format(task_index, checkpoint_files)
+                assert len(summary_files) == 0, 'Worker {} wrote summaries: {}'.format(task_index, summary_files)
+
+        print('The global step advanced by {} in {} synchronous steps of {} workers, and only the chief wrote checkpoints and summaries.'.format(
+            steps[0][1] - steps[0][0], args.num_steps, args.num_workers))
+
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        parameter_server.terminate()
+        if args.output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
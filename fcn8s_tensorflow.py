@@ -1,10 +1,10 @@
 from distutils.version import LooseVersion
 import tensorflow as tf
+from tensorflow.core.protobuf import saved_model_pb2
 import warnings
 from tqdm import trange
 import sys
 import os.path
-import scipy.misc
 import shutil
 from glob import glob
 from collections import deque
@@ -12,11 +12,13 @@ import numpy as np
 import time
 
 from helpers.tf_variable_summaries import add_variable_summaries
+from helpers.checkpoint_writer import CheckpointWriter
+from helpers.image_codecs import imread, imwrite, imresize
 from helpers.visualization_utils import print_segmentation_onto_image, create_split_view
 
 class FCN8s:
 
-    def __init__(self, model_load_dir=None, tags=None, vgg16_dir=None, num_classes=None, variables_load_dir=None):
+    def __init__(self, model_load_dir=None, tags=None, vgg16_dir=None, num_classes=None, variables_load_dir=None, sparse_labels=False, precision='float32', gradient_accumulation=False, devices=None, cluster_spec=None, task_index=0):
         '''
         Arguments:
             model_load_dir (string, optional): The directory path to a `SavedModel`, i.e. to the directory
@@ -32,6 +34,54 @@ class FCN8s:
                 The number of segmentation classes.
             variables_load_dir (string, optional): The path to variables that were saved with `tf.train.Saver`.
                 Only relevant if `model_load_dir` is `None`.
+            sparse_labels (bool, optional): Only relevant if no path to a saved FCN-8s model is given in `model_load_dir`.
+                If `True`, the model expects the ground truth data as integer label maps of shape
+                `(batch_size, height, width)` and dtype `uint8` that contain the class ID of each pixel,
+                and the loss and metrics are computed from the class IDs directly. This makes the ground truth
+                data `4 * num_classes` times smaller than in one-hot format. If `False`, the model expects
+                the ground truth data in one-hot format. For a loaded model, the format it was built with is used.
+                Defaults to `False`.
+            precision (string, optional): Only relevant if no path to a saved FCN-8s model is given in `model_load_dir`.
+                Either 'float32' or 'mixed'. If 'mixed', the decoder computes its activations in float16 while
+                keeping float32 master copies of its weights, and the optimizer uses dynamic loss scaling so that
+                small gradients don't underflow in float16. The pretrained VGG-16 encoder is loaded as it was saved
+                and therefore remains in float32. The loss and the softmax output are computed in float32 in either
+                case. Requires TensorFlow 1.10 or newer. For a loaded model, the precision it was built with is used.
+                Defaults to 'float32'.
+            gradient_accumulation (bool, optional): Only relevant if no path to a saved FCN-8s model is given in `model_load_dir`.
+                If `True`, the model gets one accumulator variable per trainable variable and separate operations
+                that add the gradients of a batch to the accumulators and that apply the averaged accumulated
+                gradients, which `train()` needs for `accumulation_steps > 1`. For a loaded model, it is used
+                if the model was built with it. Defaults to `False`.
+            devices (list, optional): Only relevant if no path to a saved FCN-8s model is given in `model_load_dir`.
+                `None` or a list of device names, e.g. `['/gpu:0', '/gpu:1']`. If a list is given, the model gets
+                one replica ("tower") of the encoder and the decoder per device. Each batch is split evenly among
+                the towers, each tower computes the gradients for its part of the batch, and the gradients are
+                averaged before they are applied. The towers share their variables, which live on the CPU.
+                Towers that get no images, e.g. for a last batch smaller than the number of towers, don't contribute
+                to the loss or the gradients. CPU devices such as `'/cpu:1'` are created
+                as virtual devices on the same CPU, so the towers can be tested without GPUs. When loading a saved
+                model that was built with towers, pass the same list so that the session provides its devices.
+                Defaults to `None`, meaning a single tower on the default device.
+            cluster_spec (dict, optional): Only relevant if no path to a saved FCN-8s model is given in `model_load_dir`.
+                `None` or a cluster specification for a synchronous distributed training, i.e. a dictionary that maps
+                the job names 'ps' and 'worker' to lists of `host:port` addresses, see `local_cluster_spec()`.
+                Each worker process builds its own model with its `task_index`, the variables live on the parameter
+                servers, which are started with `run_parameter_server()`. In each training step, the gradients of all
+                workers are averaged and applied once. The worker with `task_index` 0 is the chief: it initializes
+                (or loads, see `variables_load_dir`) the variables, and only the chief evaluates, saves, and records
+                summaries during training. Each worker should train on its own part of the dataset, see
+                `BatchGenerator.shard()`. For example, with one parameter server and two workers on one machine:
+
+                    cluster_spec = local_cluster_spec(num_workers=2)
+                    # In the parameter server process:
+                    run_parameter_server(cluster_spec)
+                    # In the worker process i (of 0 and 1):
+                    model = FCN8s(vgg16_dir=vgg16_dir, num_classes=num_classes, cluster_spec=cluster_spec, task_index=i)
+                    model.train(train_generator=batch_generator.shard(2, i).generate(...), ...)
+
+                Can't be combined with mixed precision, gradient accumulation, or `devices`. Defaults to `None`.
+            task_index (int, optional): Only relevant if `cluster_spec` is given. The index of this worker. Defaults to 0.
         '''
         # Check TensorFlow version
         assert LooseVersion(tf.__version__) >= LooseVersion('1.0'), 'This program requires TensorFlow version 1.0 or newer. You are using {}'.format(tf.__version__)
@@ -40,12 +90,30 @@ class FCN8s:
         if (model_load_dir is None) and (vgg16_dir is None or num_classes is None):
             raise ValueError("You must provide either both `model_load_dir` and `tags` or both `vgg16_dir` and `num_classes`.")
 
+        if not precision in ['float32', 'mixed']:
+            raise ValueError("`precision` must be either 'float32' or 'mixed', but is '{}'.".format(precision))
+
+        if (not devices is None) and (len(devices) == 0):
+            raise ValueError("`devices` must be `None` or a non-empty list of device names.")
+
+        if not cluster_spec is None:
+            if not model_load_dir is None:
+                raise ValueError("A distributed model must be built from scratch, use `variables_load_dir` to continue a training.")
+            if (precision == 'mixed') or gradient_accumulation or (not devices is None):
+                raise ValueError("`cluster_spec` can't be combined with mixed precision, gradient accumulation, or `devices`.")
+
         self.variables_load_dir = variables_load_dir
         self.model_load_dir = model_load_dir
         self.tags = tags
         self.vgg16_dir = vgg16_dir
         self.vgg16_tag = 'vgg16'
         self.num_classes = num_classes
+        self.sparse_labels = sparse_labels
+        self.precision = precision
+        self.gradient_accumulation = gradient_accumulation
+        self.devices = devices
+        self.cluster_spec = cluster_spec
+        self.is_chief = (task_index == 0) # Only the chief of a distributed training evaluates, saves, and records summaries.
 
         self.variables_updated = False # Keep track of whether any variable values changed since this model was last saved.
         self.eval_dataset = None # Which dataset to use for evaluation during training. Only relevant for training.
@@ -62,8 +130,25 @@ class FCN8s:
         self.training_loss = None
         self.best_training_loss = 99999999.9
 
-        self.sess = tf.Session()
+        device_setter = None # Only needed for a distributed model.
+        self.sync_optimizer = None # The optimizer that synchronizes the workers of a distributed model.
+
+        if not cluster_spec is None:
+            cluster = tf.train.ClusterSpec(cluster_spec)
+            self.num_workers = cluster.num_tasks('worker')
+            self.server = tf.train.Server(cluster, job_name='worker', task_index=task_index)
+            self.sess = tf.Session(target=self.server.target, config=tf.ConfigProto(allow_soft_placement=True))
+            # Place the variables on the parameter servers and all other operations on this worker.
+            device_setter = tf.train.replica_device_setter(worker_device='/job:worker/task:{}'.format(task_index), cluster=cluster)
+        elif devices is None:
+            self.sess = tf.Session()
+        else:
+            # Create as many virtual CPU devices as the towers need.
+            num_cpus = max([tf.DeviceSpec.from_string(device).device_index or 0 for device in devices
+                            if (tf.DeviceSpec.from_string(device).device_type or '').upper() == 'CPU'] + [0]) + 1
+            self.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True, device_count={'CPU': num_cpus}))
         self.g_step = None # The global step
+        self.dataset_handles = {} # The iterator handles of the `tf.data` datasets that have been fed to the model.
 
         ##################################################################
         # Load or build the model.
@@ -75,13 +160,40 @@ class FCN8s:
             graph = tf.get_default_graph()
 
             # Get the input and output ops.
-            self.image_input = graph.get_tensor_by_name('image_input:0')
+            try: # The model was built with an input pipeline for `tf.data` datasets.
+                self.dataset_handle = graph.get_tensor_by_name('input_pipeline/dataset_handle:0')
+                self.image_input = graph.get_tensor_by_name('input_pipeline/image_input:0')
+            except KeyError:
+                self.dataset_handle = None
+                self.image_input = graph.get_tensor_by_name('image_input:0')
             self.keep_prob = graph.get_tensor_by_name('keep_prob:0')
             self.fcn8s_output = graph.get_tensor_by_name('decoder/fcn8s_output:0')
+            self.tower_batch_sizes = None # Only needed to build the graph.
+            self.tower_outputs = None
             self.l2_regularization_rate = graph.get_tensor_by_name('l2_regularization_rate:0')
             self.labels = graph.get_tensor_by_name('labels_input:0')
+            self.sparse_labels = (self.labels.dtype == tf.uint8)
+            # Only models built with mixed precision cast the encoder outputs to float16.
+            if any(op.name.endswith('decoder/fc7_out_float16') for op in graph.get_operations()):
+                self.precision = 'mixed'
+            else:
+                self.precision = 'float32'
             self.total_loss = graph.get_tensor_by_name('optimizer/total_loss:0')
+            try:
+                self.per_image_loss = graph.get_tensor_by_name('optimizer/per_image_loss:0')
+            except KeyError: # The model was saved before the per-image loss existed.
+                self.per_image_loss = None
             self.train_op = graph.get_tensor_by_name('optimizer/train_op:0')
+            try:
+                self.accumulate_op = graph.get_operation_by_name('optimizer/accumulate_op')
+                self.apply_accumulated_op = graph.get_tensor_by_name('optimizer/apply_accumulated_op:0')
+                self.zero_accumulators_op = graph.get_operation_by_name('optimizer/zero_accumulators_op')
+                self.gradient_accumulation = True
+            except KeyError: # The model was built without gradient accumulation.
+                self.accumulate_op = None
+                self.apply_accumulated_op = None
+                self.zero_accumulators_op = None
+                self.gradient_accumulation = False
             self.learning_rate = graph.get_tensor_by_name('optimizer/learning_rate:0')
             self.global_step = graph.get_tensor_by_name('optimizer/global_step:0')
             self.softmax_output = graph.get_tensor_by_name('predictor/softmax_output:0')
@@ -99,59 +211,183 @@ class FCN8s:
             # For some reason that I don't understand, the local variables belonging to the
             # metrics need to be initialized after loading the model.
             self.sess.run(self.metrics_reset_op)
+            if self.gradient_accumulation:
+                self.sess.run(self.zero_accumulators_op)
 
         else: # Load only the pre-trained VGG-16 encoder and build the rest of the graph from scratch.
 
-            # Load the pretrained convolutionalized VGG-16 model as our encoder.
-            self.image_input, self.keep_prob, self.pool3_out, self.pool4_out, self.fc7_out = self._load_vgg16()
-            # Build the decoder on top of the VGG-16 encoder.
-            self.fcn8s_output, self.l2_regularization_rate = self._build_decoder()
-            # Build the part of the graph that is relevant for the training.
-            self.labels = tf.placeholder(dtype=tf.int32, shape=[None, None, None, self.num_classes], name='labels_input')
-            self.total_loss, self.train_op, self.learning_rate, self.global_step = self._build_optimizer()
-            # Add the prediction outputs.
-            self.softmax_output, self.predictions_argmax = self._build_predictor()
-            # Add metrics for evaluation.
-            self.mean_loss_value, self.mean_loss_update_op, self.mean_iou_value, self.mean_iou_update_op, self.acc_value, self.acc_update_op, self.metrics_reset_op = self._build_metrics()
-            # Add summary ops for TensorBoard.
-            self.summaries_training, self.summaries_evaluation = self._build_summary_ops()
-            # Initialize the global and local (for the metrics) variables.
-            self.sess.run(tf.global_variables_initializer())
-            self.sess.run(tf.local_variables_initializer())
+            with tf.device(device_setter):
+                # Build the input pipeline through which `tf.data` datasets can be fed to the model.
+                self.dataset_handle, self.image_input, dataset_labels = self._build_input_pipeline()
+                # The L2 regularization rate for the decoder kernels.
+                self.l2_regularization_rate = tf.placeholder(dtype=tf.float32, shape=[], name='l2_regularization_rate')
+                if devices is None:
+                    # Load the pretrained convolutionalized VGG-16 model as our encoder.
+                    self.keep_prob, pool3_out, pool4_out, fc7_out = self._load_vgg16(self.image_input)
+                    # Build the decoder on top of the VGG-16 encoder.
+                    self.fcn8s_output = self._build_decoder(pool3_out, pool4_out, fc7_out)
+                    self.tower_batch_sizes = None
+                    self.tower_outputs = None
+                else:
+                    # Build one encoder and decoder per device.
+                    self.keep_prob, self.fcn8s_output, self.tower_batch_sizes, self.tower_outputs = self._build_towers()
+                # Build the part of the graph that is relevant for the training.
+                # The labels come from the input pipeline unless they are being fed directly.
+                if self.sparse_labels:
+                    self.labels = tf.placeholder_with_default(dataset_labels, shape=[None, None, None], name='labels_input')
+                else:
+                    self.labels = tf.placeholder_with_default(tf.one_hot(dataset_labels, depth=self.num_classes, dtype=tf.int32),
+                                                              shape=[None, None, None, self.num_classes],
+                                                              name='labels_input')
+                self.total_loss, self.per_image_loss, self.train_op, self.accumulate_op, self.apply_accumulated_op, self.zero_accumulators_op, self.learning_rate, self.global_step = self._build_optimizer()
+                # Add the prediction outputs.
+                self.softmax_output, self.predictions_argmax = self._build_predictor()
+                # Add metrics for evaluation.
+                self.mean_loss_value, self.mean_loss_update_op, self.mean_iou_value, self.mean_iou_update_op, self.acc_value, self.acc_update_op, self.metrics_reset_op = self._build_metrics()
+                # Add summary ops for TensorBoard.
+                self.summaries_training, self.summaries_evaluation = self._build_summary_ops()
+            if cluster_spec is None:
+                # Initialize the global and local (for the metrics) variables.
+                self.sess.run(tf.global_variables_initializer())
+                self.sess.run(tf.local_variables_initializer())
+
+                # Maybe load variables.
+                if not variables_load_dir is None:
+                    saver = tf.train.Saver()
+                    saver.restore(self.sess, variables_load_dir)
+            else:
+                self._initialize_distributed_variables(variables_load_dir)
+
+    def _initialize_distributed_variables(self, variables_load_dir=None):
+        '''
+        Initializes the variables of a distributed model. The chief initializes (or loads) the
+        variables on the parameter servers, the other workers wait until it is done. Afterwards,
+        the chief starts the synchronization of the workers.
+        '''
 
-            # Maybe load variables.
+        if self.is_chief:
+            self.sess.run(tf.global_variables_initializer())
             if not variables_load_dir is None:
                 saver = tf.train.Saver()
                 saver.restore(self.sess, variables_load_dir)
+        else:
+            uninitialized_variables = tf.report_uninitialized_variables(tf.global_variables())
+            while len(self.sess.run(uninitialized_variables)) > 0:
+                print('Waiting for the chief to initialize the variables.')
+                time.sleep(1)
+
+        self.sess.run(tf.local_variables_initializer())
+        self.sess.run(self.sync_optimizer.local_step_init_op)
+
+        if self.is_chief:
+            self.sess.run(self.sync_optimizer.chief_init_op)
+            self.sess.run(self.sync_optimizer.get_init_tokens_op())
+            # This thread releases the workers into the next step once the gradients of a step have been applied.
+            self.sync_optimizer.get_chief_queue_runner().create_threads(self.sess, start=True, daemon=True)
+
+    def _build_input_pipeline(self):
+        '''
+        Builds the inputs of the model. The image and label inputs can either be fed directly,
+        or, if they aren't fed, they are read from the `tf.data` iterator whose string handle
+        is fed to the dataset handle placeholder.
+        '''
+
+        with tf.name_scope('input_pipeline'):
+
+            dataset_handle = tf.placeholder(dtype=tf.string, shape=[], name='dataset_handle')
+            # All datasets yield `uint8` images and `uint8` class ID label maps, see `data_generator.tf_data_pipeline`.
+            iterator = tf.data.Iterator.from_string_handle(string_handle=dataset_handle,
+                                                           output_types=(tf.uint8, tf.uint8),
+                                                           output_shapes=(tf.TensorShape([None, None, None, 3]),
+                                                                          tf.TensorShape([None, None, None])))
+            dataset_images, dataset_labels = iterator.get_next()
 
-    def _load_vgg16(self):
+            image_input = tf.placeholder_with_default(tf.cast(dataset_images, tf.float32), shape=[None, None, None, 3], name='image_input')
+
+        return dataset_handle, image_input, dataset_labels
+
+    def _load_vgg16(self, image_input):
         '''
-        Loads the pretrained, convolutionalized VGG-16 model into the session.
+        Loads the pretrained, convolutionalized VGG-16 model into the session and connects
+        its image input to `image_input`.
+
+        In a distributed model, only the chief restores the weights, into the variables on the
+        parameter servers. The other workers only import the graph, so that they don't overwrite
+        the shared variables while the chief initializes them or after the training started.
         '''
 
         # 1: Load the model
 
-        tf.saved_model.loader.load(sess=self.sess, tags=[self.vgg16_tag], export_dir=self.vgg16_dir)
+        if self.is_chief:
+            tf.saved_model.loader.load(sess=self.sess,
+                                       tags=[self.vgg16_tag],
+                                       export_dir=self.vgg16_dir,
+                                       input_map={'image_input:0': image_input})
+        else:
+            tf.train.import_meta_graph(_read_meta_graph_def(self.vgg16_dir, tags=[self.vgg16_tag]),
+                                       input_map={'image_input:0': image_input})
 
         # 2: Return the tensors of interest
 
         graph = tf.get_default_graph()
 
-        vgg16_image_input_tensor_name = 'image_input:0'
         vgg16_keep_prob_tensor_name = 'keep_prob:0'
         vgg16_pool3_out_tensor_name = 'layer3_out:0'
         vgg16_pool4_out_tensor_name = 'layer4_out:0'
         vgg16_fc7_out_tensor_name = 'layer7_out:0'
 
-        image_input = graph.get_tensor_by_name(vgg16_image_input_tensor_name)
         keep_prob = graph.get_tensor_by_name(vgg16_keep_prob_tensor_name)
         pool3_out = graph.get_tensor_by_name(vgg16_pool3_out_tensor_name)
         pool4_out = graph.get_tensor_by_name(vgg16_pool4_out_tensor_name)
         fc7_out = graph.get_tensor_by_name(vgg16_fc7_out_tensor_name)
 
-        return image_input, keep_prob, pool3_out, pool4_out, fc7_out
+        return keep_prob, pool3_out, pool4_out, fc7_out
+
+    def _build_towers(self):
+        '''
+        Builds one replica of the VGG-16 encoder and the FCN-8s decoder for each device in `self.devices`,
+        each of which processes its part of the batch.
+
+        The first encoder is loaded as usual, the others are copies of the operations between its input
+        and its outputs. Since the variables aren't part of these operations, all encoders share them.
+        The decoders share their variables through variable scope reuse.
+        '''
+
+        graph = tf.get_default_graph()
+        num_towers = len(self.devices)
+
+        with tf.name_scope('input_pipeline/'):
+            # Split the batch as evenly as possible, the first towers get one image more if necessary.
+            batch_size = tf.shape(self.image_input)[0]
+            tower_batch_sizes = tf.stack([(batch_size + num_towers - 1 - i) // num_towers for i in range(num_towers)], name='tower_batch_sizes')
+            tower_images = tf.split(self.image_input, tower_batch_sizes, num=num_towers)
+
+        tower_outputs = []
+
+        for i, device in enumerate(self.devices):
+
+            if i == 0:
+                with tf.device(_tower_device_function(device)):
+                    keep_prob, pool3_out, pool4_out, fc7_out = self._load_vgg16(tower_images[0])
+                encoder_outputs = [pool3_out, pool4_out, fc7_out]
+            else:
+                existing_ops = set(graph.get_operations())
+                pool3_out, pool4_out, fc7_out = tf.contrib.graph_editor.graph_replace(encoder_outputs,
+                                                                                      {tower_images[0]: tower_images[i]},
+                                                                                      dst_scope='tower_{}'.format(i))
+                # The copies keep the device of the original operations.
+                for op in set(graph.get_operations()) - existing_ops:
+                    op._set_device(device)
+
+            with tf.device(_tower_device_function(device)), tf.name_scope('tower_{}/'.format(i)), tf.variable_scope(tf.get_variable_scope(), reuse=(i > 0), auxiliary_name_scope=False):
+                tower_outputs.append(self._build_decoder(pool3_out, pool4_out, fc7_out))
+
+        with tf.name_scope('decoder'):
+            fcn8s_output = tf.concat(tower_outputs, axis=0, name='fcn8s_output')
+
+        return keep_prob, fcn8s_output, tower_batch_sizes, tower_outputs
 
-    def _build_decoder(self):
+    def _build_decoder(self, pool3_out, pool4_out, fc7_out):
         '''
         Builds the FCN-8s decoder given the pool3, pool4, and fc7 outputs of the VGG-16 encoder.
         '''
@@ -159,16 +395,27 @@ class FCN8s:
         stddev_1x1 = 0.001 # Standard deviation for the 1x1 kernel initializers
         stddev_conv2d_trans = 0.01 # Standard deviation for the convolution transpose kernel initializers
 
-        l2_regularization_rate = tf.placeholder(dtype=tf.float32, shape=[], name='l2_regularization_rate') # L2 regularization rate for the kernels
+        l2_regularization_rate = self.l2_regularization_rate
 
-        with tf.name_scope('decoder'):
+        if self.precision == 'mixed':
+            # The layers create their variables through `_float32_variable_storage_getter()`, so they see float16
+            # copies of float32 variables. The regularization losses are computed from float32 copies of the kernels.
+            custom_getter = _float32_variable_storage_getter
+            kernel_regularizer = lambda kernel: tf.contrib.layers.l2_regularizer(l2_regularization_rate)(tf.cast(kernel, tf.float32))
+        else:
+            custom_getter = None
+            kernel_regularizer = tf.contrib.layers.l2_regularizer(l2_regularization_rate)
+
+        with tf.name_scope('decoder'), tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter, auxiliary_name_scope=False):
 
             # 1: Append 1x1 convolutions to the three output layers of the encoder to reduce the Number
             #    of channels to the number of classes.
 
             # The outputs of pool3 and pool4 are being scaled in what the authors of
             # the paper call the at-once training approach.
-            pool3_out_scaled = tf.multiply(self.pool3_out, 0.0001, name='pool3_out_scaled')
+            pool3_out_scaled = tf.multiply(pool3_out, 0.0001, name='pool3_out_scaled')
+            if self.precision == 'mixed': # Cast after scaling so that large activations don't overflow in float16.
+                pool3_out_scaled = tf.cast(pool3_out_scaled, tf.float16, name='pool3_out_float16')
 
             pool3_1x1 = tf.layers.conv2d(inputs=pool3_out_scaled,
                                          filters=self.num_classes,
@@ -176,10 +423,12 @@ class FCN8s:
                                          strides=(1, 1),
                                          padding='same',
                                          kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_1x1),
-                                         kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                         kernel_regularizer=kernel_regularizer,
                                          name='pool3_1x1')
 
-            pool4_out_scaled = tf.multiply(self.pool4_out, 0.01, name='pool4_out_scaled')
+            pool4_out_scaled = tf.multiply(pool4_out, 0.01, name='pool4_out_scaled')
+            if self.precision == 'mixed':
+                pool4_out_scaled = tf.cast(pool4_out_scaled, tf.float16, name='pool4_out_float16')
 
             pool4_1x1 = tf.layers.conv2d(inputs=pool4_out_scaled,
                                          filters=self.num_classes,
@@ -187,16 +436,19 @@ class FCN8s:
                                          strides=(1, 1),
                                          padding='same',
                                          kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_1x1),
-                                         kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                         kernel_regularizer=kernel_regularizer,
                                          name='pool4_1x1')
 
-            fc7_1x1 = tf.layers.conv2d(inputs=self.fc7_out,
+            if self.precision == 'mixed':
+                fc7_out = tf.cast(fc7_out, tf.float16, name='fc7_out_float16')
+
+            fc7_1x1 = tf.layers.conv2d(inputs=fc7_out,
                                        filters=self.num_classes,
                                        kernel_size=(1, 1),
                                        strides=(1, 1),
                                        padding='same',
                                        kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_1x1),
-                                       kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                       kernel_regularizer=kernel_regularizer,
                                        name='fc7_1x1')
 
             # 2: Upscale and fuse until we're back at the original image size.
@@ -207,7 +459,7 @@ class FCN8s:
                                                           strides=(2, 2),
                                                           padding='same',
                                                           kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_conv2d_trans),
-                                                          kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                                          kernel_regularizer=kernel_regularizer,
                                                           name='fc7_conv2d_trans')
 
             add_fc7_pool4 = tf.add(fc7_conv2d_trans, pool4_1x1, name='add_fc7_pool4')
@@ -218,7 +470,7 @@ class FCN8s:
                                                                 strides=(2, 2),
                                                                 padding='same',
                                                                 kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_conv2d_trans),
-                                                                kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                                                kernel_regularizer=kernel_regularizer,
                                                                 name='fc7_pool4_conv2d_trans')
 
             add_fc7_pool4_pool3 = tf.add(fc7_pool4_conv2d_trans, pool3_1x1, name='add_fc7_pool4_pool3')
@@ -229,12 +481,15 @@ class FCN8s:
                                                                       strides=(8, 8),
                                                                       padding='same',
                                                                       kernel_initializer=tf.truncated_normal_initializer(stddev=stddev_conv2d_trans),
-                                                                      kernel_regularizer=tf.contrib.layers.l2_regularizer(l2_regularization_rate),
+                                                                      kernel_regularizer=kernel_regularizer,
                                                                       name='fc7_pool4_pool3_conv2d_trans')
 
+            if self.precision == 'mixed': # Compute the softmax and the loss in float32.
+                fc7_pool4_pool3_conv2d_trans = tf.cast(fc7_pool4_pool3_conv2d_trans, tf.float32, name='fc7_pool4_pool3_conv2d_trans_float32')
+
             fcn8s_output = tf.identity(fc7_pool4_pool3_conv2d_trans, name='fcn8s_output')
 
-        return fc7_pool4_pool3_conv2d_trans, l2_regularization_rate
+        return fc7_pool4_pool3_conv2d_trans
 
     def _build_optimizer(self):
         '''
@@ -249,14 +504,97 @@ class FCN8s:
             # Compute the regularizatin loss.
             regularization_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES) # This is a list of the individual loss values, so we still need to sum them up.
             regularization_loss = tf.add_n(regularization_losses, name='regularization_loss') # Scalar
-            # Compute the total loss.
-            approximation_loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=self.labels, logits=self.fcn8s_output), name='approximation_loss') # Scalar
-            total_loss = tf.add(approximation_loss, regularization_loss, name='total_loss')
-            # Compute the gradients and apply them.
+            # Create the optimizer.
             optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate, name='adam_optimizer')
-            train_op = optimizer.minimize(total_loss, global_step=global_step, name='train_op')
+            if self.precision == 'mixed':
+                # Scale the loss up before computing the gradients and the gradients back down before applying them.
+                # Steps whose gradients overflow are skipped and halve the scale, the scale doubles after 1000 good steps.
+                loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale=2**15,
+                                                                                                  incr_every_n_steps=1000)
+                optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, loss_scale_manager)
+            if not self.cluster_spec is None:
+                # Aggregate the gradients of all workers and apply their average once per step.
+                optimizer = tf.train.SyncReplicasOptimizer(optimizer,
+                                                           replicas_to_aggregate=self.num_workers,
+                                                           total_num_replicas=self.num_workers)
+                self.sync_optimizer = optimizer
+            # Compute the total loss and the gradients.
+            if self.devices is None:
+                cross_entropy = self._cross_entropy(self.labels, self.fcn8s_output)
+                approximation_loss = tf.reduce_mean(cross_entropy, name='approximation_loss') # Scalar
+                per_image_loss = tf.reduce_mean(cross_entropy, axis=[1, 2], name='per_image_loss') # 1D tensor of shape `(batch_size,)`
+                total_loss = tf.add(approximation_loss, regularization_loss, name='total_loss')
+                grads_and_vars = [(gradient, variable) for gradient, variable in optimizer.compute_gradients(total_loss) if not gradient is None]
+            else:
+                # Each tower computes the loss and the gradients for its part of the batch on its device.
+                # Both are averaged weighted by the number of images of each tower, which yields the same
+                # result as a single tower would for the whole batch.
+                tower_weights = tf.cast(self.tower_batch_sizes, tf.float32) / tf.cast(tf.reduce_sum(self.tower_batch_sizes), tf.float32)
+                tower_labels = tf.split(self.labels, self.tower_batch_sizes, num=len(self.devices))
+                tower_losses = []
+                tower_per_image_losses = []
+                tower_grads_and_vars = []
+                for i, device in enumerate(self.devices):
+                    with tf.device(device), tf.name_scope('tower_{}'.format(i)):
+                        cross_entropy = self._cross_entropy(tower_labels[i], self.tower_outputs[i])
+                        # The mean of an empty tower would be NaN, which its weight of 0 doesn't cancel, so its loss is 0 instead.
+                        tower_loss = tf.reduce_sum(cross_entropy) / tf.maximum(tf.cast(tf.size(cross_entropy), cross_entropy.dtype), 1.0)
+                        tower_losses.append(tower_loss)
+                        tower_per_image_losses.append(tf.reduce_mean(cross_entropy, axis=[1, 2]))
+                        tower_grads_and_vars.append(optimizer.compute_gradients(tower_loss + regularization_loss, colocate_gradients_with_ops=True))
+                approximation_loss = tf.reduce_sum(tower_weights * tf.stack(tower_losses), name='approximation_loss') # Scalar
+                per_image_loss = tf.concat(tower_per_image_losses, axis=0, name='per_image_loss') # 1D tensor of shape `(batch_size,)`
+                total_loss = tf.add(approximation_loss, regularization_loss, name='total_loss')
+                grads_and_vars = _average_gradients(tower_grads_and_vars, tower_weights)
+            # Apply the gradients.
+            train_op = self._apply_gradients(optimizer, grads_and_vars, global_step, name='train_op')
+
+            if self.gradient_accumulation:
+                # Sum up the gradients of several batches in non-trainable accumulator variables and
+                # apply their average in a separate step, which also resets the accumulators. They are
+                # local variables, so that they are neither saved nor restored with the model weights.
+                accumulators = [tf.Variable(tf.zeros(variable.get_shape(), dtype=variable.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accumulator') for _, variable in grads_and_vars]
+                accumulation_count = tf.Variable(0.0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accumulation_count')
+                accumulate_op = tf.group(*([accumulator.assign_add(gradient) for accumulator, (gradient, _) in zip(accumulators, grads_and_vars)] +
+                                           [accumulation_count.assign_add(1.0)]),
+                                         name='accumulate_op')
+                # Like the metrics' variables, the accumulators need to be initialized after loading the model, so zeroing them re-runs their initializers.
+                zero_accumulators_op = tf.variables_initializer(var_list=accumulators + [accumulation_count], name='zero_accumulators_op')
+                accumulated_grads_and_vars = [(accumulator / accumulation_count, variable) for accumulator, (_, variable) in zip(accumulators, grads_and_vars)]
+                apply_op = self._apply_gradients(optimizer, accumulated_grads_and_vars, global_step, name='apply_accumulated_gradients')
+                with tf.control_dependencies([apply_op]):
+                    reset_op = tf.group(*([accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators] +
+                                          [accumulation_count.assign(0.0)]))
+                with tf.control_dependencies([reset_op]):
+                    apply_accumulated_op = tf.identity(apply_op, name='apply_accumulated_op')
+            else:
+                accumulate_op = None
+                apply_accumulated_op = None
+                zero_accumulators_op = None
+
+        return total_loss, per_image_loss, train_op, accumulate_op, apply_accumulated_op, zero_accumulators_op, learning_rate, global_step
 
-        return total_loss, train_op, learning_rate, global_step
+    def _cross_entropy(self, labels, logits):
+        '''
+        Returns the cross-entropy loss of each pixel.
+        '''
+        if self.sparse_labels:
+            return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.cast(labels, tf.int32), logits=logits)
+        else:
+            return tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits)
+
+    def _apply_gradients(self, optimizer, grads_and_vars, global_step, name):
+        '''
+        Applies the gradients and returns a tensor named `name` that holds the updated global step.
+        '''
+        if (self.precision == 'mixed') or (not self.cluster_spec is None):
+            # The loss scale optimizer only returns an operation and the synchronizing optimizer
+            # doesn't name its result, so read the global step after the update.
+            update_op = optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+            with tf.control_dependencies([update_op]):
+                return tf.identity(global_step.read_value(), name=name)
+        else:
+            return optimizer.apply_gradients(grads_and_vars, global_step=global_step, name=name)
 
     def _build_predictor(self):
         '''
@@ -277,7 +615,10 @@ class FCN8s:
 
         with tf.variable_scope('metrics') as scope:
 
-            labels_argmax = tf.argmax(self.labels, axis=-1, name='labels_argmax', output_type=tf.int64)
+            if self.sparse_labels:
+                labels_argmax = tf.cast(self.labels, tf.int64, name='labels_argmax')
+            else:
+                labels_argmax = tf.argmax(self.labels, axis=-1, name='labels_argmax', output_type=tf.int64)
 
             # 1: Mean loss
 
@@ -396,6 +737,34 @@ class FCN8s:
             self.metric_update_ops.append(self.acc_update_op)
             self.metric_value_tensors.append(self.acc_value)
 
+    def _get_dataset_handle(self, dataset):
+        '''
+        Returns the string handle of the iterator for `dataset`. Each dataset gets one iterator,
+        so that switching between datasets, e.g. for evaluation during training, doesn't restart them.
+        '''
+
+        if self.dataset_handle is None:
+            raise ValueError("This model was built without an input pipeline for `tf.data` datasets, use a Python generator instead.")
+
+        if not dataset in self.dataset_handles:
+            iterator = dataset.make_one_shot_iterator()
+            self.dataset_handles[dataset] = self.sess.run(iterator.string_handle())
+
+        return self.dataset_handles[dataset]
+
+    def _get_batch_feed_dict(self, data):
+        '''
+        Returns the part of a feed dictionary that provides the next batch of images and labels
+        from `data`, which is either a Python generator or a `tf.data.Dataset`.
+        '''
+
+        if isinstance(data, tf.data.Dataset):
+            return {self.dataset_handle: self._get_dataset_handle(data)}
+        else:
+            batch_images, batch_labels = next(data)
+            return {self.image_input: batch_images,
+                    self.labels: batch_labels}
+
     def train(self,
               train_generator,
               epochs,
@@ -420,17 +789,25 @@ class FCN8s:
               summaries_frequency=10,
               summaries_dir=None,
               summaries_name=None,
-              training_loss_display_averaging=3):
+              training_loss_display_averaging=3,
+              loss_feedback=None,
+              accumulation_steps=1,
+              async_saving=False,
+              keep_last_saves=None):
         '''
         Trains the model.
 
         Arguments:
             train_generator (generator): A generator that yields batches of images
-                and associated ground truth images in two separate Numpy arrays.
+                and associated ground truth images in two separate Numpy arrays, or
+                a repeating `tf.data.Dataset` as built by `data_generator.tf_data_pipeline.build_dataset()`.
+                A dataset yields the ground truth data as class IDs regardless of the format below.
                 The images must be a 4D array with format `(batch_size, height, width, channels)`
                 and the ground truth images must be a 4D array with format
                 `(batch_size, height, width, num_classes)`, i.e. the ground truth
-                data must be provided in one-hot format.
+                data must be provided in one-hot format, or, if the model was built
+                with `sparse_labels=True`, a 3D array of class IDs with format
+                `(batch_size, height, width)`.
             epochs (int): The number of epochs to run the training for, where each epoch
                 consists of `steps_per_epoch` training steps.
             steps_per_epoch (int): The number of training steps (i.e. batches processed)
@@ -448,8 +825,8 @@ class FCN8s:
                 but should be set to 'val' if a validation dataset is available.
             eval_frequency (int, optional): The model will be evaluated on `metrics` after every
                 `eval_frequency` epochs. Defaults to 5.
-            val_generator (generator, optional): An optional second generator for a second
-                dataset (validation dataset), works the same way as `train_generator`.
+            val_generator (generator, optional): An optional second generator (or `tf.data.Dataset`)
+                for a second dataset (validation dataset), works the same way as `train_generator`.
             val_steps (int, optional): The number of steps to run `val_generator` for
                 during evaluation.
             metrics (set, optional): The metrics to be evaluated during training. A Python
@@ -500,6 +877,24 @@ class FCN8s:
                 allows to average the displayed loss over tha lasst `training_loss_display_averaging`
                 training steps so that it shows a more representative picture of the actual
                 current loss. Defaults to 3.
+            loss_feedback (function, optional): `None` or a function that is called after every training step
+                with a 1D Numpy array that contains the loss of each image of the batch that was just trained on
+                (without regularization). Use this to report the losses back to a sampler that focuses on hard
+                examples, e.g. pass `sampler.report_losses` of a sampler from `data_generator.samplers` that
+                `train_generator` was created with. Requires that `train_generator` is a Python generator.
+            accumulation_steps (int, optional): The number of batches whose gradients are averaged before each
+                update of the weights. Each training step then consumes `accumulation_steps` batches, so the
+                effective batch size is `accumulation_steps` times the batch size of `train_generator`, while
+                memory is only needed for one batch. The global step, the learning rate schedule and the summaries
+                advance once per training step, i.e. per update. Values greater than 1 require a model built with
+                `gradient_accumulation=True`. Defaults to 1.
+            async_saving (bool, optional): If `True`, saving the model during training only takes a snapshot
+                of the variables, and a background thread writes it to disk while the training continues,
+                see `helpers.checkpoint_writer.CheckpointWriter`. At most one snapshot is pending at a time.
+                `train()` waits for the last write to finish before it returns or raises. Defaults to `False`.
+            keep_last_saves (int, optional): Only relevant if `async_saving` is `True`. `None` or the number of
+                most recent models saved during this training to keep. Older ones are deleted, except for
+                the one with the best value of `monitor`. If `None`, all saved models are kept.
         '''
 
         # Check for a GPU
@@ -521,8 +916,30 @@ class FCN8s:
         if (not monitor in metrics) and (not monitor == 'loss'):
             raise ValueError('You are trying to monitor {}, but it is not in `metrics` and is therefore not being computed.'.format(monitor))
 
+        if not self.is_chief:
+            # In a distributed training, the other workers only train.
+            metrics = {}
+            save_during_training = False
+            record_summaries = False
+
+        if not loss_feedback is None:
+            if isinstance(train_generator, tf.data.Dataset):
+                raise ValueError("`loss_feedback` requires that `train_generator` is a Python generator.")
+            if self.per_image_loss is None:
+                raise ValueError("`loss_feedback` is not supported by this model, because it was saved without a per-image loss.")
+
+        if accumulation_steps < 1:
+            raise ValueError("`accumulation_steps` must be at least 1, but is {}.".format(accumulation_steps))
+
+        if (accumulation_steps > 1) and (not self.gradient_accumulation):
+            raise ValueError("`accumulation_steps > 1` requires a model that was built with `gradient_accumulation=True`.")
+
         self.eval_dataset = eval_dataset
 
+        # Discard any gradients that an interrupted previous training left in the accumulators.
+        if self.gradient_accumulation:
+            self.sess.run(self.zero_accumulators_op)
+
         self.g_step = self.sess.run(self.global_step)
         learning_rate = learning_rate_schedule(self.g_step)
 
@@ -535,127 +952,174 @@ class FCN8s:
             if len(metrics) > 0:
                 evaluation_writer = tf.summary.FileWriter(logdir=os.path.join(summaries_dir, summaries_name+'_eval'))
 
-        for epoch in range(1, epochs+1):
+        if save_during_training and async_saving:
+            checkpoint_writer = CheckpointWriter(keep_last=keep_last_saves,
+                                                 monitor_mode=('min' if monitor == 'loss' else 'max'))
+        else:
+            checkpoint_writer = None
 
-            ##############################################################
-            # Run the training for this epoch.
-            ##############################################################
+        try:
+            for epoch in range(1, epochs+1):
 
-            loss_history = deque(maxlen=training_loss_display_averaging)
+                ##############################################################
+                # Run the training for this epoch.
+                ##############################################################
 
-            tr = trange(steps_per_epoch, file=sys.stdout)
-            tr.set_description('Epoch {}/{}'.format(epoch, epochs))
+                loss_history = deque(maxlen=training_loss_display_averaging)
 
-            for train_step in tr:
+                tr = trange(steps_per_epoch, file=sys.stdout)
+                tr.set_description('Epoch {}/{}'.format(epoch, epochs))
 
-                batch_images, batch_labels = next(train_generator)
+                for train_step in tr:
 
-                if record_summaries and (self.g_step % summaries_frequency == 0):
-                    _, current_loss, self.g_step, training_summary = self.sess.run([self.train_op,
-                                                                                    self.total_loss,
-                                                                                    self.global_step,
-                                                                                    self.summaries_training],
-                                                                                   feed_dict={self.image_input: batch_images,
-                                                                                              self.labels: batch_labels,
-                                                                                              self.learning_rate: learning_rate,
-                                                                                              self.keep_prob: keep_prob,
-                                                                                              self.l2_regularization_rate: l2_regularization})
-                    training_writer.add_summary(summary=training_summary, global_step=self.g_step)
-                else:
-                    _, current_loss, self.g_step = self.sess.run([self.train_op,
-                                                                  self.total_loss,
-                                                                  self.global_step],
-                                                                 feed_dict={self.image_input: batch_images,
-                                                                            self.labels: batch_labels,
-                                                                            self.learning_rate: learning_rate,
-                                                                            self.keep_prob: keep_prob,
-                                                                            self.l2_regularization_rate: l2_regularization})
-
-                self.variables_updated = True
-
-                loss_history.append(current_loss)
-                losses = np.array(loss_history)
-                self.training_loss = np.mean(losses)
-
-                tr.set_postfix(ordered_dict={'loss': self.training_loss,
-                                             'learning rate': learning_rate})
-
-                learning_rate = learning_rate_schedule(self.g_step)
-
-            ##############################################################
-            # Maybe evaluate the model after this epoch.
-            ##############################################################
-
-            if (len(metrics) > 0) and (epoch % eval_frequency == 0):
-
-                if eval_dataset == 'train':
-                    data_generator = train_generator
-                    num_batches = steps_per_epoch
-                    description = 'Evaluation on training dataset'
-                elif eval_dataset == 'val':
-                    data_generator = val_generator
-                    num_batches = val_steps
-                    description = 'Evaluation on validation dataset'
-
-                self._evaluate(data_generator=data_generator,
-                               metrics=metrics,
-                               num_batches=num_batches,
-                               l2_regularization=l2_regularization,
-                               description=description)
-
-                if record_summaries:
-                    evaluation_summary = self.sess.run(self.summaries_evaluation)
-                    evaluation_writer.add_summary(summary=evaluation_summary, global_step=self.g_step)
-
-            ##############################################################
-            # Maybe save the model after this epoch.
-            ##############################################################
-
-            if save_during_training and (epoch % save_frequency == 0):
-
-                save = False
-                if save_best_only:
-                    if (monitor == 'loss' and
-                        (not 'loss' in self.metric_names) and
-                        self.training_loss < self.best_training_loss):
-                        save = True
+                    feed_dict = {self.learning_rate: learning_rate,
+                                 self.keep_prob: keep_prob,
+                                 self.l2_regularization_rate: l2_regularization}
+
+                    record_summary = record_summaries and (self.g_step % summaries_frequency == 0)
+
+                    if accumulation_steps == 1:
+                        self.g_step, current_loss, summary = self._run_training_batch(train_generator, self.train_op, feed_dict, loss_feedback, record_summary)
                     else:
-                        i = self.metric_names.index(monitor)
-                        if (monitor == 'loss') and (self.metric_values[i] < self.best_metric_values[i]):
-                            save = True
-                        elif (monitor in ['accuracry', 'mean_iou']) and (self.metric_values[i] > self.best_metric_values[i]):
+                        # Accumulate the gradients of several batches, recording the summaries along with the last one, then apply them.
+                        batch_losses = []
+                        for accumulation_step in range(accumulation_steps):
+                            _, batch_loss, summary = self._run_training_batch(train_generator,
+                                                                              self.accumulate_op,
+                                                                              feed_dict,
+                                                                              loss_feedback,
+                                                                              record_summary and (accumulation_step == accumulation_steps - 1))
+                            batch_losses.append(batch_loss)
+                        current_loss = np.mean(batch_losses)
+                        self.g_step = self.sess.run(self.apply_accumulated_op, feed_dict={self.learning_rate: learning_rate})
+
+                    if record_summary:
+                        training_writer.add_summary(summary=summary, global_step=self.g_step)
+
+                    self.variables_updated = True
+
+                    loss_history.append(current_loss)
+                    losses = np.array(loss_history)
+                    self.training_loss = np.mean(losses)
+
+                    tr.set_postfix(ordered_dict={'loss': self.training_loss,
+                                                 'learning rate': learning_rate})
+
+                    learning_rate = learning_rate_schedule(self.g_step)
+
+                ##############################################################
+                # Maybe evaluate the model after this epoch.
+                ##############################################################
+
+                if (len(metrics) > 0) and (epoch % eval_frequency == 0):
+
+                    if eval_dataset == 'train':
+                        data_generator = train_generator
+                        num_batches = steps_per_epoch
+                        description = 'Evaluation on training dataset'
+                    elif eval_dataset == 'val':
+                        data_generator = val_generator
+                        num_batches = val_steps
+                        description = 'Evaluation on validation dataset'
+
+                    self._evaluate(data_generator=data_generator,
+                                   metrics=metrics,
+                                   num_batches=num_batches,
+                                   l2_regularization=l2_regularization,
+                                   description=description)
+
+                    if record_summaries:
+                        evaluation_summary = self.sess.run(self.summaries_evaluation)
+                        evaluation_writer.add_summary(summary=evaluation_summary, global_step=self.g_step)
+
+                ##############################################################
+                # Maybe save the model after this epoch.
+                ##############################################################
+
+                if save_during_training and (epoch % save_frequency == 0):
+
+                    save = False
+                    if save_best_only:
+                        if (monitor == 'loss' and
+                            (not 'loss' in self.metric_names) and
+                            self.training_loss < self.best_training_loss):
                             save = True
-                    if save:
-                        print('New best {} value, saving model.'.format(monitor))
+                        else:
+                            i = self.metric_names.index(monitor)
+                            if (monitor == 'loss') and (self.metric_values[i] < self.best_metric_values[i]):
+                                save = True
+                            elif (monitor in ['accuracry', 'mean_iou']) and (self.metric_values[i] > self.best_metric_values[i]):
+                                save = True
+                        if save:
+                            print('New best {} value, saving model.'.format(monitor))
+                        else:
+                            print('No improvement over previous best {} value, not saving model.'.format(monitor))
                     else:
-                        print('No improvement over previous best {} value, not saving model.'.format(monitor))
-                else:
-                    save = True
+                        save = True
+
+                    if save:
+                        if monitor in self.metric_names:
+                            monitor_value = self.metric_values[self.metric_names.index(monitor)]
+                        else:
+                            monitor_value = self.training_loss
+                        self.save(model_save_dir=save_dir,
+                                  saver=saver,
+                                  tags=save_tags,
+                                  name=save_name,
+                                  include_global_step=True,
+                                  include_last_training_loss=True,
+                                  include_metrics=(len(self.metric_names) > 0),
+                                  checkpoint_writer=checkpoint_writer,
+                                  monitor_value=monitor_value)
+
+
+                ##############################################################
+                # Update the current best metric values.
+                ##############################################################
+
+                if self.training_loss < self.best_training_loss:
+                    self.best_training_loss = self.training_loss
+
+                if epoch % eval_frequency == 0:
+
+                    for i, metric_name in enumerate(self.metric_names):
+                        if (metric_name == 'loss') and (self.metric_values[i] < self.best_metric_values[i]):
+                            self.best_metric_values[i] = self.metric_values[i]
+                        elif (metric_name in ['accuracry', 'mean_iou']) and (self.metric_values[i] > self.best_metric_values[i]):
+                            self.best_metric_values[i] = self.metric_values[i]
+
+        finally:
+            # Wait for the last models to be written, also if the training is interrupted.
+            if not checkpoint_writer is None:
+                checkpoint_writer.close()
+
+    def _run_training_batch(self, train_generator, op, feed_dict, loss_feedback=None, record_summary=False):
+        '''
+        Runs `op` on the next batch of `train_generator`, used by `train()`.
 
-                if save:
-                    self.save(model_save_dir=save_dir,
-                              saver=saver,
-                              tags=save_tags,
-                              name=save_name,
-                              include_global_step=True,
-                              include_last_training_loss=True,
-                              include_metrics=(len(self.metric_names) > 0))
+        Arguments:
+            feed_dict (dict): The feed dictionary without the batch.
+            loss_feedback (function, optional): See `train()`.
+            record_summary (bool, optional): Whether to also compute the training summaries.
 
+        Returns:
+            A tuple `(op_value, loss, summary)`, where `summary` is `None` if `record_summary` is `False`.
+        '''
+        feed_dict = dict(feed_dict)
+        feed_dict.update(self._get_batch_feed_dict(train_generator))
 
-            ##############################################################
-            # Update the current best metric values.
-            ##############################################################
+        fetches = [op, self.total_loss]
+        if not loss_feedback is None:
+            fetches.append(self.per_image_loss)
+        if record_summary:
+            fetches.append(self.summaries_training)
 
-            if self.training_loss < self.best_training_loss:
-                self.best_training_loss = self.training_loss
+        results = self.sess.run(fetches, feed_dict=feed_dict)
 
-            if epoch % eval_frequency == 0:
+        if not loss_feedback is None:
+            loss_feedback(results[2])
 
-                for i, metric_name in enumerate(self.metric_names):
-                    if (metric_name == 'loss') and (self.metric_values[i] < self.best_metric_values[i]):
-                        self.best_metric_values[i] = self.metric_values[i]
-                    elif (metric_name in ['accuracry', 'mean_iou']) and (self.metric_values[i] > self.best_metric_values[i]):
-                        self.best_metric_values[i] = self.metric_values[i]
+        return results[0], results[1], (results[-1] if record_summary else None)
 
     def _evaluate(self, data_generator, metrics, num_batches, l2_regularization, description='Running evaluation'):
         '''
@@ -680,13 +1144,11 @@ class FCN8s:
         # Accumulate metrics in batches.
         for step in tr:
 
-            batch_images, batch_labels = next(data_generator)
+            feed_dict = self._get_batch_feed_dict(data_generator)
+            feed_dict.update({self.keep_prob: 1.0,
+                              self.l2_regularization_rate: l2_regularization})
 
-            self.sess.run(self.metric_update_ops,
-                          feed_dict={self.image_input: batch_images,
-                                     self.labels: batch_labels,
-                                     self.keep_prob: 1.0,
-                                     self.l2_regularization_rate: l2_regularization})
+            self.sess.run(self.metric_update_ops, feed_dict=feed_dict)
 
         # Compute final metric values.
         self.metric_values = self.sess.run(self.metric_value_tensors)
@@ -702,11 +1164,14 @@ class FCN8s:
 
         Arguments:
             data_generator (generator): A generator that yields batches of images
-                and associated ground truth images in two separate Numpy arrays.
+                and associated ground truth images in two separate Numpy arrays, or
+                a repeating `tf.data.Dataset` as built by `data_generator.tf_data_pipeline.build_dataset()`.
                 The images must be a 4D array with format `(batch_size, height, width, channels)`
                 and the ground truth images must be a 4D array with format
                 `(batch_size, height, width, num_classes)`, i.e. the ground truth
-                data must be provided in one-hot format. The generator's batch size
+                data must be provided in one-hot format, or, if the model was built
+                with `sparse_labels=True`, a 3D array of class IDs with format
+                `(batch_size, height, width)`. The generator's batch size
                 has no effect on the outcome of the evaluation.
             num_batches (int): The number of batches to evaluate the model on.
                 Typically this will be the number of batches such that the model
@@ -747,7 +1212,9 @@ class FCN8s:
         Arguments:
             images (array-like): The input image or images. Must be an array-like
                 object of rank 4. If predicting only one image, encapsulate it in
-                a Python list.
+                a Python list. Can also be a finite `tf.data.Dataset` as built by
+                `data_generator.tf_data_pipeline.build_dataset()` with `repeat=False`,
+                in which case predictions are made for all of its batches.
             argmax (bool, optional): If `True`, the model predicts class IDs,
                 i.e. the last dimension has length 1 and an integer between
                 zero and `num_classes - 1` for each pixel. Otherwise, the model
@@ -758,14 +1225,37 @@ class FCN8s:
         Returns:
             The prediction, an array of rank 4 of which the first three dimensions
             are identical to the input and the fourth dimension is as described
-            in `argmax`.
+            in `argmax`. If `images` is a dataset, a list with one such prediction
+            per batch.
         '''
         if argmax:
-            return self.sess.run(self.predictions_argmax,
-                                 feed_dict={self.image_input: images,
-                                            self.keep_prob: 1.0})
+            output = self.predictions_argmax
+        else:
+            output = self.softmax_output
+
+        if isinstance(images, tf.data.Dataset):
+
+            if self.dataset_handle is None:
+                raise ValueError("This model was built without an input pipeline for `tf.data` datasets, pass the images as an array instead.")
+
+            dataset = images
+            if not isinstance(dataset.output_types, tuple):
+                # The input pipeline expects a label map for every image, so add empty ones.
+                dataset = dataset.map(lambda batch_images: (batch_images, tf.zeros(tf.shape(batch_images)[:3], dtype=tf.uint8)))
+            handle = self.sess.run(dataset.make_one_shot_iterator().string_handle())
+
+            predictions = []
+            while True:
+                try:
+                    predictions.append(self.sess.run(output,
+                                                     feed_dict={self.dataset_handle: handle,
+                                                                self.keep_prob: 1.0}))
+                except tf.errors.OutOfRangeError:
+                    break
+            return predictions
+
         else:
-            return self.sess.run(self.softmax_output,
+            return self.sess.run(output,
                                  feed_dict={self.image_input: images,
                                             self.keep_prob: 1.0})
 
@@ -777,7 +1267,8 @@ class FCN8s:
                          image_file_extension='png',
                          include_unprocessed_image=False,
                          arrangement='vertical',
-                         overwrite_existing=True):
+                         overwrite_existing=True,
+                         png_compression=None):
         '''
         Makes predictions for all images in a given directory, overlays a copy of the
         input images with the respective predictions, and saves the resulting images to disk.
@@ -809,6 +1300,9 @@ class FCN8s:
                 Defaults to 'vertical'.
             overwrite_existing (bool, optional): If `True`, overwrites the output directory
                 in case it already exists.
+            png_compression (int, optional): `None` or the zlib compression level in [0, 9] with
+                which to write PNG output images. Lower levels write faster but produce larger files.
+                If `None`, the codec's default level is used.
         '''
 
         # Make a directory in which to store the results.
@@ -828,9 +1322,9 @@ class FCN8s:
 
             filepath = image_paths[i]
 
-            image = scipy.misc.imread(filepath)
+            image = imread(filepath)
             if resize and not np.array_equal(image.shape[:2], resize):
-                image = scipy.misc.imresize(image, resize)
+                image = imresize(image, resize)
             img_height, img_width, img_ch = image.shape
 
             prediction = self.predict([image], argmax=False)
@@ -852,7 +1346,7 @@ class FCN8s:
                                                         positions=[(0, 0), (0, img_width)],
                                                         sizes=[(img_height, img_width), (img_height, img_width)])
 
-            scipy.misc.imsave(os.path.join(results_dir, os.path.basename(filepath)), processed_image)
+            imwrite(os.path.join(results_dir, os.path.basename(filepath)), processed_image, png_compression=png_compression)
 
     def save(self,
              model_save_dir,
@@ -862,7 +1356,9 @@ class FCN8s:
              include_global_step=True,
              include_last_training_loss=True,
              include_metrics=True,
-             force_save=False):
+             force_save=False,
+             checkpoint_writer=None,
+             monitor_value=None):
         '''
         Saves the model to disk.
 
@@ -889,6 +1385,13 @@ class FCN8s:
                 metrics will be included in the model name. Defaults to `True`.
             force_save (bool, optional): If `True`, force the saver to save the model
                 even if no variables have changed since saving last. Defaults to `False`.
+            checkpoint_writer (CheckpointWriter, optional): `None` or a `CheckpointWriter` from
+                `helpers.checkpoint_writer`. If given, only a snapshot of the variables is taken
+                and the writer writes it to disk in the background, see `CheckpointWriter.save()`.
+                The model is saved in the same format and to the same path as without a writer.
+            monitor_value (float, optional): Only relevant if `checkpoint_writer` is given.
+                The value of the monitored metric, which the writer uses to decide which
+                checkpoint is the best one to keep.
         '''
 
         if (not self.variables_updated) and (not force_save):
@@ -919,7 +1422,13 @@ class FCN8s:
         if not (include_global_step or include_last_training_loss or include_metrics) and (name is None):
             model_name += '_{}'.format(time.time())
 
-        if saver == 'saved_model':
+        if not checkpoint_writer is None:
+            checkpoint_writer.save(self.sess,
+                                   save_dir=os.path.join(model_save_dir, model_name),
+                                   saver=saver,
+                                   tags=tags,
+                                   monitor_value=monitor_value)
+        elif saver == 'saved_model':
             saved_model_builder = tf.saved_model.builder.SavedModelBuilder(os.path.join(model_save_dir, model_name))
             saved_model_builder.add_meta_graph_and_variables(sess=self.sess, tags=tags)
             saved_model_builder.save()
@@ -950,3 +1459,238 @@ class FCN8s:
         '''
         self.sess.close()
         print("The session has been closed.")
+
+def _read_meta_graph_def(export_dir, tags):
+    '''
+    Returns the meta graph with the tags `tags` from the `SavedModel` in `export_dir`,
+    without loading its variables.
+    '''
+    saved_model = saved_model_pb2.SavedModel()
+    with tf.gfile.GFile(os.path.join(export_dir, tf.saved_model.constants.SAVED_MODEL_FILENAME_PB), 'rb') as f:
+        saved_model.ParseFromString(f.read())
+
+    for meta_graph_def in saved_model.meta_graphs:
+        if set(meta_graph_def.meta_info_def.tags) == set(tags):
+            return meta_graph_def
+
+    raise ValueError("The SavedModel in '{}' doesn't contain a meta graph with the tags {}.".format(export_dir, tags))
+
+def _float32_variable_storage_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+    '''
+    A custom getter for `tf.variable_scope()` that stores trainable variables in float32
+    even if a layer requests them in float16, and returns a float16 copy to the layer instead.
+    The optimizer thus updates the float32 master weights.
+    '''
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+    if trainable and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+def _tower_device_function(device):
+    '''
+    Returns a device function that places variables on the CPU, from where all towers read them,
+    and all other operations on `device`.
+    '''
+    def device_function(op):
+        if op.type in ['Variable', 'VariableV2', 'VarHandleOp']:
+            return '/cpu:0'
+        return device
+    return device_function
+
+def _average_gradients(tower_grads_and_vars, tower_weights):
+    '''
+    Computes the weighted average of the gradients of the towers.
+
+    Arguments:
+        tower_grads_and_vars (list): One list of `(gradient, variable)` pairs per tower, as returned by
+            `compute_gradients()`. All lists must contain the same variables in the same order.
+        tower_weights (tensor): A 1D tensor that contains the weight of each tower.
+
+    Returns:
+        A list of `(gradient, variable)` pairs, without the variables that don't have gradients.
+    '''
+    grads_and_vars = []
+    for variable_grads_and_vars in zip(*tower_grads_and_vars):
+        variable = variable_grads_and_vars[0][1]
+        if variable_grads_and_vars[0][0] is None:
+            continue
+        gradient = tf.add_n([tower_weights[i] * gradient for i, (gradient, _) in enumerate(variable_grads_and_vars)])
+        grads_and_vars.append((gradient, variable))
+    return grads_and_vars
+
+def benchmark_towers(vgg16_dir,
+                     num_classes,
+                     devices,
+                     batch_size,
+                     image_size=(384, 1248),
+                     num_steps=20,
+                     warmup_steps=3,
+                     precision='float32'):
+    '''
+    Measures how the training throughput scales with the number of towers. For each `n` from 1 to
+    `len(devices)`, a new model with towers on the first `n` devices is built and trained on
+    random data. Afterwards, each model with more than one tower trains on a batch with fewer
+    images than towers, which must leave the loss and the weights finite.
+
+    Arguments:
+        vgg16_dir (string): See `FCN8s`.
+        num_classes (int): See `FCN8s`.
+        devices (list): The device names, see `FCN8s`.
+        batch_size (int): The batch size, which is split among the towers.
+        image_size (tuple, optional): The size `(height, width)` of the random images.
+        num_steps (int, optional): The number of training steps to time.
+        warmup_steps (int, optional): The number of training steps to run before the timing starts.
+        precision (string, optional): See `FCN8s`.
+
+    Returns:
+        A dictionary that maps each number of towers to the number of images trained on per second.
+    '''
+    images = np.random.randint(0, 256, size=(batch_size, image_size[0], image_size[1], 3)).astype(np.float32)
+    labels = np.random.randint(0, num_classes, size=(batch_size, image_size[0], image_size[1])).astype(np.uint8)
+
+    results = {}
+
+    for num_towers in range(1, len(devices) + 1):
+        with tf.Graph().as_default():
+            model = FCN8s(vgg16_dir=vgg16_dir,
+                          num_classes=num_classes,
+                          sparse_labels=True,
+                          precision=precision,
+                          devices=devices[:num_towers])
+            feed_dict = {model.image_input: images,
+                         model.labels: labels,
+                         model.learning_rate: 1e-6,
+                         model.keep_prob: 0.5,
+                         model.l2_regularization_rate: 0.0}
+            for step in range(warmup_steps + num_steps):
+                if step == warmup_steps:
+                    start = time.time()
+                model.sess.run(model.train_op, feed_dict=feed_dict)
+            results[num_towers] = batch_size * num_steps / (time.time() - start)
+            print('{} tower(s): {:.2f} images/s'.format(num_towers, results[num_towers]))
+            if num_towers > 1:
+                # Leave at least one tower without images, like the last batch of a pass can.
+                small_feed_dict = dict(feed_dict)
+                small_feed_dict.update({model.image_input: images[:num_towers-1],
+                                        model.labels: labels[:num_towers-1]})
+                _, small_batch_loss = model.sess.run([model.train_op, model.total_loss], feed_dict=small_feed_dict)
+                assert np.isfinite(small_batch_loss), '{} tower(s): The loss of a batch of {} image(s) is {}.'.format(num_towers, num_towers-1, small_batch_loss)
+                # NaN gradients of the empty towers would have made the weights NaN.
+                loss = model.sess.run(model.total_loss, feed_dict=feed_dict)
+                assert np.isfinite(loss), '{} tower(s): The loss is {} after training on a batch of {} image(s).'.format(num_towers, loss, num_towers-1)
+            model.close()
+
+    return results
+
+def compare_precisions(vgg16_dir,
+                       num_classes,
+                       batch_size=2,
+                       image_size=(96, 160),
+                       num_steps=10,
+                       num_batches=4,
+                       learning_rate=1e-5,
+                       tolerance=0.02,
+                       device='/cpu:0',
+                       seed=0):
+    '''
+    A smoke test for mixed precision that runs on the CPU. Trains one model with `precision='float32'`
+    and one with `precision='mixed'` for a few steps from the same initial weights on the same random
+    batches, with dropout disabled, and compares their loss curves. Steps that the loss scaling skips because
+    the float16 gradients overflowed make the curves drift apart, so a few steps are more telling than many.
+
+    Arguments:
+        vgg16_dir (string): See `FCN8s`.
+        num_classes (int): See `FCN8s`.
+        batch_size (int, optional): The batch size.
+        image_size (tuple, optional): The size `(height, width)` of the random images. Both sides
+            must be multiples of 32.
+        num_steps (int, optional): The number of training steps.
+        num_batches (int, optional): The number of random batches, which the training steps cycle through.
+        learning_rate (float, optional): The learning rate.
+        tolerance (float, optional): The largest relative difference between the losses of the two
+            models at any step for which the curves count as agreeing.
+        device (string, optional): The device on which to build both models. Defaults to the CPU.
+        seed (int, optional): The seed for the random batches.
+
+    Returns:
+        A dictionary with the losses of each step for 'float32' and 'mixed', their largest relative difference
+        'max_relative_difference', and whether that difference is within the tolerance, 'agree'.
+    '''
+    rng = np.random.RandomState(seed)
+    batches = [(rng.randint(0, 256, size=(batch_size, image_size[0], image_size[1], 3)).astype(np.float32),
+                rng.randint(0, num_classes, size=(batch_size, image_size[0], image_size[1])).astype(np.uint8))
+               for _ in range(num_batches)]
+
+    results = {}
+    initial_weights = None
+
+    for precision in ['float32', 'mixed']:
+        with tf.Graph().as_default():
+            with tf.device(device):
+                model = FCN8s(vgg16_dir=vgg16_dir,
+                              num_classes=num_classes,
+                              sparse_labels=True,
+                              precision=precision)
+            # The decoder is initialized randomly, and the op-level seeds depend on the graph, which
+            # differs between the precisions, so the mixed model starts from the float32 model's weights.
+            # Both keep their master weights in float32 under the same names.
+            trainable_variables = tf.trainable_variables()
+            if initial_weights is None:
+                initial_weights = dict(zip([variable.op.name for variable in trainable_variables], model.sess.run(trainable_variables)))
+            else:
+                for variable in trainable_variables:
+                    variable.load(initial_weights[variable.op.name], model.sess)
+            losses = []
+            for step in range(num_steps):
+                images, labels = batches[step % num_batches]
+                feed_dict = {model.image_input: images,
+                             model.labels: labels,
+                             model.learning_rate: learning_rate,
+                             model.keep_prob: 1.0,
+                             model.l2_regularization_rate: 0.0}
+                _, loss = model.sess.run([model.train_op, model.total_loss], feed_dict=feed_dict)
+                losses.append(float(loss))
+            results[precision] = losses
+            model.close()
+
+    relative_differences = np.abs(np.array(results['mixed']) - np.array(results['float32'])) / np.maximum(np.abs(results['float32']), 1e-12)
+    results['max_relative_difference'] = float(np.max(relative_differences))
+    results['agree'] = results['max_relative_difference'] <= tolerance
+
+    for step in range(num_steps):
+        print('Step {}: float32 loss {:.6f}, mixed loss {:.6f}'.format(step + 1, results['float32'][step], results['mixed'][step]))
+    print('Largest relative difference: {:.6f} ({} the tolerance of {})'.format(results['max_relative_difference'],
+                                                                                 'within' if results['agree'] else 'exceeds',
+                                                                                 tolerance))
+
+    return results
+
+def local_cluster_spec(num_workers, num_ps=1, start_port=2222):
+    '''
+    Returns a cluster specification for a distributed training in several processes on this machine,
+    see the `cluster_spec` argument of `FCN8s`.
+
+    Arguments:
+        num_workers (int): The number of worker processes.
+        num_ps (int, optional): The number of parameter server processes. Defaults to 1.
+        start_port (int, optional): The processes listen on consecutive ports starting at this one,
+            first the parameter servers, then the workers. Defaults to 2222.
+
+    Returns:
+        A dictionary that maps the job names 'ps' and 'worker' to lists of `localhost:port` addresses.
+    '''
+    return {'ps': ['localhost:{}'.format(start_port + i) for i in range(num_ps)],
+            'worker': ['localhost:{}'.format(start_port + num_ps + i) for i in range(num_workers)]}
+
+def run_parameter_server(cluster_spec, task_index=0):
+    '''
+    Runs a parameter server of a distributed training, see the `cluster_spec` argument of `FCN8s`.
+    Never returns, so it should be run in its own process.
+
+    Arguments:
+        cluster_spec (dict): The cluster specification.
+        task_index (int, optional): The index of this parameter server. Defaults to 0.
+    '''
+    server = tf.train.Server(tf.train.ClusterSpec(cluster_spec), job_name='ps', task_index=task_index)
+    server.join()
@@ -0,0 +1,201 @@
+import tensorflow as tf
+from tensorflow.core.protobuf import saved_model_pb2
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class CheckpointWriter():
+
+    def __init__(self,
+                 keep_last=None,
+                 monitor_mode='min',
+                 max_pending=1):
+        '''
+        Writes checkpoints in a background thread, so that saving a model only blocks
+        for as long as it takes to copy the variable values into host memory.
+
+        `save()` takes a snapshot of the variables and of the meta graph and hands it to a single
+        writer thread. The writer writes each checkpoint
+        into a temporary directory next to its destination and renames it once it is complete,
+        so that an interrupted write never leaves a valid-looking checkpoint behind. Errors
+        that occur in the writer are raised by the next call to `save()`, `wait()`, or `close()`.
+
+        Arguments:
+            keep_last (int, optional): `None` or the number of most recent checkpoints to keep.
+                Older checkpoints written by this writer are deleted, except for the one with
+                the best monitor value. If `None`, all checkpoints are kept.
+            monitor_mode (string, optional): Either 'min' or 'max', whether a lower or a higher
+                monitor value is better. Defaults to 'min'.
+            max_pending (int, optional): The maximum number of snapshots that are waiting to be written
+                or being written. Each pending snapshot holds a copy of all variables in memory. If the
+                limit is reached, `save()` blocks until the oldest pending checkpoint has been written.
+                Defaults to 1.
+        '''
+        if not monitor_mode in ['min', 'max']:
+            raise ValueError("`monitor_mode` must be either 'min' or 'max', but is '{}'.".format(monitor_mode))
+
+        self.keep_last = keep_last
+        self.monitor_mode = monitor_mode
+        self.checkpoints = [] # `(save_dir, monitor_value)` for each checkpoint that was written and not deleted, oldest first.
+        self.pending = []
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._graph = None
+        self._session = None
+        self._signature = None
+
+    def save(self, sess, save_dir, saver='train_saver', tags=['default'], monitor_value=None, var_list=None):
+        '''
+        Takes a snapshot of the variables and writes it in the background.
+
+        Arguments:
+            sess (Session): The session that holds the variable values.
+            save_dir (string): The directory to write the checkpoint to. It must not exist yet.
+            saver (string, optional): Either 'train_saver', in which case `save_dir` contains the same files
+                as after `tf.train.Saver.save()` with `save_path=save_dir/variables`, i.e. the variables, the meta
+                graph `variables.meta`, and the `checkpoint` state file, or 'saved_model', in which case
+                `save_dir` becomes a `SavedModel` that contains the graph of `sess` with the tags `tags`.
+            tags (list, optional): Only relevant for 'saved_model'. The tags of the meta graph.
+            monitor_value (float, optional): The value of the monitored metric for this checkpoint,
+                used by the retention policy. If `None`, the checkpoint never counts as the best one.
+            var_list (list, optional): The variables to save. If `None`, all global variables of
+                the graph of `sess` are saved.
+
+        Returns:
+            A `Future` that completes once the checkpoint has been written.
+        '''
+        if not saver in {'saved_model', 'train_saver'}:
+            raise ValueError("Unexpected value for `saver`: Can be either 'saved_model' or 'train_saver', but received '{}'.".format(saver))
+
+        self._raise_errors()
+        self._slots.acquire()
+
+        try:
+            with sess.graph.as_default():
+                if var_list is None:
+                    var_list = tf.global_variables()
+                # The graph can only be exported in this thread, since the training may change it.
+                # Without a saver definition, the variables are restored by name with a default saver.
+                meta_graph_def = tf.train.export_meta_graph(graph=sess.graph, clear_extraneous_savers=True)
+            values = sess.run(var_list)
+            names = [variable.op.name for variable in var_list]
+        except Exception:
+            self._slots.release()
+            raise
+
+        future = self._executor.submit(self._write, save_dir, saver, names, values, meta_graph_def, tags, monitor_value)
+        future.add_done_callback(lambda _: self._slots.release())
+        self.pending.append(future)
+
+        return future
+
+    def wait(self):
+        '''
+        Waits until all pending checkpoints have been written.
+        '''
+        for future in self.pending:
+            future.exception()
+        self._raise_errors()
+
+    def close(self):
+        '''
+        Waits until all pending checkpoints have been written and releases the writer thread.
+        '''
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+            if not self._session is None:
+                self._session.close()
+
+    def _raise_errors(self):
+        '''
+        Raises the error of the first finished write that failed, if any, and forgets the finished writes.
+        '''
+        finished = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in finished:
+            if not future.exception() is None:
+                raise future.exception()
+
+    def _write(self, save_dir, saver, names, values, meta_graph_def, tags, monitor_value):
+        '''
+        Writes a snapshot to `save_dir`. Runs in the writer thread.
+        '''
+        temp_dir = '{}.tmp-{}'.format(save_dir.rstrip(os.sep), os.getpid())
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+
+        try:
+            if saver == 'train_saver':
+                self._write_variables(os.path.join(temp_dir, 'variables'), names, values)
+                with open(os.path.join(temp_dir, 'variables.meta'), 'wb') as f:
+                    f.write(meta_graph_def.SerializeToString())
+                # A relative checkpoint path stays valid when the directory is renamed.
+                tf.train.update_checkpoint_state(os.path.abspath(temp_dir), model_checkpoint_path='variables')
+            else:
+                self._write_variables(os.path.join(temp_dir, 'variables', 'variables'), names, values)
+                saved_model = saved_model_pb2.SavedModel()
+                saved_model.saved_model_schema_version = 1
+                meta_graph = saved_model.meta_graphs.add()
+                meta_graph.CopyFrom(meta_graph_def)
+                meta_graph.meta_info_def.tags.extend(tags)
+                with open(os.path.join(temp_dir, 'saved_model.pb'), 'wb') as f:
+                    f.write(saved_model.SerializeToString())
+            os.rename(temp_dir, save_dir)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        self.checkpoints.append((save_dir, monitor_value))
+        self._apply_retention_policy()
+
+    def _write_variables(self, save_path, names, values):
+        '''
+        Writes the variable values with a `tf.train.Saver` of a private graph that mirrors the variables
+        by name, shape and type, so that the checkpoint can be restored into the original graph.
+        '''
+        signature = [(name, value.dtype, value.shape) for name, value in zip(names, values)]
+
+        if signature != self._signature:
+            if not self._session is None:
+                self._session.close()
+            self._graph = tf.Graph()
+            with self._graph.as_default():
+                self._placeholders = [tf.placeholder(dtype=value.dtype, shape=value.shape) for value in values]
+                variables = [tf.Variable(placeholder, trainable=False, name=name) for name, placeholder in zip(names, self._placeholders)]
+                # Variables are restored by the name under which they are saved, not by their name in this graph.
+                self._assign_op = tf.group(*[variable.initializer for variable in variables])
+                self._saver = tf.train.Saver(var_list=dict(zip(names, variables)), max_to_keep=None)
+            # Keep the writer on the CPU, so that it doesn't claim any GPU memory.
+            self._session = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+            self._signature = signature
+
+        self._session.run(self._assign_op, feed_dict=dict(zip(self._placeholders, values)))
+        self._saver.save(self._session, save_path=save_path, write_meta_graph=False, write_state=False)
+
+    def _apply_retention_policy(self):
+        '''
+        Deletes the oldest checkpoints beyond `keep_last`, except for the best one.
+        '''
+        if self.keep_last is None or len(self.checkpoints) <= self.keep_last:
+            return
+
+        scored = [checkpoint for checkpoint in self.checkpoints if not checkpoint[1] is None]
+        if len(scored) == 0:
+            best = None
+        elif self.monitor_mode == 'min':
+            best = min(scored, key=lambda checkpoint: checkpoint[1])
+        else:
+            best = max(scored, key=lambda checkpoint: checkpoint[1])
+
+        recent = self.checkpoints[-self.keep_last:]
+        for checkpoint in self.checkpoints[:-self.keep_last]:
+            if checkpoint is best:
+                continue
+            shutil.rmtree(checkpoint[0], ignore_errors=True)
+
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if (checkpoint in recent) or (checkpoint is best)]
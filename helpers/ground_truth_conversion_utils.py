@@ -1,4 +1,5 @@
 import numpy as np
+from functools import lru_cache
 
 def convert_IDs_to_IDs(input_array, id_map_array):
     '''
@@ -28,35 +29,106 @@ def convert_IDs_to_IDs_partial(image, id_map_dict):
     Converts an array of integers to an array of the same shape of any numeric
     datatype with elements of the input array replaced according to a map.
 
-    This is much slower than `conver_IDs_to_IDs()`, but it doesn't require
-    `id_map_dict` to contain a mapping for all possible values of `input_array`,
-    but rather only for those values that are to be replaced.
+    In contrast to `convert_IDs_to_IDs()`, `id_map_dict` doesn't need to contain
+    a mapping for all possible values of `image`, but rather only for those values
+    that are to be replaced. All other values remain unchanged.
+
+    For `uint8` and `uint16` arrays, the dictionary is turned into a full lookup
+    table (an identity map of length 256 or 65536 with the mapped keys overwritten)
+    once and cached, so that the conversion is a single indexing operation that is
+    just as fast as `convert_IDs_to_IDs()`. Other dtypes fall back to one pass
+    over the array per key.
 
     Arguments:
-        input_array (array): An nD Numpy array of an unsigned integer type.
-        id_map_dict (array): A Python dictionary that serves as a map between
+        image (array): An nD Numpy array of an unsigned integer type.
+        id_map_dict (dict): A Python dictionary that serves as a map between
             the values of the input array and the values of the returned array.
-            The keys of `id_map_dict` represent the values of `input_array`
+            The keys of `id_map_dict` represent the values of `image`
             and the values of `id_map_dict` represent the desired values of the
             returned array.
 
     Returns:
-        A Numpy array of the same shape as `input_array` with values according
+        A Numpy array of the same shape and dtype as `image` with values according
         to `id_map_dict`.
     '''
+    if image.dtype in (np.uint8, np.uint16):
+        return _get_partial_id_map(tuple(id_map_dict.items()), image.dtype.str)[image]
+
     canvas = np.copy(image)
 
-    for key, value in id_map.items():
+    for key, value in id_map_dict.items():
         canvas[image == key] = value
 
     return canvas
 
-def convert_between_IDs_and_colors(image, color_map_dict, gt_dtype=np.uint8):
+@lru_cache(maxsize=32)
+def _get_partial_id_map(id_map_items, dtype):
+    '''
+    Returns the full lookup table for a partial ID map and an unsigned integer dtype.
+    Cached, so that each map is only being prepared once per dtype.
+    '''
+    id_map_array = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    for key, value in id_map_items:
+        if 0 <= key < len(id_map_array): # Keys that can't occur in an array of this dtype are irrelevant.
+            id_map_array[key] = value
+    return id_map_array
+
+def convert_colors_to_IDs(image, color_map_dict, gt_dtype=np.uint8, unknown_id=0):
+    '''
+    Converts a 3-channel color image to a single-channel image of class IDs according to a map.
+
+    The three color channels of every pixel are packed into one 24-bit integer, which is then
+    looked up among the sorted packed colors of `color_map_dict` with a binary search, so the
+    conversion takes a single pass over the image regardless of the number of colors.
+
+    Arguments:
+        image (array): A Numpy array of shape `(height, width, 3)` (or more channels, of
+            which only the first three are being used) and dtype `uint8`.
+        color_map_dict (dict): A Python dictionary whose keys are 3-tuples of integers that
+            represent colors and whose values are the corresponding integer class IDs.
+        gt_dtype (dtype, optional): The dtype of the returned array.
+        unknown_id (int, optional): The class ID for pixels whose color is not a key of
+            `color_map_dict`. If `None`, a `ValueError` is raised if there are any such pixels.
+
+    Returns:
+        A Numpy array of shape `(height, width)` and dtype `gt_dtype`.
+    '''
+    packed_colors, ids = _get_packed_color_map(tuple(color_map_dict.items()))
+
+    packed_image = (image[...,0].astype(np.uint32) << 16) | (image[...,1].astype(np.uint32) << 8) | image[...,2]
+
+    positions = np.searchsorted(packed_colors, packed_image)
+    np.minimum(positions, len(packed_colors) - 1, out=positions) # Colors larger than all keys are unknown, too.
+    known = (packed_colors[positions] == packed_image)
+
+    canvas = ids[positions].astype(gt_dtype)
+
+    if not known.all():
+        if unknown_id is None:
+            raise ValueError("The image contains colors that are not in `color_map_dict`, e.g. {}.".format(tuple(int(c) for c in image[~known][0][:3])))
+        canvas[~known] = unknown_id
+
+    return canvas
 
+@lru_cache(maxsize=32)
+def _get_packed_color_map(color_map_items):
+    '''
+    Returns the sorted packed 24-bit colors of a color map and the class IDs in the same order.
+    Cached, so that each color map is only being prepared once.
+    '''
+    packed_colors = np.array([(int(color[0]) << 16) | (int(color[1]) << 8) | int(color[2]) for color, _ in color_map_items], dtype=np.uint32)
+    ids = np.array([class_id for _, class_id in color_map_items])
+    order = np.argsort(packed_colors)
+    return packed_colors[order], ids[order]
+
+def convert_between_IDs_and_colors(image, color_map_dict, gt_dtype=np.uint8):
+    '''
+    Converts a 3-channel color image to a single-channel image of class IDs or vice versa,
+    depending on the shape of `image`. For color images, see `convert_colors_to_IDs()`.
+    Colors that are not in `color_map_dict` are converted to class ID 0.
+    '''
     if len(np.squeeze(image).shape) == 3:
-        canvas = np.zeros(shape=(image.shape[0], image.shape[1]), dtype=gt_dtype)
-        for key, value in color_map_dict.items():
-            canvas[np.all(image == key, axis=2)] = value
+        canvas = convert_colors_to_IDs(image, color_map_dict, gt_dtype=gt_dtype)
     else:
         canvas = np.zeros(shape=(image.shape[0], image.shape[1], 3), dtype=np.uint8)
         for key, value in color_map_dict.items():
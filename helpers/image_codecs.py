@@ -0,0 +1,184 @@
+import numpy as np
+import os
+import io
+import time
+import cv2
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def _cv2_decode(data):
+    '''
+    Decodes an image with OpenCV.
+    '''
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError("OpenCV could not decode the image.")
+    # OpenCV returns BGR(A), everything else in this repository expects RGB(A).
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    return image
+
+def _cv2_encode(image, extension, png_compression):
+    '''
+    Encodes an image with OpenCV.
+    '''
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
+    params = [] if png_compression is None else [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    success, data = cv2.imencode(extension, image, params)
+    if not success:
+        raise ValueError("OpenCV could not encode the image as '{}'.".format(extension))
+    return data.tobytes()
+
+def _pil_decode(data):
+    '''
+    Decodes an image with Pillow.
+    '''
+    image = Image.open(io.BytesIO(data))
+    # Like `scipy.misc.imread()`, convert palette images to RGB(A).
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return np.array(image)
+
+def _pil_encode(image, extension, png_compression):
+    '''
+    Encodes an image with Pillow.
+    '''
+    f = io.BytesIO()
+    params = {} if png_compression is None else {'compress_level': png_compression}
+    Image.fromarray(image).save(f, format=Image.registered_extensions()[extension], **params)
+    return f.getvalue()
+
+# The available backends as `name: (decode, encode)`, in the order of preference.
+BACKENDS = {'cv2': (_cv2_decode, _cv2_encode)}
+if not Image is None:
+    BACKENDS['pil'] = (_pil_decode, _pil_encode)
+
+_default_backend = 'cv2'
+
+def set_default_backend(backend):
+    '''
+    Sets the backend that `imread()`, `imdecode()`, `imwrite()`, and `imencode()` use by default.
+    Worker processes that are started afterwards inherit the setting.
+
+    Arguments:
+        backend (string): One of the keys of `BACKENDS`, i.e. 'cv2' or, if Pillow is installed, 'pil'.
+    '''
+    global _default_backend
+    if not backend in BACKENDS:
+        raise ValueError("Unknown backend '{}'. Available backends: {}.".format(backend, list(BACKENDS)))
+    _default_backend = backend
+
+def imdecode(data, backend=None):
+    '''
+    Decodes an encoded image.
+
+    Arguments:
+        data (bytes): The contents of a PNG, JPEG, or other image file.
+        backend (string, optional): The backend to use, see `BACKENDS`. If `None`, the default backend is used.
+
+    Returns:
+        The decoded image as a Numpy array of shape `(height, width)` for single-channel images or
+        `(height, width, channels)` with the channels in RGB(A) order otherwise. The bit depth is preserved,
+        i.e. 16-bit PNGs are decoded to `uint16` arrays. Palette images are converted to RGB.
+    '''
+    return BACKENDS[_default_backend if backend is None else backend][0](data)
+
+def imread(source, backend=None):
+    '''
+    Reads and decodes an image, see `imdecode()`.
+
+    Arguments:
+        source (string or bytes): The path of the image file or the contents of the file as `bytes`.
+        backend (string, optional): The backend to use, see `BACKENDS`. If `None`, the default backend is used.
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return imdecode(source, backend)
+    with open(source, 'rb') as f:
+        return imdecode(f.read(), backend)
+
+def imencode(image, extension='.png', png_compression=None, backend=None):
+    '''
+    Encodes an image.
+
+    Arguments:
+        image (array): An image as returned by `imdecode()`.
+        extension (string, optional): The file extension that determines the format, e.g. '.png' or '.jpg'.
+        png_compression (int, optional): `None` or the zlib compression level in [0, 9] for PNG images.
+            Lower levels encode faster but produce larger files. If `None`, the backend's default is used.
+        backend (string, optional): The backend to use, see `BACKENDS`. If `None`, the default backend is used.
+
+    Returns:
+        The encoded image as `bytes`.
+    '''
+    return BACKENDS[_default_backend if backend is None else backend][1](image, extension.lower(), png_compression)
+
+def imwrite(path, image, png_compression=None, backend=None):
+    '''
+    Encodes an image and writes it to `path`. The file extension of `path` determines the format.
+    For the arguments, see `imencode()`.
+    '''
+    data = imencode(image, os.path.splitext(path)[1], png_compression, backend)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def imresize(image, size, interpolation='bilinear'):
+    '''
+    Resizes an image.
+
+    Arguments:
+        image (array): The image to resize.
+        size (tuple): The output size `(height, width)`.
+        interpolation (string, optional): Either 'bilinear' or, e.g. for ground truth images, 'nearest'.
+
+    Returns:
+        The resized image with the same data type and number of channels.
+    '''
+    if not interpolation in ['bilinear', 'nearest']:
+        raise ValueError("`interpolation` must be either 'bilinear' or 'nearest', but is '{}'.".format(interpolation))
+    return cv2.resize(image,
+                      dsize=(size[1], size[0]),
+                      interpolation=cv2.INTER_LINEAR if interpolation == 'bilinear' else cv2.INTER_NEAREST)
+
+def benchmark_decode(image_paths, backends=None, repeats=3):
+    '''
+    Measures the decoding throughput of each backend. The files are read into memory first,
+    so that only the decoding is being timed.
+
+    Arguments:
+        image_paths (list): The paths of the image files to decode.
+        backends (list, optional): The names of the backends to measure. If `None`, all available
+            backends are measured.
+        repeats (int, optional): How often to decode all images with each backend. The best run counts.
+
+    Returns:
+        A dictionary that maps each backend to a dictionary with the decoded images per second
+        ('images_per_second') and the encoded megabytes per second ('megabytes_per_second').
+    '''
+    data = []
+    for image_path in image_paths:
+        with open(image_path, 'rb') as f:
+            data.append(f.read())
+    num_bytes = sum(len(d) for d in data)
+
+    results = {}
+
+    for backend in (BACKENDS if backends is None else backends):
+        decode = BACKENDS[backend][0]
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for d in data:
+                decode(d)
+            best = min(best, time.perf_counter() - start)
+        results[backend] = {'images_per_second': len(data) / best,
+                            'megabytes_per_second': num_bytes / best / 1e6}
+
+    return results